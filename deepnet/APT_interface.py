@@ -83,6 +83,9 @@ import shapely.geometry
 import TrkFile
 from scipy.ndimage import uniform_filter
 import multiprocessing
+import queue
+import threading
+import traceback
 import poseConfig
 import torch
 import copy
@@ -320,18 +323,23 @@ def create_tfrecord(conf, split=True, split_file=None, use_cache=True, on_gt=Fal
         env = tf1.python_io.TFRecordWriter(train_filename)
         val_env = None
         envs = [env, val_env]
+        out_files = [train_filename]
     elif len(db_files) > 1:
         train_filename = db_files[0]
         env = tf1.python_io.TFRecordWriter(train_filename)
         val_filename = db_files[1]
         val_env = tf1.python_io.TFRecordWriter(val_filename)
         envs = [env, val_env]
+        out_files = [train_filename, val_filename]
     elif len(db_files)==1:
         train_filename = db_files[0]
         env = tf1.python_io.TFRecordWriter(train_filename)
         venv = tf1.python.io.TFRecordWriter(tempfile.mkstemp()[1])
         envs = [env,venv]
+        out_files = [train_filename]
     else:
+        out_files = [os.path.join(conf.cachedir, conf.trainfilename + '.tfrecords'),
+                     os.path.join(conf.cachedir, conf.valfilename + '.tfrecords')]
         try:
             envs = multiResData.create_envs(conf, split)
         except IOError:
@@ -348,6 +356,9 @@ def create_tfrecord(conf, split=True, split_file=None, use_cache=True, on_gt=Fal
 
     envs[0].close()
     envs[1].close() if envs[1] is not None else None
+    # offset index for random access and counting records without reading the whole file
+    for out_file in out_files:
+        PoseTools.create_tfrecord_index(out_file)
     try:
         with open(os.path.join(conf.cachedir, 'splitdata.json'), 'w') as f:
             json.dump(splits, f)
@@ -2346,12 +2357,34 @@ def create_cv_split_files(conf, n_splits=3):
     return all_train, splits, split_files
 
 
-def create_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc,use_bsize=True):
+def alloc_batch_ims(conf, bsize=None):
+    '''
+    Allocates a zeroed batch of bsize (default conf.batch_size) images. Batches are kept as uint8 since frames are read as uint8 and preprocess_ims converts them to uint8 anyway.
+    '''
+    if bsize is None:
+        bsize = conf.batch_size
+    return np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,), dtype=np.uint8)
+
+
+def batch_ims_buffers(conf, n_buffers):
+    '''
+    Cycles through n_buffers preallocated batches so that the batches can be reused while reading a movie. A buffer is overwritten n_buffers batches after it was handed out, so n_buffers should be larger than the number of batches in use at any time.
+    '''
+    return itertools.cycle([alloc_batch_ims(conf) for _ in range(n_buffers)])
+
+
+def create_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc,use_bsize=True,all_f=None):
+    '''
+    Reads and crops the images for the [frm,tgt] entries in to_do_list. If all_f is given, the images are read into it and rows beyond len(to_do_list) are zeroed, otherwise a new batch is allocated.
+    '''
     if use_bsize:
         bsize = conf.batch_size
     else:
         bsize = len(to_do_list)
-    all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
+    if all_f is None:
+        all_f = alloc_batch_ims(conf, bsize)
+    else:
+        all_f[len(to_do_list):, ...] = 0
     # KB 20200504: sometimes crop_loc might be specified as nans when
     # we want no cropping to happen for reasons. 
     if crop_loc is not None and np.any(np.isnan(np.array(crop_loc))):
@@ -2370,6 +2403,123 @@ def create_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc,use_bsize=True
     return all_f
 
 
+def iter_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc, buffers=None):
+    '''
+    Generator that yields the same batches as create_batch_ims on consecutive chunks of to_do_list.
+    to_do_list should be sorted by frame as in classify_movie. The movie is read in a single pass with cap.iter_frames, and each frame is decoded once and then cropped for all the targets in it.
+    If buffers (see batch_ims_buffers) is given, the batches are read into buffers from it instead of newly allocated ones.
+    '''
+    bsize = conf.batch_size
+    n_list = len(to_do_list)
+    if n_list == 0:
+        return
+    if crop_loc is not None and np.any(np.isnan(np.array(crop_loc))):
+        crop_loc = None
+
+    frames = np.unique([cur_entry[0] for cur_entry in to_do_list])
+    assert all(to_do_list[ndx][0] <= to_do_list[ndx + 1][0] for ndx in range(n_list - 1)), 'to_do_list should be sorted by frame'
+    step = int(np.gcd.reduce(np.diff(frames))) if frames.size > 1 else 1
+
+    def new_batch():
+        return alloc_batch_ims(conf) if buffers is None else next(buffers)
+
+    all_f = new_batch()
+    cur_t = 0
+    ndx = 0
+    for cur_f, frame, _ in cap.iter_frames(int(frames[0]), int(frames[-1]) + 1, step):
+        while ndx < n_list and to_do_list[ndx][0] == cur_f:
+            cur_trx = trx[to_do_list[ndx][1]]
+            frame_in, _ = multiResData.get_patch_from_frame(
+                frame, cur_f, conf, np.zeros([conf.n_classes, 2]),
+                cur_trx=cur_trx, flipud=flipud, crop_loc=crop_loc)
+            all_f[cur_t, ...] = frame_in
+            cur_t += 1
+            ndx += 1
+            if cur_t == bsize:
+                yield all_f
+                all_f = new_batch()
+                cur_t = 0
+        if ndx == n_list:
+            break
+    assert ndx == n_list, 'Could not read all the frames to track'
+    if cur_t > 0:
+        all_f[cur_t:, ...] = 0
+        yield all_f
+
+
+def prefetch_batch_ims(to_do_list, conf, cap, flipud, trx, crop_loc, n_workers=1, queue_depth=4, stream=False):
+    '''
+    Generator that yields (cur_b, all_f) for the batches of to_do_list in order, where all_f is the output of create_batch_ims for batch cur_b.
+    Batches are read and cropped by n_workers background threads so that decoding overlaps with prediction on the current batch. At most queue_depth batches are read ahead. If queue_depth is 0, batches are read serially in the calling thread.
+    Worker w reads batches w, w+n_workers, ... Worker 0 uses cap, and the other workers open their own reader on the movie so that they don't compete for the seek position.
+    If stream is True and there is a single worker, the batches are read with iter_batch_ims in one pass through the movie. to_do_list should then be sorted by frame.
+    Each worker reads into its own ring of preallocated batches, so a yielded batch is only valid till the next one is requested.
+    '''
+    bsize = conf.batch_size
+    n_list = len(to_do_list)
+    n_batches = int(math.ceil(float(n_list) / bsize))
+    if queue_depth < 1:
+        n_workers = 1
+    n_workers = max(1, min(n_workers, n_batches))
+    worker_depth = max(1, queue_depth // n_workers)
+
+    def read_batches(w, cur_cap, n_buffers):
+        buffers = batch_ims_buffers(conf, n_buffers)
+        if stream and n_workers == 1:
+            yield from iter_batch_ims(to_do_list, conf, cur_cap, flipud, trx, crop_loc, buffers=buffers)
+            return
+        for cur_b in range(w, n_batches, n_workers):
+            cur_start = cur_b * bsize
+            ppe = min(n_list - cur_start, bsize)
+            yield create_batch_ims(to_do_list[cur_start:(cur_start + ppe)], conf, cur_cap, flipud, trx, crop_loc, all_f=next(buffers))
+
+    if queue_depth < 1 or n_batches == 0:
+        for cur_b, all_f in enumerate(read_batches(0, cap, 1)):
+            yield cur_b, all_f
+        return
+
+    # one queue per worker so that batches can be consumed in order
+    queues = [queue.Queue(maxsize=worker_depth) for _ in range(n_workers)]
+    stop = threading.Event()
+
+    def put(w, item):
+        while not stop.is_set():
+            try:
+                queues[w].put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker(w):
+        cur_cap = None
+        try:
+            cur_cap = cap if w == 0 else movies.Movie(cap.fullpath, use_keyframe_index=cap.use_keyframe_index)
+            # batches in the queue, the one being read and the one being used for prediction
+            for all_f in read_batches(w, cur_cap, worker_depth + 2):
+                if not put(w, (all_f, None)):
+                    break
+        except Exception as e:
+            put(w, (None, e))
+        finally:
+            if w > 0 and cur_cap is not None:
+                cur_cap.close()
+
+    threads = [threading.Thread(target=worker, args=(w,), daemon=True) for w in range(n_workers)]
+    for t in threads:
+        t.start()
+    try:
+        for cur_b in range(n_batches):
+            all_f, err = queues[cur_b % n_workers].get()
+            if err is not None:
+                raise err
+            yield cur_b, all_f
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+
 def get_trx_info(trx_file, conf, n_frames, use_ht_pts=False):
     ''' all returned values are 0-indexed'''
     if conf.has_trx_file:
@@ -2495,11 +2645,12 @@ def classify_list(conf, pred_fn, cap, to_do_list, trx, crop_loc, n_done=0, part_
     if do_write_n_done:
         start_time = time.time()
 
+    all_f = alloc_batch_ims(conf)
     for cur_b in range(n_batches):
         cur_start = cur_b * bsize
         nrows_pred = min(n_list - cur_start, bsize)
         all_f = create_batch_ims(to_do_list[cur_start:(cur_start + nrows_pred)],
-                                 conf, cap, flipud, trx, crop_loc)
+                                 conf, cap, flipud, trx, crop_loc, all_f=all_f)
         assert all_f.shape[0] == bsize  # dim0 has size bsize but only nrows_pred rows are filled
         ret_dict_b = pred_fn(all_f)
 
@@ -2692,7 +2843,7 @@ def classify_db(conf, read_fn, pred_fn, n, return_ims=False,
                 return_hm=False, hm_dec=100, hm_floor=0.0, hm_nclustermax=1):
     '''Classifies n examples generated by read_fn'''
     bsize = conf.batch_size
-    all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
+    all_f = alloc_batch_ims(conf, bsize)
     pred_locs = np.zeros([n, conf.n_classes, 2])
     mdn_locs = np.zeros([n, conf.n_classes, 2])
     unet_locs = np.zeros([n, conf.n_classes, 2])
@@ -2764,7 +2915,7 @@ def classify_db_multi(conf, read_fn, pred_fn, n, return_ims=False,
     '''Classifies n examples generated by read_fn'''
     bsize = conf.batch_size
     max_n = conf.max_n_animals
-    all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
+    all_f = alloc_batch_ims(conf, bsize)
     pred_locs = np.zeros([n, max_n, conf.n_classes, 2])
     mdn_locs = np.zeros([n, max_n, conf.n_classes, 2])
     unet_locs = np.zeros([n, max_n, conf.n_classes, 2])
@@ -2844,7 +2995,7 @@ def classify_db_multi(conf, read_fn, pred_fn, n, return_ims=False,
     '''Classifies n examples generated by read_fn'''
     bsize = conf.batch_size
     max_n = conf.max_n_animals
-    all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
+    all_f = alloc_batch_ims(conf, bsize)
     pred_locs = np.zeros([n, max_n, conf.n_classes, 2])
     mdn_locs = np.zeros([n, max_n, conf.n_classes, 2])
     unet_locs = np.zeros([n, max_n, conf.n_classes, 2])
@@ -2926,7 +3077,7 @@ def classify_db2(conf, read_fn, pred_fn, n, return_ims=False,
     bsize = conf.batch_size
     n_batches = int(math.ceil(float(n) / bsize))
 
-    all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,))
+    all_f = alloc_batch_ims(conf, bsize)
     if conf.is_multi:
         labeled_locs = np.zeros([n, conf.max_n_animals,conf.n_classes, 2])
     else:
@@ -3113,7 +3264,7 @@ def classify_db_2stage(model_type, conf, db_file, model_file = [None,None], name
 
     bsize = conf[0].batch_size
     max_n = conf[0].max_n_animals
-    all_f = np.zeros((bsize,) + tuple(conf[0].imsz) + (conf[0].img_dim,))
+    all_f = alloc_batch_ims(conf[0], bsize)
     n_batches = int(math.ceil(float(db_len) / bsize))
     ret_dict_all = {}
     labeled_locs = np.zeros([db_len, max_n, npts, 2])
@@ -3184,7 +3335,7 @@ def classify_db_2stage(model_type, conf, db_file, model_file = [None,None], name
 
     # Predict the single level
     bsize = conf[1].batch_size
-    all_fs = np.zeros((conf[1].batch_size,) + tuple(conf[1].imsz) + (conf[1].img_dim,))
+    all_fs = alloc_batch_ims(conf[1])
     n_batches = int(math.ceil(float(len(single_data)) / bsize))
 
     for cur_b in tqdm(range(n_batches),**TQDM_PARAMS,unit='batch'):
@@ -3582,11 +3733,12 @@ def convert_to_mat_trk(pred_locs, conf, start, end, trx_ids):
     return pred_dict
 
 
-def write_trk(out_file, pred_locs_in, extra_dict, start, info, conf=None):
+def create_trk(pred_locs_in, extra_dict, start):
     '''
+    Creates an unlinked dense Trk object from the predictions.
     pred_locs is the predicted locations of size
     n_frames x n_Trx x n_body_parts x 2
-    n_done is the number of frames that have been tracked.
+    start is the frame number of the first row of pred_locs.
     everything should be 0-indexed
     '''
 
@@ -3605,12 +3757,20 @@ def write_trk(out_file, pred_locs_in, extra_dict, start, info, conf=None):
         tag = np.transpose(pred_occ, [2, 0, 1])
 
     trk = TrkFile.Trk(p=locs_lnk, pTrkTS=ts, pTrkTag=tag, pTrkConf=locs_conf,T0=start)
-    if (conf is not None)  and do_link(conf):
-        trk = lnk.link_pure(trk, conf)
-
-    trk.save(out_file, saveformat='tracklet', trkInfo=info)
     return trk
 
+
+def write_trk(out_file, pred_locs_in, extra_dict, start, info, conf=None):
+    '''
+    pred_locs is the predicted locations of size
+    n_frames x n_Trx x n_body_parts x 2
+    n_done is the number of frames that have been tracked.
+    everything should be 0-indexed
+    '''
+
+    trk = create_trk(pred_locs_in, extra_dict, start)
+    return save_trk(out_file, trk, info, conf)
+
     # Old code that saves extra information. Keeping it in for now MK - 20210319
     pred_locs = convert_to_mat_trk(pred_locs_in, conf, start, end, trx_ids)
 
@@ -3648,80 +3808,62 @@ def write_trk(out_file, pred_locs_in, extra_dict, start, info, conf=None):
         logging.exception("Did not successfully write output to %s" % out_file_tmp)
 
 
-def classify_movie(conf, pred_fn, model_type,
-                   mov_file='',
-                   out_file='',
-                   trx_file=None,
-                   start_frame=0,
-                   end_frame=-1,
-                   skip_rate=1,
-                   trx_ids=(),
-                   model_file='',
-                   name='',
-                   nskip_partfile=500,
-                   save_hmaps=False,
-                   predict_trk_file=None,
-                   crop_loc=[None]):
-    ''' Classifies frames in a movie. All animals in a frame are classified before moving to the next frame.'''
+def save_trk(out_file, trk, info, conf=None):
+    '''
+    Saves the unlinked dense trk to out_file. If conf is given and linking is done at this stage, the trk is linked before saving. Returns the saved trk.
+    '''
+    if (conf is not None)  and do_link(conf):
+        trk = lnk.link_pure(trk, conf)
 
-    if type(crop_loc) == list and crop_loc[0] is None:
-        crop_loc = None
-    logging.info('classify_movie:')
-    logging.info(f'mov_file: {mov_file}\n' + \
-                 f'out_file: {out_file}\n' + \
-                 f'trx_file: {trx_file}\n' + \
-                 f'start_frame: {start_frame}, end_frame: {end_frame}, skip_rate: {skip_rate}\n' + \
-                 f'trx_ids: {trx_ids}\n' + \
-                 f'model_file: {model_file}\n' + \
-                 f'name: {name}\n' + \
-                 f'crop_loc: {crop_loc}')
+    trk.save(out_file, saveformat='tracklet', trkInfo=info)
+    return trk
 
-    pre_fix, ext = os.path.splitext(out_file)
-    part_file = out_file + '.part'
 
-    cap = movies.Movie(mov_file)
-    logging.info('Preparing to track...')
-    sz = (cap.get_height(), cap.get_width())
-    n_frames = int(cap.get_n_frames())
-    trx_dict = get_trx_info(trx_file, conf, n_frames)
+def track_movie_frames(conf, pred_fn, cap, trx_dict, trx_ids, start_frame, end_frame, skip_rate=1, crop_loc=None,
+                       part_file=None, info=None, nskip_partfile=500, resume_trk=None, resume_frame=None, linker=None):
+    '''
+    Tracks every skip_rate-th frame from start_frame to end_frame (exclusive) of the movie cap using pred_fn. trx_dict is the output of get_trx_info and trx_ids are the (0-indexed) targets to track.
+    Returns the predictions as an unlinked dense Trk with T0=start_frame. If part_file is given, partial results are appended to it every nskip_partfile batches, and it has all the predictions once tracking is done.
+    If resume_trk is given (see load_part_trk), predictions for frames before resume_frame are taken from it and only the remaining frames are tracked.
+    If linker (a link_trajectories.OnlineLinker) is given, the predictions are added to it after every batch and only the frames that are not yet in the linker or the part file are kept, so memory does not grow with the number of frames. Nothing is returned in this case.
+    '''
     T = trx_dict['trx']; n_trx = trx_dict['n_trx']
     first_frames = trx_dict['first_frames']; end_frames = trx_dict['end_frames']
-
-    # For multi-animal T is [None,] and n_trx is conf.max_n_animals. With this combination, rest of the workflow seems to work. Totally unintentional but I'm not going to update it if it is working. MK 20201111
-    has_trx = conf.has_trx_file or conf.use_ht_trx or conf.use_bbox_trx
-    trx_ids = get_trx_ids(trx_ids, n_trx, has_trx)
-    conf.batch_size = 1 if model_type == 'deeplabcut' else conf.batch_size
     bsize = conf.batch_size
     flipud = conf.flipud
 
-    logging.info('Organizing output trk file metadata...')
-    info = compile_trk_info(conf, model_file, crop_loc, mov_file, expname=name)
-
-    if end_frames.size==0:
-        logging.warning('No frames to track, writing empty trk file.')
-        pred_locs = np.zeros([1,0,conf.n_classes,2])
-        write_trk(out_file, pred_locs, {}, 0, 1, [], conf, info, mov_file)
-        return
-
-    logging.info('Determining frames to track...')
-
-    if end_frame < 0: end_frame = end_frames.max()
-    if end_frame > end_frames.max(): end_frame = end_frames.max()
-    if start_frame > end_frame: return None
-
     max_n_frames = end_frame - start_frame
-    min_first_frame = start_frame
-    pred_locs = np.zeros([max_n_frames, n_trx, conf.n_classes, 2])
+    if resume_trk is None:
+        resume_frame = start_frame
+    # pred_locs and extra_dict have the predictions from frame buf_start onwards. Without a linker, for all the frames.
+    buf_start = start_frame
+    n_buf = max_n_frames
+    if linker is not None:
+        buf_start = resume_frame
+        n_buf = min(end_frame - resume_frame, 2 * bsize * skip_rate)
+    pred_locs = np.zeros([n_buf, n_trx, conf.n_classes, 2])
     pred_locs[:] = np.nan
 
     extra_dict = {}
 
-    hmap_out_dir = os.path.splitext(out_file)[0] + '_hmap'
-    if (not os.path.exists(hmap_out_dir)) and save_hmaps:
-        os.mkdir(hmap_out_dir)
+    resume_extra = {}
+    resume_part_trk = None
+    if resume_trk is not None:
+        if linker is None:
+            pred_locs[:resume_frame - start_frame], resume_extra = get_part_trk_preds(resume_trk, start_frame, resume_frame)
+            if 'conf' in resume_extra:
+                extra_dict['conf'] = np.zeros(pred_locs.shape[:3])
+                extra_dict['conf'][:resume_frame - start_frame] = resume_extra['conf']
+        else:
+            # the frames tracked earlier are linked and added to the new part file right away
+            resume_part_trk = create_trk(*get_part_trk_preds(resume_trk, start_frame, resume_frame), start_frame)
+            linker.append(resume_part_trk)
+        logging.info('Resuming tracking from frame {}'.format(resume_frame))
 
     to_do_list = []
     for cur_f in range(start_frame, end_frame,skip_rate):
+        if cur_f < resume_frame:
+            continue
         for t in range(n_trx):
             if not np.any(trx_ids == t) and len(trx_ids)>0:
                 continue
@@ -3734,17 +3876,39 @@ def classify_movie(conf, pred_fn, model_type,
 
     n_list = len(to_do_list)
     n_batches = int(math.ceil(float(n_list) / bsize))
+
+    part_writer = None
+    if part_file is not None:
+        part_info = {} if info is None else info.copy()
+        part_info['part'] = {'start_frame': start_frame, 'next_frame': start_frame, 'skip_rate': skip_rate}
+        part_writer = TrkFile.TrkWriter(part_file, n_trx, T0=start_frame, trkInfo=part_info)
+        if resume_part_trk is not None:
+            part_writer.append(resume_part_trk)
+            part_writer.set_info('part/next_frame', resume_frame)
+    # next frame to add to the linker
+    link_frame = buf_start
+
     logging.info('Tracking...')
-    for cur_b in tqdm(range(n_batches),**TQDM_PARAMS,unit='batch'):
+    # batches are read ahead in background threads while the network runs on the current batch
+    batch_iter = prefetch_batch_ims(to_do_list, conf, cap, flipud, T, crop_loc,
+                                    n_workers=conf.get('track_prefetch_workers', 1),
+                                    queue_depth=conf.get('track_prefetch_depth', 4),
+                                    stream=conf.get('track_stream_frames', True))
+    for cur_b, all_f in tqdm(batch_iter, total=n_batches, **TQDM_PARAMS, unit='batch'):
         cur_start = cur_b * bsize
         ppe = min(n_list - cur_start, bsize)
-        all_f = create_batch_ims(to_do_list[cur_start:(cur_start + ppe)], conf, cap, flipud, T, crop_loc)
+
+        # frames before next_frame are done after this batch
+        n_done = cur_start + ppe
+        next_frame = to_do_list[n_done][0] if n_done < n_list else end_frame
+        if linker is not None:
+            keep_frame = link_frame if part_writer is None else min(link_frame, part_writer.T0 + part_writer.T)
+            pred_locs, extra_dict, buf_start = reserve_track_buffers(pred_locs, extra_dict, buf_start, keep_frame, next_frame - 1)
 
         ret_dict = pred_fn(all_f)
         base_locs = ret_dict.pop('locs')
         # hmaps = ret_dict.pop('hmaps')
 
-        assert not save_hmaps
         # if save_hmaps:
         # mat_out = os.path.join(hmap_out_dir, 'hmap_batch_{}.mat'.format(cur_b+1))
         # hdf5storage.savemat(mat_out,{'hm':hmaps,'startframe1b':to_do_list[cur_start][0]+1})
@@ -3757,9 +3921,9 @@ def classify_movie(conf, pred_fn, model_type,
             base_locs_orig = convert_to_orig(base_locs[cur_t, ...], conf, cur_f, cur_trx, crop_loc)
             if conf.is_multi:
                 # doing only this seems to work
-                pred_locs[cur_f - min_first_frame, :, :, :] = base_locs_orig[...]
+                pred_locs[cur_f - buf_start, :, :, :] = base_locs_orig[...]
             else:
-                pred_locs[cur_f - min_first_frame, trx_ndx, :, :] = base_locs_orig[...]
+                pred_locs[cur_f - buf_start, trx_ndx, :, :] = base_locs_orig[...]
 
             # if save_hmaps:
             #    write_hmaps(hmaps[cur_t, ...], hmap_out_dir, trx_ndx, cur_f)
@@ -3778,9 +3942,11 @@ def classify_movie(conf, pred_fn, model_type,
                     if k not in extra_dict:
                         sz = cur_v.shape[1:]
                         if conf.is_multi:
-                            extra_dict[k] = np.zeros((max_n_frames,) + sz)
+                            extra_dict[k] = np.zeros((pred_locs.shape[0],) + sz)
                         else:
-                            extra_dict[k] = np.zeros((max_n_frames, n_trx) + sz)
+                            extra_dict[k] = np.zeros((pred_locs.shape[0], n_trx) + sz)
+                        if k in resume_extra:
+                            extra_dict[k][:resume_frame - start_frame] = resume_extra[k]
 
                     if k.startswith('locs'):  # transform locs
                         cur_orig = convert_to_orig(cur_v[cur_t, ...], conf, cur_f, cur_trx, crop_loc)
@@ -3788,13 +3954,200 @@ def classify_movie(conf, pred_fn, model_type,
                         cur_orig = cur_v[cur_t, ...]
 
                     if conf.is_multi:
-                        extra_dict[k][cur_f - min_first_frame, ...] = cur_orig
+                        extra_dict[k][cur_f - buf_start, ...] = cur_orig
                     else:
-                        extra_dict[k][cur_f - min_first_frame, trx_ndx, ...] = cur_orig
+                        extra_dict[k][cur_f - buf_start, trx_ndx, ...] = cur_orig
 
-        if (cur_b % nskip_partfile == 0) & (cur_b > 0):
+        if (part_writer is not None) and (cur_b % nskip_partfile == 0) & (cur_b > 0):
             #Write partial trk files . no linking
-            write_trk(part_file, pred_locs, extra_dict, start_frame, info)
+            # Frames before next_frame are done, so tracking can be resumed from there.
+            append_part_trk(part_writer, pred_locs, extra_dict, buf_start, next_frame)
+
+        if linker is not None and next_frame > link_frame:
+            f0 = link_frame - buf_start
+            f1 = next_frame - buf_start
+            linker.append(create_trk(pred_locs[f0:f1], {k: v[f0:f1] for k, v in extra_dict.items()}, link_frame))
+            link_frame = next_frame
+
+    if linker is not None:
+        keep_frame = link_frame if part_writer is None else min(link_frame, part_writer.T0 + part_writer.T)
+        pred_locs, extra_dict, buf_start = reserve_track_buffers(pred_locs, extra_dict, buf_start, keep_frame, end_frame - 1)
+    if part_writer is not None:
+        append_part_trk(part_writer, pred_locs, extra_dict, buf_start, end_frame)
+        part_writer.close()
+
+    if linker is not None:
+        if end_frame > link_frame:
+            f0 = link_frame - buf_start
+            f1 = end_frame - buf_start
+            linker.append(create_trk(pred_locs[f0:f1], {k: v[f0:f1] for k, v in extra_dict.items()}, link_frame))
+        return None
+    return create_trk(pred_locs, extra_dict, start_frame)
+
+
+def reserve_track_buffers(pred_locs, extra_dict, buf_start, keep_frame, last_frame):
+    '''
+    Makes sure that the prediction buffers pred_locs and extra_dict of track_movie_frames, whose first row is for frame buf_start, have a row for last_frame. If they don't, the frames before keep_frame, which are not needed anymore, are dropped and the buffers are grown if that is not enough.
+    Returns the buffers and the frame of their first row.
+    '''
+    if last_frame - buf_start < pred_locs.shape[0]:
+        return pred_locs, extra_dict, buf_start
+    n_drop = keep_frame - buf_start
+    n_rows = max(pred_locs.shape[0], 2 * (last_frame - keep_frame + 1))
+
+    def resize(x, fill):
+        out = np.full((n_rows,) + x.shape[1:], fill, dtype=x.dtype)
+        out[:x.shape[0] - n_drop] = x[n_drop:]
+        return out
+
+    return resize(pred_locs, np.nan), {k: resize(v, 0) for k, v in extra_dict.items()}, keep_frame
+
+
+def append_part_trk(writer, pred_locs, extra_dict, start_frame, next_frame):
+    '''
+    Appends the predictions for the frames after the last frame in the part file till next_frame (exclusive) using TrkFile.TrkWriter writer. pred_locs and extra_dict are as in track_movie_frames, with the first row for start_frame.
+    '''
+    f0 = writer.T0 + writer.T - start_frame
+    f1 = next_frame - start_frame
+    if f1 > f0 or writer.fields is None:
+        writer.append(create_trk(pred_locs[f0:f1], {k: v[f0:f1] for k, v in extra_dict.items()}, start_frame + f0))
+    writer.set_info('part/next_frame', next_frame)
+
+
+def load_part_trk(part_file, mov_file, start_frame, end_frame, skip_rate):
+    '''
+    Loads the partial trk file written by track_movie_frames to resume tracking of mov_file. Returns the trk and the frame from which tracking should resume. Frames before it were tracked completely, for all the targets.
+    Returns None, None if there is no part file or if it was written while tracking with different frame range or skip rate.
+    '''
+    if not os.path.exists(part_file):
+        logging.info('No part file {} to resume tracking from'.format(part_file))
+        return None, None
+    try:
+        trk = TrkFile.Trk(part_file)
+        info = trk.trkData['trkInfo']
+        part = info['part']
+        part_start, next_frame, part_skip = [int(np.squeeze(part[k])) for k in ['start_frame', 'next_frame', 'skip_rate']]
+    except (OSError, KeyError):
+        logging.warning('Could not read tracking progress from part file {}. Tracking from the start'.format(part_file))
+        return None, None
+
+    if info['mov_file'] != mov_file or part_start != start_frame or part_skip != skip_rate or next_frame > end_frame:
+        logging.warning('Part file {} was written for a different movie, frame range or skip rate. Tracking from the start'.format(part_file))
+        return None, None
+    return trk, next_frame
+
+
+def get_part_trk_preds(trk, start_frame, end_frame):
+    '''
+    Returns the predictions for frames start_frame to end_frame (exclusive) from a part trk in the format used while tracking. pred_locs is n_frames x n_targets x n_landmarks x 2 and extra_dict has the confidences and occlusions, if present. As while tracking, confidences for frames that were not tracked are 0.
+    '''
+    frames = np.arange(start_frame, end_frame)
+    p, edict = trk.gettargetframe(np.arange(trk.ntargets), frames, extra=True)
+    pred_locs = np.transpose(p, [2, 3, 0, 1])
+    extra_dict = {}
+    if edict['pTrkConf'] is not None:
+        extra_dict['conf'] = np.transpose(edict['pTrkConf'], [1, 2, 0])
+        extra_dict['conf'][np.isnan(extra_dict['conf'])] = 0
+    if edict['pTrkTag'] is not None:
+        extra_dict['occ'] = np.transpose(edict['pTrkTag'], [1, 2, 0]).astype('float')
+    return pred_locs, extra_dict
+
+
+def classify_movie(conf, pred_fn, model_type,
+                   mov_file='',
+                   out_file='',
+                   trx_file=None,
+                   start_frame=0,
+                   end_frame=-1,
+                   skip_rate=1,
+                   trx_ids=(),
+                   model_file='',
+                   name='',
+                   nskip_partfile=500,
+                   save_hmaps=False,
+                   predict_trk_file=None,
+                   crop_loc=[None],
+                   resume=False):
+    ''' Classifies frames in a movie. All animals in a frame are classified before moving to the next frame.
+    pred_fn can also be a TrackShardPool, in which case the frames are split between the pool's worker processes and their partial trks are merged before linking.
+    If resume is True, frames already tracked in the part file from an earlier, interrupted run are not tracked again.
+    Returns the saved trk, or None if the tracklets were linked while tracking (conf.link_online) and are only in the output file.'''
+
+    if type(crop_loc) == list and crop_loc[0] is None:
+        crop_loc = None
+    logging.info('classify_movie:')
+    logging.info(f'mov_file: {mov_file}\n' + \
+                 f'out_file: {out_file}\n' + \
+                 f'trx_file: {trx_file}\n' + \
+                 f'start_frame: {start_frame}, end_frame: {end_frame}, skip_rate: {skip_rate}\n' + \
+                 f'trx_ids: {trx_ids}\n' + \
+                 f'model_file: {model_file}\n' + \
+                 f'name: {name}\n' + \
+                 f'crop_loc: {crop_loc}')
+
+    pre_fix, ext = os.path.splitext(out_file)
+    part_file = out_file + '.part'
+
+    cap = movies.Movie(mov_file, use_keyframe_index=conf.get('movie_keyframe_index', False))
+    logging.info('Preparing to track...')
+    n_frames = int(cap.get_n_frames())
+    trx_dict = get_trx_info(trx_file, conf, n_frames)
+    T = trx_dict['trx']; n_trx = trx_dict['n_trx']
+    first_frames = trx_dict['first_frames']; end_frames = trx_dict['end_frames']
+
+    # For multi-animal T is [None,] and n_trx is conf.max_n_animals. With this combination, rest of the workflow seems to work. Totally unintentional but I'm not going to update it if it is working. MK 20201111
+    has_trx = conf.has_trx_file or conf.use_ht_trx or conf.use_bbox_trx
+    trx_ids = get_trx_ids(trx_ids, n_trx, has_trx)
+    conf.batch_size = 1 if model_type == 'deeplabcut' else conf.batch_size
+
+    logging.info('Organizing output trk file metadata...')
+    info = compile_trk_info(conf, model_file, crop_loc, mov_file, expname=name)
+
+    if end_frames.size==0:
+        logging.warning('No frames to track, writing empty trk file.')
+        pred_locs = np.zeros([1,0,conf.n_classes,2])
+        write_trk(out_file, pred_locs, {}, 0, 1, [], conf, info, mov_file)
+        return
+
+    logging.info('Determining frames to track...')
+
+    if end_frame < 0: end_frame = end_frames.max()
+    if end_frame > end_frames.max(): end_frame = end_frames.max()
+    if start_frame > end_frame: return None
+
+    max_n_frames = end_frame - start_frame
+    min_first_frame = start_frame
+
+    hmap_out_dir = os.path.splitext(out_file)[0] + '_hmap'
+    if (not os.path.exists(hmap_out_dir)) and save_hmaps:
+        os.mkdir(hmap_out_dir)
+    assert not save_hmaps
+
+    resume_trk, resume_frame = None, None
+    if resume and isinstance(pred_fn, TrackShardPool):
+        # shards are tracked by the pool's workers and no part file is written, so there is no progress to resume from.
+        logging.warning('Resuming is not supported when tracking in shards. Tracking {} from the start'.format(mov_file))
+    elif resume:
+        resume_trk, resume_frame = load_part_trk(part_file, mov_file, start_frame, end_frame, skip_rate)
+
+    raw_file = raw_predict_file(predict_trk_file, out_file)
+    cur_out_file = raw_file if do_link(conf) else out_file
+    linker = None
+    if do_link(conf) and conf.get('link_online', False):
+        # pure linking is done while tracking, and the tracklets are written to a temporary file as they are linked.
+        # it is renamed once tracking is done because the existence of the trk file signals that tracking is done.
+        linker = lnk.OnlineLinker(conf, TrkFile.TrackletWriter(cur_out_file + '.tmp', T0=start_frame, trkInfo=info),
+                                  nframes_estimate=conf.get('link_online_estimate_frames', 1000))
+
+    if isinstance(pred_fn, TrackShardPool):
+        # frames are tracked in parallel by the pool's worker processes.
+        trk = pred_fn.track(mov_file, trx_file, trx_ids, start_frame, end_frame, skip_rate, crop_loc)
+        if linker is not None:
+            linker.append(trk)
+    else:
+        trk = track_movie_frames(conf, pred_fn, cap, trx_dict, trx_ids, start_frame, end_frame, skip_rate, crop_loc,
+                                 part_file=part_file, info=info, nskip_partfile=nskip_partfile,
+                                 resume_trk=resume_trk, resume_frame=resume_frame, linker=linker)
 
     # Get the animal confidences for 2 stage tracking
     pred_animal_conf = None
@@ -3806,10 +4159,14 @@ def classify_movie(conf, pred_fn, model_type,
                     if (end_frames[ix] > cur_f) and (first_frames[ix] <= cur_f):
                         pred_animal_conf[ cur_f- min_first_frame,ix,:] = T[ix]['conf'][0,cur_f-first_frames[ix],0:1]
 
-    raw_file = raw_predict_file(predict_trk_file, out_file)
-    cur_out_file = raw_file if do_link(conf) else out_file
-    logging.info(f'Writing trk file {cur_out_file}...')
-    trk = write_trk(cur_out_file, pred_locs, extra_dict, start_frame, info, conf)
+    if linker is not None:
+        logging.info(f'Writing the last linked tracklets to trk file {cur_out_file}...')
+        linker.close()
+        os.replace(cur_out_file + '.tmp', cur_out_file)
+        trk = None
+    else:
+        logging.info(f'Writing trk file {cur_out_file}...')
+        trk = save_trk(cur_out_file, trk, info, conf)
     #Write final trk file but maybe do pure linking if required
 
     logging.info('Cleaning up...')
@@ -3817,7 +4174,6 @@ def classify_movie(conf, pred_fn, model_type,
     if os.path.exists(part_file):
         os.remove(part_file)
     cap.close()
-    tf1.reset_default_graph()
     return trk
 
 def raw_predict_file(predict_trk_file, out_file):
@@ -3901,17 +4257,38 @@ def get_latest_model_files(conf, net_type='mdn', name='deepnet'):
     return files
 
 
-def classify_movie_all(model_type, **kwargs):
-    ''' Classify movie wrapper'''
+def setup_track_stage(conf):
+    ''' Updates conf for tracking with the first stage (detection) of a two stage tracker '''
+    if conf.stage == 'first':
+        conf.n_classes = 2
+        conf.op_affinity_graph = [[0, 1]]
+
+
+def get_track_pred_fn(model_type, conf, model_file=None, name='deepnet'):
+    '''
+    Returns pred_fn, close_fn and model_file for tracking movies. If conf.track_n_shards > 1, pred_fn is a TrackShardPool whose worker processes each load the predictor, otherwise it is the predictor from get_pred_fn.
+    '''
+    if conf.get('track_n_shards', 1) > 1:
+        pool = TrackShardPool(model_type, conf, model_file, name=name)
+        return pool, pool.close, pool.model_file
+    return get_pred_fn(model_type, conf, model_file, name=name)
+
+
+def classify_movie_all(model_type, predictor=None, **kwargs):
+    ''' Classify movie wrapper.
+    If predictor=(pred_fn, model_file) is given (e.g. from TrackSession), it is used to track the movie and is left open. Otherwise a predictor is created for the movie and closed after tracking.
+    '''
     conf = kwargs['conf']
     model_file = kwargs['model_file']
     train_name = kwargs['train_name']
     del kwargs['model_file'], kwargs['conf'], kwargs['train_name']
-    if conf.stage == 'first':
-        conf.n_classes = 2
-        conf.op_affinity_graph = [[0, 1]]
+    setup_track_stage(conf)
 
-    pred_fn, close_fn, model_file = get_pred_fn(model_type, conf, model_file, name=train_name)
+    if predictor is None:
+        pred_fn, close_fn, model_file = get_track_pred_fn(model_type, conf, model_file, name=train_name)
+    else:
+        pred_fn, model_file = predictor
+        close_fn = lambda: None
     # logging.info('Saving hmaps') if kwargs['save_hmaps'] else logging.info('NOT saving hmaps')
     try:
         trk = classify_movie(conf, pred_fn, model_type, model_file=model_file, **kwargs)
@@ -3920,9 +4297,185 @@ def classify_movie_all(model_type, **kwargs):
         logging.exception('Could not track movie')
     finally:
         close_fn()
+        if predictor is None:
+            # a predictor given by the caller is still in use, so its graph is left alone.
+            tf1.reset_default_graph()
     return trk
 
 
+class TrackSession(object):
+    '''
+    Keeps the predictors loaded while tracking many movies in a single invocation. The predictor for a view and stage is created when its first movie is tracked and is reused for the rest of the movies, so the network is built and the model file is read only once. For two stage tracking, the predictors for both the stages stay loaded.
+    Use as a context manager or call close() once all the movies have been tracked.
+    '''
+
+    def __init__(self):
+        self.predictors = collections.OrderedDict()
+
+    def get_predictor(self, lbl_file, view_ndx, view, name, args, first_stage=False, second_stage=False, trk_config_file=None):
+        '''
+        Returns conf, pred_fn and model_file for tracking view with the network and stage specified by args. Arguments are the same as for track_view_mov.
+        '''
+        conf_params = None if args.conf_params is None else tuple(args.conf_params)
+        key = (view, name, args.type, conf_params, args.model_file[view_ndx], args.train_name, first_stage, second_stage, trk_config_file)
+        if key not in self.predictors:
+            conf = create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache, conf_params=args.conf_params, first_stage=first_stage, second_stage=second_stage, config_file=trk_config_file)
+            setup_track_stage(conf)
+            logging.info('Loading the predictor for view {}, network {}'.format(view, args.type))
+            pred_fn, close_fn, model_file = get_track_pred_fn(args.type, conf, args.model_file[view_ndx], name=args.train_name)
+            self.predictors[key] = (conf, pred_fn, close_fn, model_file)
+        conf, pred_fn, _, model_file = self.predictors[key]
+        return conf, pred_fn, model_file
+
+    def close(self):
+        for _, _, close_fn, _ in self.predictors.values():
+            close_fn()
+        if len(self.predictors) > 0:
+            tf1.reset_default_graph()
+        self.predictors.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def track_shard_worker(worker_ndx, model_type, conf, model_file, name, n_threads, task_queue, result_queue):
+    '''
+    Main loop of a TrackShardPool worker process. Loads the predictor and then tracks the frame ranges from task_queue until it gets None. Results and errors are put in result_queue as (job_id, shard_ndx, result, error).
+    '''
+    # same TF setup as in main(). CUDA_VISIBLE_DEVICES was set by the parent when starting the process.
+    tf1.disable_v2_behavior()
+    tf1.logging.set_verbosity(tf1.logging.ERROR)
+    try:
+        gpu_devices = tf.config.list_physical_devices('GPU')
+        tf.config.experimental.set_memory_growth(gpu_devices,True)
+    except:
+        pass
+    if n_threads > 0:
+        torch.set_num_threads(n_threads)
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        except:
+            pass
+
+    try:
+        pred_fn, close_fn, model_file = get_pred_fn(model_type, conf, model_file, name=name)
+    except Exception:
+        result_queue.put((None, worker_ndx, None, traceback.format_exc()))
+        return
+    result_queue.put((None, worker_ndx, model_file, None))
+
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            job_id, shard_ndx, mov_file, trx_file, trx_ids, start_frame, end_frame, skip_rate, crop_loc = task
+            try:
+                cap = movies.Movie(mov_file, use_keyframe_index=conf.get('movie_keyframe_index', False))
+                try:
+                    trx_dict = get_trx_info(trx_file, conf, int(cap.get_n_frames()))
+                    trk = track_movie_frames(conf, pred_fn, cap, trx_dict, trx_ids, start_frame, end_frame, skip_rate, crop_loc)
+                finally:
+                    cap.close()
+                result_queue.put((job_id, shard_ndx, trk, None))
+            except Exception:
+                result_queue.put((job_id, shard_ndx, None, traceback.format_exc()))
+    finally:
+        close_fn()
+
+
+class TrackShardPool(object):
+    '''
+    Tracks movies in parallel in conf.track_n_shards worker processes. Each worker loads its own copy of the predictor and uses a GPU from conf.track_shard_gpus (assigned round robin) or, if no GPUs are given, only the CPU with conf.track_shard_threads threads.
+    The frames of a movie are split into contiguous shards, one per worker, and the partial trks from the workers are merged into one trk for the whole frame range. Since each frame is predicted independently, the merged trk is the same as the one from tracking in a single process.
+    The workers stay alive till close() is called, so the predictors are loaded only once when tracking many movies.
+    '''
+
+    def __init__(self, model_type, conf, model_file=None, name='deepnet'):
+        n_shards = conf.track_n_shards
+        gpus = [str(g) for g in conf.get('track_shard_gpus', [])]
+        n_threads = conf.get('track_shard_threads', 0)
+        if len(gpus) == 0 and n_threads < 1:
+            n_threads = max(1, multiprocessing.cpu_count() // n_shards)
+
+        # spawn so that the workers don't inherit CUDA/TF state from this process
+        ctx = multiprocessing.get_context('spawn')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.workers = []
+        self.job_id = 0
+        cuda_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+        logging.info('Starting {} tracking processes on {}'.format(n_shards, 'GPUs ' + ','.join(gpus) if len(gpus) > 0 else 'CPU'))
+        try:
+            for ndx in range(n_shards):
+                # the spawned process gets the environment at the time it is started
+                os.environ['CUDA_VISIBLE_DEVICES'] = gpus[ndx % len(gpus)] if len(gpus) > 0 else ''
+                p = ctx.Process(target=track_shard_worker, args=(ndx, model_type, conf, model_file, name, n_threads, self.task_queue, self.result_queue), daemon=True)
+                p.start()
+                self.workers.append(p)
+        finally:
+            if cuda_devices is None:
+                os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+            else:
+                os.environ['CUDA_VISIBLE_DEVICES'] = cuda_devices
+
+        try:
+            model_files = self.get_results(None, n_shards)
+        except:
+            self.close()
+            raise
+        self.model_file = model_files[0]
+
+    def get_results(self, job_id, n_results):
+        results = {}
+        while len(results) < n_results:
+            try:
+                cur_id, ndx, res, err = self.result_queue.get(timeout=10)
+            except queue.Empty:
+                if not all([p.is_alive() for p in self.workers]):
+                    raise RuntimeError('Tracking worker process exited unexpectedly')
+                continue
+            if cur_id != job_id:
+                # left over from an earlier job that failed
+                continue
+            if err is not None:
+                raise RuntimeError('Tracking worker process failed:\n' + err)
+            results[ndx] = res
+        return results
+
+    def track(self, mov_file, trx_file, trx_ids, start_frame, end_frame, skip_rate=1, crop_loc=None):
+        '''
+        Tracks the frames of mov_file in the same way as track_movie_frames, with the frames split between the workers, and returns the merged unlinked dense Trk.
+        '''
+        n_shards = len(self.workers)
+        n_track = len(range(start_frame, end_frame, skip_rate))
+        # shard boundaries are on tracked frames so that the shards together track the same frames as a single process.
+        bounds = [min(end_frame, start_frame + skip_rate * int(math.ceil(n_track * ndx / n_shards))) for ndx in range(n_shards)] + [end_frame]
+        shards = [(bounds[ndx], bounds[ndx + 1]) for ndx in range(n_shards) if bounds[ndx] < bounds[ndx + 1]]
+        if len(shards) == 0:
+            shards = [(start_frame, end_frame)]
+
+        self.job_id += 1
+        for ndx, (s_frame, e_frame) in enumerate(shards):
+            self.task_queue.put((self.job_id, ndx, mov_file, trx_file, trx_ids, s_frame, e_frame, skip_rate, crop_loc))
+        logging.info('Tracking frames {} to {} in {} shards...'.format(start_frame, end_frame, len(shards)))
+        trks = self.get_results(self.job_id, len(shards))
+        return TrkFile.merge_trks([trks[ndx] for ndx in range(len(shards))])
+
+    def close(self):
+        for p in self.workers:
+            if p.is_alive():
+                self.task_queue.put(None)
+        for p in self.workers:
+            p.join(timeout=60)
+            if p.is_alive():
+                p.terminate()
+        self.workers = []
+
+
 def gen_train_samples(conf, model_type='mdn_joint_fpn', nsamples=10, train_name='deepnet', out_file=None,
                       distort=True,debug=KBDEBUG):
     # Pytorch dataloaders can be fickle. Also they might not release GPU memory. Launching this in a separate process seems like a better idea
@@ -4452,6 +5005,7 @@ def parse_args(argv):
     parser_classify.add_argument('-list_file', dest='list_file', help='JSON file with list of movies, targets and frames to track', default=None)
     parser_classify.add_argument('-use_cache', dest='use_cache', action='store_true', help='Use cached images in the label file to generate the database for list file.')
     parser_classify.add_argument('-config_file', dest='trk_config_file', help='JSON file with parameters related to tracking.', default=None)
+    parser_classify.add_argument('-resume', dest='resume', action='store_true', help='Resume tracking from the partial trk file (out file + .part) of an earlier run that was interrupted. Frames that were already tracked are not tracked again. Not supported when tracking in shards.')
 
     parser_gt = subparsers.add_parser('gt_classify', help='Classify GT labeled frames')
     parser_gt.add_argument('-out', dest='out_files', help='Mat file (full path with .mat extension) where GT output will be saved', nargs='+', required=True)
@@ -4528,7 +5082,10 @@ def get_valfilename(conf, nettype):
         raise ValueError('Unrecognized net type')
     return val_filename
 
-def track_multi_stage(args, view_ndx, view, mov_ndx, conf_raw=None):
+def track_multi_stage(args, view_ndx, view, mov_ndx, conf_raw=None, session=None):
+    '''
+    Tracks movie mov_ndx of view with all the stages. If session (TrackSession) is given, the predictors are reused from it.
+    '''
     name = args.name
     if conf_raw is None:
         lbl_file = load_config_file(args.lbl_file)
@@ -4546,12 +5103,12 @@ def track_multi_stage(args, view_ndx, view, mov_ndx, conf_raw=None):
         name2 = args.name2 if args.name2 else name
 
         args.out_files = args.trx
-        trk1 = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file, first_stage=True)
+        trk1 = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file, first_stage=True, session=session)
         args.out_files = out_files
         args.type = args.type2
         args.conf_params = args.conf_params2
         args.model_file = args.model_file2
-        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name2, args, trk_config_file=trk_config_file, second_stage=True)
+        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name2, args, trk_config_file=trk_config_file, second_stage=True, session=session)
 
         # reset back to normal for linking
         args.type = type1
@@ -4562,20 +5119,26 @@ def track_multi_stage(args, view_ndx, view, mov_ndx, conf_raw=None):
         args.model_file2 = model_file2
 
     elif args.stage == 'first':
-        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file, first_stage=True)
+        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file, first_stage=True, session=session)
     elif args.stage == 'second':
-        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file, second_stage=True)
+        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file, second_stage=True, session=session)
     else:
-        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file)
+        trk = track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, trk_config_file=trk_config_file, session=session)
     return trk
 
 
-def track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, first_stage=False, second_stage=False, trk_config_file=None):
+def track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, first_stage=False, second_stage=False, trk_config_file=None, session=None):
 
-    conf = create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache, conf_params=args.conf_params,first_stage=first_stage,second_stage=second_stage,config_file=trk_config_file)
+    if session is not None and not args.track_type == 'only_link':
+        conf, pred_fn, model_file = session.get_predictor(lbl_file, view_ndx, view, name, args, first_stage=first_stage, second_stage=second_stage, trk_config_file=trk_config_file)
+        predictor = (pred_fn, model_file)
+    else:
+        conf = create_conf(lbl_file, view, name, net_type=args.type, cache_dir=args.cache, conf_params=args.conf_params,first_stage=first_stage,second_stage=second_stage,config_file=trk_config_file)
+        predictor = None
 
     if not args.track_type == 'only_link':
         trk = classify_movie_all(args.type,
+                           predictor=predictor,
                            conf=conf,
                            mov_file=args.mov[view_ndx][mov_ndx],
                            trx_file=args.trx[view_ndx][mov_ndx],
@@ -4588,7 +5151,8 @@ def track_view_mov(lbl_file, view_ndx, view, mov_ndx, name, args, first_stage=Fa
                            crop_loc=args.crop_loc[view_ndx][mov_ndx],
                            model_file=args.model_file[view_ndx],
                            train_name=args.train_name,
-                           predict_trk_file=args.predict_trk_files[view_ndx][mov_ndx]
+                           predict_trk_file=args.predict_trk_files[view_ndx][mov_ndx],
+                           resume=args.resume
                            )
     else:
         trk = None
@@ -4847,8 +5411,10 @@ def run(args):
         nmov = len(args.mov[0])
 
         for view_ndx, view in enumerate(views):
-            for mov_ndx in range(nmov):
-                track_multi_stage(args,view_ndx=view_ndx,view=view,mov_ndx=mov_ndx,conf_raw=conf_raw)
+            # load the predictors once for all the movies of the view, and free them before linking.
+            with TrackSession() as session:
+                for mov_ndx in range(nmov):
+                    track_multi_stage(args,view_ndx=view_ndx,view=view,mov_ndx=mov_ndx,conf_raw=conf_raw,session=session)
 
 
             if not args.track_type == 'only_predict':
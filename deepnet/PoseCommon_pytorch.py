@@ -10,12 +10,6 @@ import PoseTools
 import tfdatagen
 import time
 import tensorflow.compat.v1 as tf
-ISTFR = False
-try:
-    from tfrecord.torch.dataset import TFRecordDataset
-    ISTFR = True
-except:
-    print('TFRecordDataset not available')
 import errno
 import re
 import gc
@@ -77,7 +71,8 @@ def decode_augment(features, conf, distort):
     features['info'] = np.array([features['expndx'][0],features['ts'][0],features['trx_ndx'][0]])
 
 
-    ret = PoseTools.preprocess_ims(ims, locs, conf, distort, conf.rescale,mask=features['mask'][None,...,0])
+    mask = features['mask'][None,...,0] if features['mask'] is not None else None
+    ret = PoseTools.preprocess_ims(ims, locs, conf, distort, conf.rescale,mask=mask)
     ims,locs = ret[:2]
     if features['mask'] is not None:
         features['mask'] = ret[2][0]
@@ -95,6 +90,49 @@ def decode_augment(features, conf, distort):
 def dataloader_worker_init_fn(id,epoch=0):
     np.random.seed(id + 100*epoch)
 
+def parse_tfrecord_example(record):
+    '''
+    Parses a serialized tf.train.Example into a dict of numpy arrays. bytes features are returned as uint8 arrays, like tfrecord.torch.dataset.TFRecordDataset does, so that the result can be passed to decode_augment.
+    '''
+    example = tf.train.Example.FromString(record)
+    features = {}
+    for k, f in example.features.feature.items():
+        kind = f.WhichOneof('kind')
+        if kind == 'bytes_list':
+            features[k] = np.frombuffer(f.bytes_list.value[0], dtype=np.uint8)
+        elif kind == 'float_list':
+            features[k] = np.array(f.float_list.value, dtype=np.float32)
+        elif kind == 'int64_list':
+            features[k] = np.array(f.int64_list.value, dtype=np.int64)
+    return features
+
+class tfrecord_loader(torch.utils.data.Dataset):
+    '''
+    Map style dataset for tfrecord dbs that reads records by index using the offset index of the tfrecord file (PoseTools.TFRecordIndexedReader). Each DataLoader worker opens its own file handle, so the decoding and augmentation can run in multiple workers, and the sampler shuffles the examples.
+    '''
+
+    def __init__(self, conf, tfr_file, augment):
+        self.reader = PoseTools.TFRecordIndexedReader(tfr_file)
+        self.conf = conf
+        self.augment = augment
+        self.len = max(conf.batch_size,len(self.reader))
+        self.ex_wts = torch.ones(self.len)
+
+    def __len__(self):
+        return self.len
+
+    def __getitem__(self, item):
+        if self.conf.batch_size > len(self.reader):
+            item = np.random.randint(len(self.reader))
+        features = parse_tfrecord_example(self.reader[item])
+        features = decode_augment(features, self.conf, self.augment)
+        features['item'] = item
+        return features
+
+    def update_wts(self,idx,loss):
+        for ix,l in zip(idx,loss):
+            self.ex_wts[ix] = l
+
 class coco_loader(torch.utils.data.Dataset):
 
     def __init__(self, conf, ann_file, augment):
@@ -352,41 +390,22 @@ class PoseCommon_pytorch(object):
             assert  False, 'Unknown data format type'
 
 
-    def create_tf_data_gen(self, debug=False,**kwargs):
-        assert ISTFR, 'TFRecordDataset unavailable'
+    def create_tf_data_gen(self, debug=False, pin_mem=True,**kwargs):
         conf = self.conf
-        train_tfn = lambda f: decode_augment(f,conf,True)
-        val_tfn = lambda f: decode_augment(f,conf,False)
         trntfr = os.path.join(conf.cachedir, conf.trainfilename) + '.tfrecords'
         valtfr = trntfr
-        xx = tf.python_io.tf_record_iterator(trntfr)
-        len_db = sum([1 for x in xx])
-        queue_sz = min(len_db,300)
         # valtfr = os.path.join(conf.cachedir, conf.valfilename) + '.tfrecords'
         if not os.path.exists(valtfr):
             logging.info('Validation data set doesnt exist. Using train data set for validation')
             valtfr = trntfr
-        train_dl_tf = TFRecordDataset(trntfr,None,None,transform=train_tfn,shuffle_queue_size=queue_sz)
-        val_dl_tf = TFRecordDataset(valtfr,None,None,transform=val_tfn)
+        train_dl_tf = tfrecord_loader(conf,trntfr,True)
+        val_dl_tf = tfrecord_loader(conf,valtfr,False)
         self.train_loader_raw = train_dl_tf
         self.val_loader_raw = val_dl_tf
         num_workers = 0 if debug else 16
-        args = {
-            'batch_size': self.conf.batch_size,
-            'pin_memory': True,
-            'drop_last': True,
-        }
-
-        if num_workers > 0:
-            #try:
-            #    self.train_dl = torch.utils.data.DataLoader(train_dl_tf, **args,num_workers=num_workers,worker_init_fn=lambda id: np.random.seed(id))
-            #except:
-            logging.warning(f'Could not create torch DataLoader with num_workers = {num_workers}, trying with 0')
-            self.train_dl = torch.utils.data.DataLoader(train_dl_tf, **args, num_workers=0)
-        else:
-            self.train_dl = torch.utils.data.DataLoader(train_dl_tf, **args, num_workers=0)
 
-        self.val_dl = torch.utils.data.DataLoader(val_dl_tf, **args)
+        self.train_dl = torch.utils.data.DataLoader(train_dl_tf, batch_size=self.conf.batch_size,pin_memory=pin_mem,drop_last=True,num_workers=num_workers,shuffle=True,worker_init_fn=dataloader_worker_init_fn)
+        self.val_dl = torch.utils.data.DataLoader(val_dl_tf, batch_size=self.conf.batch_size,pin_memory=pin_mem,drop_last=True)
 
         self.train_iter = iter(self.train_dl)
         self.val_iter = iter(self.val_dl)
@@ -435,7 +454,7 @@ class PoseCommon_pytorch(object):
                     shuffle = False
                 else:
                     train_sampler = None
-                    shuffle = True if self.conf.db_format == 'coco' else False
+                    shuffle = True
 
                 self.train_dl = torch.utils.data.DataLoader(self.train_loader_raw, batch_size=self.conf.batch_size, pin_memory=True,drop_last=True, num_workers=16,sampler=train_sampler,shuffle=shuffle,worker_init_fn=partial(dataloader_worker_init_fn,epoch=self.train_epoch))
                 self.train_iter = iter(self.train_dl)
@@ -448,7 +467,7 @@ class PoseCommon_pytorch(object):
 
     def create_targets(self, inputs):
         locs = inputs['locs']
-        return PoseTools.create_label_images(locs,self.conf.imsz,1,self.conf.label_blur_rad)
+        return PoseTools.create_label_images(locs,self.conf.imsz,1,self.conf.label_blur_rad,subpixel=self.conf.get('label_subpixel',False),gaussian=self.conf.get('label_gaussian',False))
 
 
     def create_optimizer(self, model, base_lr):
@@ -39,6 +39,7 @@ import datetime
 from scipy.ndimage.interpolation import zoom
 from scipy import stats
 import pickle
+import struct
 import yaml
 import logging
 import time
@@ -114,7 +115,7 @@ def unscale_points(locs_lores, scalex, scaley):
     locs_hires[..., 1] = float(scaley) * (locs_hires[..., 1] + 0.5) - 0.5
     return locs_hires
 
-def scale_images(img, locs, scale, conf, mask=None, **kwargs):
+def scale_images(img, locs, scale, conf, mask=None, out_dtype='float', **kwargs):
     sz = img.shape
     szy_ds = int(sz[1]//scale)
     szx_ds = int(sz[2]//scale)
@@ -125,9 +126,15 @@ def scale_images(img, locs, scale, conf, mask=None, **kwargs):
     high_valid = locs > -10000  # ridiculosly low values are used for multi animal
     valid = nan_valid & high_valid
 
-    simg = np.zeros((sz[0], szy_ds, szx_ds, sz[3]))
-    smask = np.zeros((sz[0],szy_ds,szx_ds)) if mask is not None else None
-    for ndx in range(sz[0]):
+    # resizing to the same size doesn't change the images
+    same_size = (szy_ds, szx_ds) == tuple(sz[1:3])
+    if same_size:
+        simg = img.astype(out_dtype)
+        smask = mask.astype('float') if mask is not None else None
+    else:
+        simg = np.zeros((sz[0], szy_ds, szx_ds, sz[3]), dtype=out_dtype)
+        smask = np.zeros((sz[0],szy_ds,szx_ds)) if mask is not None else None
+    for ndx in range(0 if same_size else sz[0]):
         # using skimage transform which is really really slow
         # use anti_aliasing?
         # if sz[3] == 1:
@@ -524,8 +531,64 @@ def randomly_scale(img,locs,conf,group_sz=1):
     return img, locs
 
 
-def randomly_affine(img,locs, conf, group_sz=1, mask= None, interp_method=cv2.INTER_LINEAR):
+def random_affine_mat(orig_locs, valid, conf, rows, cols, srange):
+    '''
+    Draws a random rotation, scaling and translation for a group of images and returns the 2x3 affine matrix and the transformed locs. If conf.check_bounds_distort, the parameters are redrawn until all the valid locs stay inside the image, and after 5 tries the identity is used.
+    '''
+    sane = False
+    do_transform = True
+    count = 0
+    while not sane:
+        if np.random.rand() < conf.rot_prob:
+            rangle = (np.random.rand() * 2 - 1) * conf.rrange
+        else:
+            rangle = 0
 
+        if conf.use_scale_factor_range:
+            # KB 20191218: first choose the scale factor
+            # then decide whether to make it smaller or larger
+            sfactor = 1.+np.random.rand()*np.abs(srange-1.)
+            if np.random.rand() < 0.5:
+                sfactor = 1.0/sfactor
+        else:
+            sfactor = (np.random.rand()-0.5)*srange + 1
+
+        # sfactor = (np.random.rand() - 0.5) * conf.scale_range + 1
+        # clip scaling to 0.05
+        if sfactor < 0.05:
+            sfactor = 0.05
+        dx = (np.random.rand()*2 -1)*float(conf.trange)/conf.rescale
+        dy = (np.random.rand()*2 -1)*float(conf.trange)/conf.rescale
+
+        count += 1
+        if count > 5:
+            rangle = 0; dx = 0; dy=0; sfactor = 1
+            sane = True
+            do_transform = False
+        # print(f'Aug params rot:{rangle},scale:{sfactor},dx:{dx},dy:{dy}')
+        rot_mat = cv2.getRotationMatrix2D((cols/2,rows/2), rangle, sfactor)
+        rot_mat[0,2] += dx
+        rot_mat[1,2] += dy
+        lr = np.matmul(orig_locs,rot_mat[:,:2].T)
+        lr[...,0] += rot_mat[0,2]
+        lr[...,1] += rot_mat[1,2]
+
+        if np.all(lr[valid, 0] > 0) \
+                and np.all(lr[valid, 1] >0) \
+                and np.all(lr[valid, 0] <= cols) \
+                and np.all(lr[valid, 1] <= rows):
+            sane = True
+        elif not conf.check_bounds_distort:
+            sane = True
+        elif do_transform:
+            continue
+    return rot_mat, lr
+
+
+def affine_srange(conf):
+    '''
+    Returns the scale range used by randomly_affine and whether random scaling is off.
+    '''
     # KB 20191218 - replaced scale_range with scale_factor_range
     if conf.use_scale_factor_range:
         srange = conf.scale_factor_range
@@ -534,7 +597,12 @@ def randomly_affine(img,locs, conf, group_sz=1, mask= None, interp_method=cv2.IN
     no_rescale = (conf.use_scale_factor_range and \
                   (srange > 1.0/1.01) and (srange < 1.01)) or \
                   ((not conf.use_scale_factor_range) and srange < .01)
+    return srange, no_rescale
+
 
+def randomly_affine(img,locs, conf, group_sz=1, mask= None, interp_method=cv2.INTER_LINEAR):
+
+    srange, no_rescale = affine_srange(conf)
     if conf.rrange < 1 and conf.trange< 1 and no_rescale:
         return img, locs, mask
 
@@ -562,71 +630,22 @@ def randomly_affine(img,locs, conf, group_sz=1, mask= None, interp_method=cv2.IN
         orig_locs = locs[st:en, ...]
         orig_im = img[st:en, ...].copy()
         orig_mask = mask[st:en,...].copy() if mask is not None else None
-        sane = False
-        do_transform = True
-
-        count = 0
-        lr = orig_locs.copy()
         out_ii = orig_im.copy()
         out_mask = orig_mask.copy() if mask is not None else None
 
         nan_valid = np.invert(np.isnan(orig_locs[:, :, :, 0]))
         high_valid = orig_locs[..., 0] > -1000  # ridiculosly low values are used for multi animal
         valid = nan_valid & high_valid
-        while not sane:
-            if np.random.rand() < conf.rot_prob:
-                rangle = (np.random.rand() * 2 - 1) * conf.rrange
-            else:
-                rangle = 0
-
-            if conf.use_scale_factor_range:
-                # KB 20191218: first choose the scale factor
-                # then decide whether to make it smaller or larger
-                sfactor = 1.+np.random.rand()*np.abs(srange-1.)
-                if np.random.rand() < 0.5:
-                    sfactor = 1.0/sfactor
-            else:
-                sfactor = (np.random.rand()-0.5)*srange + 1
-
-            # sfactor = (np.random.rand() - 0.5) * conf.scale_range + 1
-            # clip scaling to 0.05
-            if sfactor < 0.05:
-                sfactor = 0.05
-            dx = (np.random.rand()*2 -1)*float(conf.trange)/conf.rescale
-            dy = (np.random.rand()*2 -1)*float(conf.trange)/conf.rescale
-
-            count += 1
-            if count > 5:
-                rangle = 0; dx = 0; dy=0; sfactor = 1
-                sane = True
-                do_transform = False
-            # print(f'Aug params rot:{rangle},scale:{sfactor},dx:{dx},dy:{dy}')
-            rot_mat = cv2.getRotationMatrix2D((cols/2,rows/2), rangle, sfactor)
-            rot_mat[0,2] += dx
-            rot_mat[1,2] += dy
-            lr = np.matmul(orig_locs,rot_mat[:,:2].T)
-            lr[...,0] += rot_mat[0,2]
-            lr[...,1] += rot_mat[1,2]
-
-            if np.all(lr[valid, 0] > 0) \
-                    and np.all(lr[valid, 1] >0) \
-                    and np.all(lr[valid, 0] <= cols) \
-                    and np.all(lr[valid, 1] <= rows):
-                sane = True
-            elif not conf.check_bounds_distort:
-                sane = True
-            elif do_transform:
-                continue
-
-            for g in range(group_sz):
-                ii = copy.deepcopy(orig_im[g,...])
-                ii = cv2.warpAffine(ii, rot_mat, (int(cols), int(rows)),flags=interp_method)
-                # Do not use inter_cubic. Leads to splotches.
-                if ii.ndim == 2:
-                    ii = ii[..., np.newaxis]
-                out_ii[g,...] = ii
-                if mask is not None:
-                    out_mask[g,...] = cv2.warpAffine(orig_mask[g,...],rot_mat,(int(cols),int(rows)),flags=cv2.INTER_NEAREST)
+        rot_mat, lr = random_affine_mat(orig_locs, valid, conf, rows, cols, srange)
+        for g in range(group_sz):
+            ii = copy.deepcopy(orig_im[g,...])
+            ii = cv2.warpAffine(ii, rot_mat, (int(cols), int(rows)),flags=interp_method)
+            # Do not use inter_cubic. Leads to splotches.
+            if ii.ndim == 2:
+                ii = ii[..., np.newaxis]
+            out_ii[g,...] = ii
+            if mask is not None:
+                out_mask[g,...] = cv2.warpAffine(orig_mask[g,...],rot_mat,(int(cols),int(rows)),flags=cv2.INTER_NEAREST)
 
         lr[~high_valid,0] = -100000
         lr[~high_valid,1] = -100000
@@ -674,9 +693,101 @@ def create_label_images_slow(locs, im_sz, scale, blur_rad):
     return  out
 
 
-def create_label_images(locs, im_sz, scale, blur_rad,occluded=None):
+def label_window(c, sz, blur_l, blur_rad=None):
+    '''
+    Rows/cols and 1d weights of the label windows for points at output coords c
+    along an axis of size sz. blur_l is the 1d template that is pasted at the
+    rounded locations. If blur_rad is given, gaussians centered on the exact
+    locations are used instead, within the same window.
+    :return: npts x len(blur_l) indices clipped to the axis, and the weights,
+    which are 0 outside the axis.
+    '''
+    k_size = len(blur_l) // 2
+    ndx = np.round(c).astype('int')[:, np.newaxis] + np.arange(-k_size, k_size + 1)
+    if blur_rad is None:
+        wts = np.tile(blur_l, [len(c), 1])
+    else:
+        wts = np.exp(-(ndx - c[:, np.newaxis])**2 / (2 * blur_rad**2))
+    outside = (ndx < 0) | (ndx >= sz)
+    wts[outside] = 0.
+    ndx[outside] = 0
+    return ndx, wts
+
+
+def create_label_images(locs, im_sz, scale, blur_rad,occluded=None,subpixel=False,gaussian=False):
     '''
 
+    :param locs: original, hi-res locs
+    :param im_sz: original, hi-res imsz
+    :param scale: downsample fac
+    :param blur_rad: gaussian/blur radius in output coord sys
+    :param subpixel: paste gaussians centered on the exact locs in the output
+    coord sys instead of the template
+    :param gaussian: use a gaussian template. By default the template is
+    normalized with old_div (floordiv), which leaves a single-pixel spike at the
+    center, as the targets have always been.
+    :return: [bsize x sz0_ds x sz1_ds x npts]
+
+    The template is separable, so the windows for all the points in the batch
+    are built as outer products of their row and column weights and accumulated
+    with a single np.add.at. Without subpixel, this gives the same output as
+    create_label_images_loop, which pastes a pixel-centered template in the
+    output/downsampled coord sys.
+
+    '''
+    locs = np.asarray(locs, dtype='float')
+    if locs.ndim == 3:
+        locs = locs[:,np.newaxis,...]
+    n_ex, maxn, n_classes = locs.shape[:3]
+    sz0 = int(im_sz[0] // scale)
+    sz1 = int(im_sz[1] // scale)
+
+    # These may differ slightly from scale if im_sz is not evenly divisible by
+    # scale.
+    scaley_actual = im_sz[0]/sz0
+    scalex_actual = im_sz[1]/sz1
+
+    k_size = max(int(round(3 * blur_rad)),1)
+    blur_l = np.zeros([2 * k_size + 1, 2 * k_size + 1])
+    blur_l[k_size, k_size] = 1
+    blur_l = cv2.GaussianBlur(blur_l, (2 * k_size + 1, 2 * k_size + 1), blur_rad)
+    if gaussian:
+        blur_l = blur_l / blur_l.max()
+    else:
+        blur_l = old_div(blur_l, blur_l.max())
+    # the 2d template is the outer product of its central row with itself.
+    # Only the columns where the template is nonzero need to be pasted.
+    blur_l = blur_l[k_size]
+    if not subpixel:
+        nz = np.nonzero(blur_l)[0]
+        k_nz = k_size - nz[0]
+        blur_l = blur_l[k_size - k_nz:k_size + k_nz + 1]
+
+    with np.errstate(invalid='ignore'):
+        yy = (locs[..., 1] - float(scaley_actual - 1) / 2) / scaley_actual
+        xx = (locs[..., 0] - float(scalex_actual - 1) / 2) / scalex_actual
+        # skip missing points and points whose window is outside the label image
+        valid = (locs[..., 0] >= -1000) & (locs[..., 1] >= -1000) & \
+                (yy > -k_size - 1) & (yy < sz0 + k_size) & (xx > -k_size - 1) & (xx < sz1 + k_size)
+    ex_ndx, _, cls_ndx = np.nonzero(valid)
+    sub_rad = blur_rad if subpixel else None
+    rows, wts_y = label_window(yy[valid], sz0, blur_l, sub_rad)
+    cols, wts_x = label_window(xx[valid], sz1, blur_l, sub_rad)
+
+    ndx = ((ex_ndx[:, np.newaxis, np.newaxis] * sz0 + rows[:, :, np.newaxis]) * sz1 +
+           cols[:, np.newaxis, :]) * n_classes + cls_ndx[:, np.newaxis, np.newaxis]
+    wts = wts_y[:, :, np.newaxis] * wts_x[:, np.newaxis, :]
+
+    # label_ims = 2.0 * (label_ims - 0.5)
+    label_ims = np.full([n_ex, sz0, sz1, n_classes], -1.)
+    np.add.at(label_ims.reshape(-1), ndx.ravel(), 2. * wts.ravel())
+    return label_ims
+
+
+def create_label_images_loop(locs, im_sz, scale, blur_rad,occluded=None):
+    '''
+    Reference per-point implementation of create_label_images.
+
     :param locs: original, hi-res locs
     :param im_sz: original, hi-res imsz
     :param scale: downsample fac
@@ -1109,10 +1220,107 @@ def compute_vals(op,n_steps):
     return all
 
 def count_records(filename):
-    num = 0
-    for record in tf.python_io.tf_record_iterator(filename):
-        num += 1
-    return num
+    return len(load_tfrecord_index(filename))
+
+
+def tfrecord_index_file(filename):
+    return filename + '.idx'
+
+
+def create_tfrecord_index(filename, index_file=None):
+    '''
+    Writes the offset index for a tfrecord file. Each line of the index has the byte offset and the size of a record, which is the format used by tfrecord.tools.tfrecord2idx. Only the record headers are read, the data is skipped.
+    Returns the index as n_records x 2 array.
+    '''
+    index = []
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            # record is 8 byte length, 4 byte length crc, data and 4 byte data crc
+            rec_size = 16 + struct.unpack('<Q', header)[0]
+            if offset + rec_size > file_size:
+                logging.warning('Truncated record at offset {} in {}'.format(offset, filename))
+                break
+            index.append([offset, rec_size])
+            offset += rec_size
+    index = np.array(index, dtype=np.int64).reshape([-1, 2])
+
+    if index_file is None:
+        index_file = tfrecord_index_file(filename)
+    try:
+        tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+        np.savetxt(tmp_file, index, fmt='%d')
+        os.replace(tmp_file, index_file)
+    except IOError:
+        logging.warning('Could not write the tfrecord index {}'.format(index_file))
+    return index
+
+
+def load_tfrecord_index(filename):
+    '''
+    Loads the offset index of a tfrecord file. The index is created if it doesn't exist or is older than the tfrecord file.
+    '''
+    index_file = tfrecord_index_file(filename)
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(filename):
+        return np.loadtxt(index_file, dtype=np.int64, ndmin=2).reshape([-1, 2])
+    return create_tfrecord_index(filename)
+
+
+class TFRecordIndexedReader(object):
+    '''
+    Random access to the records of a tfrecord file using its offset index.
+
+    reader = TFRecordIndexedReader(filename)
+    for ndx in reader.epoch_order(epoch, shuffle=True, shard=(worker_id, n_workers)):
+        record = reader[ndx]
+
+    The file is opened on first access in each process, so readers can be passed to DataLoader workers. Forked workers don't share the parent's file handle (and its offset).
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = load_tfrecord_index(filename)
+        self.fid = None
+        self.pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, ndx):
+        if self.fid is None or self.pid != os.getpid():
+            self.fid = open(self.filename, 'rb')
+            self.pid = os.getpid()
+        offset, rec_size = self.index[ndx]
+        self.fid.seek(offset + 12)
+        return self.fid.read(rec_size - 16)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['fid'] = None
+        return state
+
+    def close(self):
+        if self.fid is not None:
+            self.fid.close()
+            self.fid = None
+
+    def epoch_order(self, epoch, shuffle=True, seed=0, shard=None):
+        '''
+        Order of the records for an epoch. With shuffle, the order is a uniform random permutation that depends on the epoch and seed, so all workers get the same permutation. With shard=(shard_ndx, n_shards), only every n_shards-th record of the order starting at shard_ndx is returned.
+        '''
+        if shuffle:
+            order = np.random.RandomState([seed, epoch]).permutation(len(self))
+        else:
+            order = np.arange(len(self))
+        if shard is not None:
+            order = order[shard[0]::shard[1]]
+        return order
+
 
 def show_stack(im_s,xx,yy,cmap='gray'):
     import matplotlib.pyplot as plt
@@ -1413,6 +1621,16 @@ def crop_to_size(img, sz):
 
 def preprocess_ims(ims, in_locs, conf, distort, scale, group_sz = 1,mask=None,occ=None,interp_method=cv2.INTER_LINEAR):
     '''
+    Preprocesses and augments the images. Uses preprocess_ims_fused if conf.fused_preprocess is True.
+    '''
+    if conf.get('fused_preprocess', False):
+        return preprocess_ims_fused(ims, in_locs, conf, distort, scale, group_sz=group_sz, mask=mask, occ=occ, interp_method=interp_method)
+    else:
+        return preprocess_ims_sequential(ims, in_locs, conf, distort, scale, group_sz=group_sz, mask=mask, occ=occ, interp_method=interp_method)
+
+
+def preprocess_ims_sequential(ims, in_locs, conf, distort, scale, group_sz = 1,mask=None,occ=None,interp_method=cv2.INTER_LINEAR):
+    '''
 
     :param ims: Input image. It is converted to uint8 before applying the transformations. Size: B x H x W x C
     :param in_locs: 2D Location as B x N x 2
@@ -1428,8 +1646,8 @@ def preprocess_ims(ims, in_locs, conf, distort, scale, group_sz = 1,mask=None,oc
     '''
 #    assert ims.dtype == 'uint8', 'Preprocessing only work on uint8 images'
     locs = in_locs.copy()
-    cur_im = ims.copy()
-    cur_im = cur_im.astype('uint8')
+    # astype makes a copy, so ims is not modified
+    cur_im = ims.astype('uint8')
     xs = adjust_contrast(cur_im, conf)
     start = time.time()
     xs, locs, mask = scale_images(xs, locs, scale, conf, mask=mask)
@@ -1455,6 +1673,131 @@ def preprocess_ims(ims, in_locs, conf, distort, scale, group_sz = 1,mask=None,oc
     return ret
 
 
+def flip_locs(locs, occ, conf, flipped, axis, sz):
+    '''
+    Flips the locs (B x maxn x npts x 2) and occ (B x maxn x npts) of the examples where flipped is True along axis (0 for x, 1 for y) in an image of size sz, swapping the landmarks in conf.flipLandmarkMatches. Same as the locs part of randomly_flip_lr/ud.
+    '''
+    locs = locs.copy()
+    pairs = conf.flipLandmarkMatches
+    match = [int(pairs['{}'.format(ll)]) if '{}'.format(ll) in pairs.keys() else ll for ll in range(locs.shape[2])]
+    orig = locs[flipped][:, :, match]
+    flip_val = np.where(orig[..., axis] < -1000, -100000, sz - 1 - orig[..., axis])
+    orig[..., axis] = flip_val
+    locs[flipped] = orig
+    if occ is not None:
+        occ = occ.copy()
+        occ[flipped] = occ[flipped][:, :, match]
+    return locs, occ
+
+
+def preprocess_ims_fused(ims, in_locs, conf, distort, scale, group_sz = 1,mask=None,occ=None,interp_method=cv2.INTER_LINEAR):
+    '''
+    Same as preprocess_ims_sequential, but the flips, rotation, scaling and translation are composed into one affine transform per image, which is applied with a single warp on the uint8 images. Brightness, contrast and mean normalization are applied to the whole batch at once in float32.
+    The random parameters are drawn in the same order as in preprocess_ims_sequential, including the retries for check_bounds_distort, so the same seed gives the same augmentation. The images differ slightly because the warps are done on uint8 images and interpolated only once.
+    Returns float32 images.
+    '''
+    locs = in_locs.copy()
+    # astype makes a copy, so ims is not modified
+    xs = ims.astype('uint8')
+    if conf.adjust_contrast:
+        xs = adjust_contrast(xs, conf).astype('uint8')
+    xs, locs, mask = scale_images(xs, locs, scale, conf, mask=mask, out_dtype='uint8')
+    n_im = xs.shape[0]
+    rows, cols = xs.shape[1:3]
+    n_groups = n_im//group_sz
+
+    if distort:
+        if locs.ndim == 3: # hack for multi animal
+            reduce_dim = True
+            locs = locs[:,np.newaxis,...]
+            occ = occ[:,np.newaxis] if occ is not None else None
+        else:
+            reduce_dim = False
+
+        # transforms from input to output image coordinates
+        mats = np.tile(np.eye(3), [n_im, 1, 1])
+        for axis, do_flip in ((0, conf.horz_flip), (1, conf.vert_flip)):
+            if not do_flip:
+                continue
+            flipped = np.zeros(n_im, dtype=bool)
+            for ndx in range(n_groups):
+                flipped[ndx*group_sz:(ndx+1)*group_sz] = np.random.randint(2) > 0.5
+            sz = cols if axis == 0 else rows
+            locs, occ = flip_locs(locs, occ, conf, flipped, axis, sz)
+            flip_mat = np.eye(3)
+            flip_mat[axis, axis] = -1
+            flip_mat[axis, 2] = sz - 1
+            mats[flipped] = np.matmul(flip_mat, mats[flipped])
+
+        srange, no_rescale = affine_srange(conf)
+        if not (conf.rrange < 1 and conf.trange< 1 and no_rescale):
+            assert(n_im%group_sz==0), 'Incorrect group size'
+            for ndx in range(n_groups):
+                st = ndx*group_sz
+                en = (ndx+1)*group_sz
+                orig_locs = locs[st:en, ...]
+                nan_valid = np.invert(np.isnan(orig_locs[:, :, :, 0]))
+                high_valid = orig_locs[..., 0] > -1000  # ridiculosly low values are used for multi animal
+                valid = nan_valid & high_valid
+                rot_mat, lr = random_affine_mat(orig_locs, valid, conf, float(rows), float(cols), srange)
+                lr[~high_valid,0] = -100000
+                lr[~high_valid,1] = -100000
+                locs[st:en, ...] = lr
+                mats[st:en] = np.matmul(np.concatenate([rot_mat, [[0, 0, 1]]], 0), mats[st:en])
+
+        for ndx in range(n_im):
+            if np.array_equal(mats[ndx], np.eye(3)):
+                continue
+            # Do not use inter_cubic. Leads to splotches.
+            ii = cv2.warpAffine(xs[ndx], mats[ndx, :2], (cols, rows), flags=interp_method)
+            xs[ndx] = ii.reshape(xs[ndx].shape)
+            if mask is not None:
+                mask[ndx] = cv2.warpAffine(mask[ndx], mats[ndx, :2], (cols, rows), flags=cv2.INTER_NEAREST)
+
+        if reduce_dim:
+            locs = locs[:, 0, ...]
+            occ = occ[:, 0] if occ is not None else None
+
+    xs = xs.astype('float32')
+    imax = conf.imax
+    if distort:
+        # randomly_adjust for all the groups at once
+        brange = conf.brange
+        if type(brange) == float:
+            brange = [-brange,brange]
+        bdiff = brange[1] - brange[0]
+        crange = conf.crange
+        if type(crange) == float:
+            crange = [1-crange, 1+crange]
+        cdiff = crange[1] - crange[0]
+        if (bdiff >= 0.01) or (cdiff >= 0.01):
+            factors = np.random.rand(n_groups, 2)
+            bfactor = factors[:, 0:1] * bdiff + brange[0]
+            cfactor = factors[:, 1:2] * cdiff + crange[0]
+            xg = xs[:n_groups*group_sz].reshape([n_groups, -1])
+            mm = xg.mean(axis=1, keepdims=True, dtype='float64')
+            xg += bfactor * imax
+            xg -= mm
+            xg *= cfactor
+            xg += mm
+            np.clip(xg, 0, imax, out=xg)
+
+    # normalize_mean
+    if conf.normalize_img_mean:
+        xs -= xs.mean(axis=(1,2), keepdims=True, dtype='float64')
+        if conf.img_dim == 3 and conf.perturb_color:
+            for dim in range(3):
+                to_add = old_div(((np.random.rand(n_im) - 0.5) * conf.imax), 8)
+                xs[:, :, :, dim] += to_add[:, np.newaxis, np.newaxis]
+
+    ret = [xs,locs]
+    if mask is not None:
+        ret.append(mask)
+    if occ is not None:
+        ret.append(occ)
+    return ret
+
+
 def pad_ims(ims, locs, pady, padx):
     # AL WARNING for caller: this modifies locs in place
     pady_b = pady//2 # before
@@ -53,7 +53,7 @@ def preproc_func(conf, distort, *args, pad_input=False,pad_x=0,pad_y=0):
         tlocs[:,:,1] -= pad_y//2
 
     hsz = [i//conf.rescale for i in conf.imsz]
-    hmaps = PoseTools.create_label_images(tlocs, hsz, 1, conf.label_blur_rad,occluded=occ)
+    hmaps = PoseTools.create_label_images(tlocs, hsz, 1, conf.label_blur_rad,occluded=occ,subpixel=conf.get('label_subpixel',False),gaussian=conf.get('label_gaussian',False))
     return ims.astype('float32'), locs.astype('float32'), info.astype('float32'), hmaps.astype('float32')
 
 def conv_residual(x_in, train_phase):
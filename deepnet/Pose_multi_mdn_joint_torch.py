@@ -476,73 +476,84 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
         return target_dict
 
     def get_joint_pred(self,preds):
+        # All the examples in the batch are decoded together. The greedy NMS loops over the top k candidates, but only with batched tensor ops so that there are no host syncs till the final copy.
         n_max = self.conf.max_n_animals
         n_min = self.conf.min_n_animals
         locs_joint, logits_joint, locs_ref, logits_ref, occ_out = preds
-        locs_joint = locs_joint
         bsz = locs_joint.shape[0]
         n_classes = locs_joint.shape[1]
         n_x_j = locs_joint.shape[-1]; n_y_j = locs_joint.shape[-2]
         n_x_r = locs_ref.shape[-1]; n_y_r = locs_ref.shape[-2]
         locs_offset = self.offset
-        k_ref = locs_ref.shape[-3]
         k_joint = locs_joint.shape[-3]
+        device = locs_joint.device
         ll_joint_flat = logits_joint.reshape([-1,k_joint*n_x_j*n_y_j])
-        locs_ref = locs_ref * self.ref_scale
 
-        preds_ref = torch.ones([bsz,n_max, n_classes,2],device=self.device) * np.nan
-        conf_ref = torch.ones([bsz,n_max,n_classes],device=self.device)*-100
-        preds_joint = torch.ones([bsz,n_max, n_classes,2],device=self.device) * np.nan
-        pred_occ = torch.ones([bsz,n_max, n_classes],device=self.device) * np.nan
-        conf_joint = torch.ones([bsz,n_max],device=self.device)*-100
+        preds_ref = torch.ones([bsz,n_max, n_classes,2],device=device) * np.nan
+        conf_ref = torch.ones([bsz,n_max,n_classes],device=device)*-100
+        preds_joint = torch.ones([bsz,n_max, n_classes,2],device=device) * np.nan
+        pred_occ = torch.ones([bsz,n_max, n_classes],device=device) * np.nan
+        conf_joint = torch.ones([bsz,n_max],device=device)*-100
         match_dist_factor = self.conf.multi_match_dist_factor
         assert ll_joint_flat.shape[1] >= n_min, f'The max number of animals with image size {self.conf.imsz} is {ll_joint_flat.shape[1]} while the minimum animals set is {n_min}'
-        k = np.clip(n_max*5,n_min,ll_joint_flat.shape[1])
-        for ndx in range(bsz):
-            # n_preds = np.count_nonzero(ll_joint_flat[ndx,:]>0)
-            # n_preds = np.clip(n_preds,n_min,np.inf)
-            ids = ll_joint_flat[ndx,:].topk(k)[1]
-            done_count = 0
-            cur_n = 0
-            while (done_count < n_max) and (cur_n<len(ids)):
-                sel_ex = ids[cur_n]
-                cur_n += 1
-
-                if (ll_joint_flat[ndx,sel_ex] < 0) and (done_count >= n_min):
-                    break
-
-                idx = unravel_index(sel_ex, [k_joint,n_y_j, n_x_j])
-                curp = locs_joint[ndx,...,idx[0],idx[1],idx[2]] * locs_offset
-                dprev = torch.norm(preds_joint[ndx,...]-curp[None,...],dim=-1).mean(-1)
-                # Find the animal size as the mean length of the bounding box
-                cur_sz =  torch.mean(curp.max(axis=-2)[0]-curp.min(axis=-2)[0])
-                nms_dist = cur_sz * match_dist_factor
-                if ( not torch.all(torch.isnan(dprev))) and (nanmin(dprev) < nms_dist):
-                    continue
-                preds_joint[ndx,done_count,...] = locs_joint[ndx,...,idx[0],idx[1],idx[2]] * locs_offset
-                if self.conf.predict_occluded:
-                    pred_occ[ndx,done_count,...] = occ_out[ndx,...,idx[0],idx[1],idx[2]]
-                conf_joint[ndx,done_count] = logits_joint[ndx,idx[0],idx[1],idx[2]]
-                for cls in range(n_classes):
-                    rpred = locs_joint[ndx, cls, :, idx[0], idx[1], idx[2]] * self.offset/self.ref_scale
-                    mm = torch.round(rpred).int()
-                    mm_y = torch.clamp(mm[1],0,n_y_r-1)
-                    mm_x = torch.clamp(mm[0],0,n_x_r-1)
-                    pt_selex = logits_ref[ndx,cls,:,mm_y,mm_x].argmax()
-                    cur_pred = locs_ref[ndx,cls,:,pt_selex,mm_y,mm_x]
-                    preds_ref[ndx,done_count,cls,:] = cur_pred
-                    conf_ref[ndx,done_count,cls] = logits_ref[ndx,cls,pt_selex,mm_y,mm_x]
-
-                done_count += 1
-
-        preds_ref = preds_ref.detach().cpu().numpy().copy()
-        preds_joint = preds_joint.detach().cpu().numpy().copy()
-        conf_ref = conf_ref.detach().cpu().numpy().copy()
-        conf_joint = conf_joint.detach().cpu().numpy().copy()
-        pred_occ = pred_occ.detach().cpu().numpy().copy()
-
-
-        return {'ref':preds_ref,'joint':preds_joint,'conf_joint':conf_joint,'conf_ref':conf_ref,'pred_occ':pred_occ}
+        k = int(np.clip(n_max*5,n_min,ll_joint_flat.shape[1]))
+
+        # Candidates sorted by their joint logits.
+        cand_ll, ids = ll_joint_flat.topk(k,dim=1)
+        locs_joint_flat = locs_joint.reshape([bsz,n_classes,2,-1])
+        cand_locs = torch.gather(locs_joint_flat,3,ids[:,None,None,:].expand(-1,n_classes,2,-1)).permute([0,3,1,2]).contiguous()
+        curp = cand_locs * locs_offset
+
+        # Distance between all pairs of candidates and the nms distance for each candidate based on the animal size, which is the mean length of the bounding box.
+        dd = torch.norm(curp[:,None,...]-curp[:,:,None,...],dim=-1).mean(-1)
+        cur_sz = torch.mean(curp.max(axis=-2)[0]-curp.min(axis=-2)[0],-1)
+        nms_dist = cur_sz * match_dist_factor
+        too_close = dd < nms_dist[:,:,None]
+
+        # Greedy selection. Logits are sorted, so once we stop for an example (negative logit after n_min animals) all the later candidates are rejected too.
+        accepted = torch.zeros([bsz,k],dtype=torch.bool,device=device)
+        done_count = torch.zeros([bsz],dtype=torch.long,device=device)
+        for cur_n in range(k):
+            stop = (cand_ll[:,cur_n] < 0) & (done_count >= n_min)
+            suppressed = (too_close[:,cur_n,:] & accepted).any(-1)
+            cur_acc = ~stop & ~suppressed & (done_count < n_max)
+            accepted[:,cur_n] = cur_acc
+            done_count += cur_acc.long()
+
+        # Move the accepted candidates to the front while keeping their order.
+        n_sel = min(n_max,k)
+        cand_ndx = torch.arange(k,device=device)[None,:]
+        sel = torch.argsort(torch.where(accepted,cand_ndx,cand_ndx+k),dim=1)[:,:n_sel]
+        valid = torch.gather(accepted,1,sel)
+
+        sel_locs = cand_locs[torch.arange(bsz,device=device)[:,None],sel]
+        preds_joint[:,:n_sel] = torch.where(valid[...,None,None],sel_locs*locs_offset,preds_joint[:,:n_sel])
+        conf_joint[:,:n_sel] = torch.where(valid,torch.gather(cand_ll,1,sel),conf_joint[:,:n_sel])
+        if self.conf.predict_occluded:
+            occ_flat = occ_out.reshape([bsz,n_classes,-1])
+            sel_ids = torch.gather(ids,1,sel)
+            sel_occ = torch.gather(occ_flat,2,sel_ids[:,None,:].expand(-1,n_classes,-1)).permute([0,2,1])
+            pred_occ[:,:n_sel] = torch.where(valid[...,None],sel_occ,pred_occ[:,:n_sel])
+
+        # Select the reference prediction for all the landmarks from the reference grid cell that the joint prediction falls in.
+        rpred = sel_locs * self.offset/self.ref_scale
+        mm = torch.round(rpred).int()
+        mm_y = torch.clamp(mm[...,1],0,n_y_r-1).long()
+        mm_x = torch.clamp(mm[...,0],0,n_x_r-1).long()
+        b_ndx = torch.arange(bsz,device=device)[:,None,None]
+        cls_ndx = torch.arange(n_classes,device=device)[None,None,:]
+        ref_logits = logits_ref[b_ndx,cls_ndx,:,mm_y,mm_x]
+        pt_selex = ref_logits.argmax(-1)
+        cur_pred = locs_ref[b_ndx,cls_ndx,:,pt_selex,mm_y,mm_x] * self.ref_scale
+        cur_conf = torch.gather(ref_logits,-1,pt_selex[...,None])[...,0]
+        preds_ref[:,:n_sel] = torch.where(valid[...,None,None],cur_pred,preds_ref[:,:n_sel])
+        conf_ref[:,:n_sel] = torch.where(valid[...,None],cur_conf,conf_ref[:,:n_sel])
+
+        # Copy everything to the host in one go.
+        out = {'ref':preds_ref,'joint':preds_joint,'conf_joint':conf_joint,'conf_ref':conf_ref,'pred_occ':pred_occ}
+        out_flat = torch.cat([v.reshape([bsz,-1]).float() for v in out.values()],1).detach().cpu().numpy()
+        splits = np.cumsum([int(np.prod(v.shape[1:])) for v in out.values()])[:-1]
+        return {key:f.reshape(out[key].shape) for key,f in zip(out.keys(),np.split(out_flat,splits,axis=1))}
 
     def get_joint_pred_up(self,preds,up_sample=8):
         n_max = self.conf.max_n_animals
@@ -679,81 +690,54 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
         conf_margin = 4
         # Average both predictions if the confidences of the predictions are withing this of each other. Else pick the dominant one.
 
-        # match predictions from offset pred and normal preds
-        for b in range(dd.shape[0]):
-            # loop over examples
-            done_offset = np.zeros(dd.shape[1])
-            done_locs = np.zeros(dd.shape[1])
-            mpred = []
-            for ix in range(dd.shape[1]):
-
-                if not valid_locs[b,ix]: continue
-                if np.all(np.isnan(dd[b, :, ix])):
-                    # no predictions at all in  offset predictions
-                    mpred.append((locs_orig[b,ix],locs['conf_joint'][b,ix],locs['pred_occ'][b,ix]))
-                    done_locs[ix] = 1
-                    continue
-
-                olocs_ndx = np.nanargmin(dd[b, :, ix])
-                # Find the closest one in offset prediction.
-
-                bb_avg = (bb_sz[b,ix]+obb_sz[b,olocs_ndx])/2
-                if dd[b, olocs_ndx, ix] < bb_avg*match_dist_factor:
-
-                    # Select the one with higher confidence unless they both are close.
-                    if locs['conf_joint'][b, ix] < olocs['conf_joint'][b, olocs_ndx] - conf_margin:
-                        cc = olocs_orig[b, olocs_ndx, ...]
-                        oo = olocs['pred_occ'][b, olocs_ndx, ...]
-                    elif locs['conf_joint'][b, ix] - conf_margin > olocs['conf_joint'][b, olocs_ndx]:
-                        cc = locs_orig[b, ix, ...]
-                        oo = locs['pred_occ'][b, ix, ...]
-                    else:
-                        cc = (olocs_orig[b, olocs_ndx, ...] + locs_orig[b, ix, ...]) / 2
-                        oo = (olocs['pred_occ'][b, olocs_ndx, ...] + locs['pred_occ'][b, ix, ...]) / 2
-
-                    # code below is for selecting based on ref confidences.
-                    # cc = np.ones([conf.n_classes,2])*np.nan
-                    # for cls in range(conf.n_classes):
-                    #     if olocs['conf_ref'][b,olocs_ndx,cls] > locs['conf_ref'][b,ix,cls]:
-                    #         cc[cls,:] = olocs_orig[b,olocs_ndx,cls,:]
-                    #     else:
-                    #         cc[cls,:] = locs_orig[b,ix,cls,...]
-
-                    done_offset[olocs_ndx] = 1
-                    done_locs[ix] = 1
-                    mconf = max(olocs['conf_joint'][b, olocs_ndx], locs['conf_joint'][b, ix])
-                    # print(f'Matched {ix} with {olocs_ndx}')
-                else:
-                    cc = locs_orig[b, ix, ...]
-                    oo = locs['pred_occ'][b, ix]
-                    done_locs[ix] = 1
-                    mconf = locs['conf_joint'][b, ix]
-                mpred.append((cc, mconf, oo))
-
-            for ix in np.where(done_offset < 0.5)[0]:
-                if not valid_olocs[b,ix]:
-                    continue
-                cc = olocs_orig[b, ix, ...]
-                oo = olocs['pred_occ'][b, ix]
-                mconf = olocs['conf_joint'][b, ix]
-                mpred.append((cc, mconf, oo))
-
-            pconf = np.array([m[1] for m in mpred])
-            ord = np.flip(np.argsort(pconf))[:conf.max_n_animals]
-            if len(ord) > conf.min_n_animals:
-                neg_ndx = np.where(pconf[ord[conf.min_n_animals:]] < 0)[0]
-                if neg_ndx.size > 0:
-                    ord = ord[:(conf.min_n_animals + neg_ndx[0])]
-
-            bpred = [mpred[ix][0] for ix in ord]
-            bpred = np.array(bpred)
-            opred = [mpred[ix][2] for ix in ord]
-            opred = np.array(opred)
-            npred = bpred.shape[0]
-            if npred > 0:
-                cur_pred[b, :npred, ...] = bpred
-                cur_occ_pred[b, :npred, ...] = opred
-                cur_joint_conf[b, :npred, ...] = pconf[ord, None]
+        # match predictions from offset pred and normal preds. All the examples are matched together.
+        # Find the closest one in offset prediction for each normal prediction.
+        n_ex, n_max = dd.shape[:2]
+        b_ndx = np.arange(n_ex)[:, None]
+        l_ndx = np.arange(n_max)[None, :]
+        dd_nan = np.isnan(dd)
+        has_opred = ~np.all(dd_nan, axis=1)
+        olocs_ndx = np.argmin(np.where(dd_nan, np.inf, dd), axis=1)
+        bb_avg = (bb_sz + obb_sz[b_ndx, olocs_ndx]) / 2
+        is_matched = valid_locs & has_opred & (dd[b_ndx, olocs_ndx, l_ndx] < bb_avg * match_dist_factor)
+
+        # Select the one with higher confidence unless they both are close.
+        l_conf = locs['conf_joint']
+        o_conf = olocs['conf_joint'][b_ndx, olocs_ndx]
+        m_olocs = olocs_orig[b_ndx, olocs_ndx]
+        m_oocc = olocs['pred_occ'][b_ndx, olocs_ndx]
+        sel_o = l_conf < o_conf - conf_margin
+        sel_l = l_conf - conf_margin > o_conf
+        cc = np.where(sel_o[..., None, None], m_olocs, np.where(sel_l[..., None, None], locs_orig, (m_olocs + locs_orig) / 2))
+        oo = np.where(sel_o[..., None], m_oocc, np.where(sel_l[..., None], locs['pred_occ'], (m_oocc + locs['pred_occ']) / 2))
+        cc = np.where(is_matched[..., None, None], cc, locs_orig)
+        oo = np.where(is_matched[..., None], oo, locs['pred_occ'])
+        mconf = np.where(is_matched, np.maximum(o_conf, l_conf), l_conf)
+
+        # Offset predictions that didn't match any normal prediction are added as is.
+        done_offset = np.zeros([n_ex, n_max], dtype=bool)
+        mb, mix = np.where(is_matched)
+        done_offset[mb, olocs_ndx[mb, mix]] = True
+
+        mpred = np.concatenate([cc, olocs_orig], axis=1)
+        mocc = np.concatenate([oo, olocs['pred_occ']], axis=1)
+        pconf = np.concatenate([mconf, olocs['conf_joint']], axis=1)
+        mvalid = np.concatenate([valid_locs, valid_olocs & ~done_offset], axis=1)
+
+        # Keep the most confident ones. Predictions with negative confidence are kept only to get to min_n_animals.
+        pconf = np.where(mvalid, pconf, -np.inf)
+        ord = np.flip(np.argsort(pconf, axis=1, kind='stable'), axis=1)[:, :conf.max_n_animals]
+        sconf = np.take_along_axis(pconf, ord, axis=1)
+        npred = np.minimum(mvalid.sum(axis=1), ord.shape[1])
+        pos = np.arange(ord.shape[1])[None, :]
+        is_neg = (sconf < 0) & (pos >= conf.min_n_animals) & (pos < npred[:, None])
+        npred = np.where(is_neg.any(axis=1), np.argmax(is_neg, axis=1), npred)
+        keep = pos < npred[:, None]
+
+        n_out = ord.shape[1]
+        cur_pred[:, :n_out] = np.where(keep[..., None, None], mpred[b_ndx, ord], cur_pred[:, :n_out])
+        cur_occ_pred[:, :n_out] = np.where(keep[..., None], mocc[b_ndx, ord], cur_occ_pred[:, :n_out])
+        cur_joint_conf[:, :n_out] = np.where(keep[..., None], sconf[..., None], cur_joint_conf[:, :n_out])
 
         matched['ref'] = cur_pred
         return matched, cur_joint_conf, cur_occ_pred
@@ -767,6 +751,12 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
         self.k_j = k_j
 
 
+    def get_raw_pred(self, preds, locs, ndx):
+        # Network outputs and decoded locations of example ndx, as they would be for a batch with only that example. Raw predictions are returned per example.
+        cur_preds = [p[ndx:ndx+1] if p is not None else None for p in preds]
+        cur_locs = {k: v[ndx:ndx+1] for k, v in locs.items()}
+        return cur_preds, cur_locs
+
     def get_pred_fn_2pass(self, model_file=None,max_n=None,imsz=None):
         if max_n is not None:
             self.conf.max_n_animals = max_n
@@ -794,42 +784,36 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
             locs_sz = (conf.batch_size, conf.n_classes, 2)
             locs_dummy = np.zeros(locs_sz)
             ims_in, _ = PoseTools.preprocess_ims(ims_in,locs_dummy,conf,False,conf.rescale)
+            # do prediction on half grid cell size offset images. o is for offset
+            # Original and offset images are stacked so that the whole batch goes through the network in a single forward pass.
+            hsz = self.offset//2
+            bsz = ims_in.shape[0]
+            ims = torch.tensor(ims_in).to(self.device).permute([0,3,1,2])/255.
+            oims = torch.nn.functional.pad(ims, [0, hsz,0, hsz])[:,:, hsz:, hsz:]
+            with torch.no_grad():
+                all_preds = model({'images':torch.cat([ims,oims],0)})
+                preds = [p[:bsz] if p is not None else None for p in all_preds]
+                opreds = [p[bsz:] if p is not None else None for p in all_preds]
+                locs = self.get_joint_pred(preds)
+                olocs = self.get_joint_pred(opreds)
+
+            matched, cur_joint_conf, cur_occ_pred = self.match_preds(locs,olocs,match_dist_factor)
             ret_dict = {}
-            ret_dict['locs'] = []
-            ret_dict['conf'] = []
-            ret_dict['occ'] = []
+            ret_dict['locs'] = matched['ref'] * conf.rescale
+            ret_dict['conf'] = 1/(1+np.exp(-cur_joint_conf))
+            if self.conf.predict_occluded:
+                ret_dict['occ'] = cur_occ_pred
+            else:
+                ret_dict['occ'] = np.ones_like(cur_occ_pred)*np.nan
+
             if retrawpred:
                 ret_dict['preds'] = [[],[]]
                 ret_dict['raw_locs'] = [[],[]]
-
-            for ndx, ims in enumerate(ims_in):
-                # do prediction on half grid cell size offset images. o is for offset
-                hsz = self.offset//2
-                ims = torch.tensor(ims[None]).to(self.device).permute([0,3,1,2])/255.
-                oims = torch.nn.functional.pad(ims, [0, hsz,0, hsz])[:,:, hsz:, hsz:]
-                with torch.no_grad():
-                    preds = model({'images':ims})
-                    opreds = model({'images':oims})
-                    locs = self.get_joint_pred(preds)
-                    olocs = self.get_joint_pred(opreds)
-
-
-                matched, cur_joint_conf, cur_occ_pred = self.match_preds(locs,olocs,match_dist_factor)
-                ret_dict['locs'].append(matched['ref'][0] * conf.rescale)
-                ret_dict['conf'].append(1/(1+np.exp(-cur_joint_conf[0])))
-                if self.conf.predict_occluded:
-                    ret_dict['occ'].append(cur_occ_pred[0])
-                else:
-                    ret_dict['occ'].append(np.ones_like(cur_occ_pred[0])*np.nan)
-
-                if retrawpred:
-                    ret_dict['preds'][0].append(preds)
-                    ret_dict['preds'][1].append(opreds)
-                    ret_dict['raw_locs'][0].append(locs)
-                    ret_dict['raw_locs'][1].append(olocs)
-            ret_dict['locs'] = np.array(ret_dict['locs'] )
-            ret_dict['conf'] = np.array(ret_dict['conf'])
-            ret_dict['occ'] = np.array(ret_dict['occ'])
+                for ndx in range(bsz):
+                    for px, (cur_preds, cur_locs) in enumerate([(preds, locs), (opreds, olocs)]):
+                        cur_preds, cur_locs = self.get_raw_pred(cur_preds, cur_locs, ndx)
+                        ret_dict['preds'][px].append(cur_preds)
+                        ret_dict['raw_locs'][px].append(cur_locs)
             return ret_dict
 
         def close_fn():
@@ -867,39 +851,29 @@ class Pose_multi_mdn_joint_torch(PoseCommon_pytorch.PoseCommon_pytorch):
             locs_sz = (conf.batch_size, conf.n_classes, 2)
             locs_dummy = np.zeros(locs_sz)
             ims_in, _ = PoseTools.preprocess_ims(ims_in,locs_dummy,conf,False,conf.rescale)
+            # Run the whole batch through the network in a single forward pass.
+            ims = torch.tensor(ims_in).to(self.device).permute([0,3,1,2])/255.
+            with torch.no_grad():
+                preds = model({'images':ims})
+                locs = self.get_joint_pred(preds)
+
             ret_dict = {}
-            ret_dict['locs'] = []
-            ret_dict['conf'] = []
-            ret_dict['occ'] = []
+            ret_dict['locs'] = locs['ref'] * conf.rescale
+            conf_joint = 1/(1+np.exp(-locs['conf_joint']))
+            conf_ref = 1/(1+np.exp(-locs['conf_ref']))
+            ret_dict['conf'] = conf_joint[...,None]*conf_ref
+            if self.conf.predict_occluded:
+                ret_dict['occ'] = locs['pred_occ']
+            else:
+                ret_dict['occ'] = np.ones_like(locs['ref'][..., 0]) * np.nan
+
             if retrawpred:
                 ret_dict['preds'] = [[]]
                 ret_dict['raw_locs'] = [[]]
-
-            for ndx, ims in enumerate(ims_in):
-                # do prediction on half grid cell size offset images. o is for offset
-                hsz = self.offset//2
-                ims = torch.tensor(ims[None]).to(self.device).permute([0,3,1,2])/255.
-                # oims = torch.nn.functional.pad(ims, [0, hsz,0, hsz])[:,:, hsz:, hsz:]
-                with torch.no_grad():
-                    preds = model({'images':ims})
-                    locs = self.get_joint_pred(preds)
-
-                ret_dict['locs'].append(locs['ref'][0] * conf.rescale)
-                conf_joint = 1/(1+np.exp(-locs['conf_joint']))
-                conf_ref = 1/(1+np.exp(-locs['conf_ref']))
-                pred_conf = conf_joint[...,None]*conf_ref
-                ret_dict['conf'].append(pred_conf[0])
-                if self.conf.predict_occluded:
-                    ret_dict['occ'].append(locs['pred_occ'][0])
-                else:
-                    ret_dict['occ'].append(np.ones_like(locs['ref'][0][..., 0]) * np.nan)
-
-                if retrawpred:
-                    ret_dict['preds'].append(preds)
-                    ret_dict['raw_locs'].append(locs)
-            ret_dict['locs'] = np.array(ret_dict['locs'])
-            ret_dict['conf'] = np.array(ret_dict['conf'])
-            ret_dict['occ'] = np.array(ret_dict['occ'])
+                for ndx in range(ims.shape[0]):
+                    cur_preds, cur_locs = self.get_raw_pred(preds, locs, ndx)
+                    ret_dict['preds'].append(cur_preds)
+                    ret_dict['raw_locs'].append(cur_locs)
             return ret_dict
 
         def close_fn():
@@ -1,4 +1,5 @@
 import hdf5storage
+import os
 import numpy as np
 import copy
 import matplotlib.pyplot as plt
@@ -433,6 +434,14 @@ class Tracklet:
   Class for tracklet-based representation of data of size [d1,...,dn,T,ntargets]
   This sparsification is efficient if each target has a single dense interval of frames for which
   it has data.
+  The data for all targets is packed into one contiguous buffer buf of size [d1,...,dn,capacity]. Target itgt's
+  data is in columns offsets[itgt]:offsets[itgt]+ncols[itgt] of buf, and those columns correspond to frames
+  startframes[itgt]:endframes[itgt]+1. Each target owns the segment seglo[itgt]:seghi[itgt] of buf, which can
+  have spare columns on either side to grow into. Targets that outgrow their segment are moved to the end of the
+  buffer with twice the room they need, and the buffer itself grows by doubling, so appending frames one at a
+  time is amortized O(1).
+  Which targets are alive in a given frame is looked up in frame_index, an index of the targets overlapping each
+  bin of frames, which is built on demand and dropped whenever startframes or endframes change.
   """
 
   # size property is defined based on size_rest, T, and ntargets
@@ -469,10 +478,34 @@ class Tracklet:
   @property
   def nframes(self):
     return self.endframes - self.startframes + 1
+
+  @property
+  def data(self):
+    """
+    List with one size_rest x nframes[itgt] nd-array per target, None for targets without data. The arrays
+    are views into the packed buffer, so they are only valid until the buffer is next reallocated.
+    """
+    data = [None,]*len(self.offsets)
+    for itgt in np.nonzero(self.offsets >= 0)[0]:
+      data[itgt] = self.buf[...,self.offsets[itgt]:self.offsets[itgt]+self.ncols[itgt]]
+    return data
+
+  @data.setter
+  def data(self,data):
+    self.pack(data)
   
   def __init__(self,size=None,ntargets=None,defaultval=None,dtype=None,**kwargs):
     
-    self.data = [] # data values, list with one nd-array per target
+    self.buf = None # packed data values, size_rest x capacity
+    self.offsets = None # 1-d array of the column in buf of each target's first frame, -1 if no data
+    self.ncols = None # 1-d array of the number of columns of buf with data for each target
+    self.seglo = None # 1-d array, first column of buf owned by each target
+    self.seghi = None # 1-d array, one past the last column of buf owned by each target
+    self.nbuf = 0 # number of columns of buf in use
+    self.ngarbage = 0 # number of columns of buf in use that no target owns anymore
+    self.isconsolidated = False # whether all targets are already as tight as consolidate would make them
+    self.frame_index = None # which targets are alive in each bin of frames, see get_frame_index
+    self.nframe_queries = 0 # number of getframe calls since startframes/endframes last changed
     self.startframes = None # 1-d array of first frame for each target
     self.endframes = None # 1-d array of last frame for each target
     self.size_rest = None # size fields before nframes and ntargets
@@ -481,6 +514,7 @@ class Tracklet:
     self.ntargets = 0 # number of targets
     self.max_startframes = None
     self.min_endframes = None
+    self.data = [] # data values, list with one nd-array per target
     
     for key,val in kwargs.items():
       if hasattr(self,key):
@@ -501,27 +535,211 @@ class Tracklet:
     ismat_tracklet = isinstance(trk,dict) and 'startframes' in trk.keys()
     ish5py_tracklet = isinstance(trk,h5py._hl.files.File) and 'startframes' in trk.keys()
     return (ismat_tracklet or ish5py_tracklet)
+
+  @staticmethod
+  def isPacked(trk):
+    """
+    Whether trk, loaded or opened with h5py from a trk file, is in the packed (v2) tracklet layout written by
+    Trk.savepacked.
+    """
+    return Tracklet.isTracklet(trk) and 'offsets' in trk.keys()
+
+  def pack(self,data,dtype=None):
+    """
+    pack(self,data,dtype=None)
+    Copy the list of per-target data into a new, contiguous buffer.
+    :param data: list with one size_rest x nframes[itgt] nd-array per target, or None for targets with no data.
+    :param dtype: data type of the buffer. Default = None: the common type of the input arrays.
+    :return:
+    """
+    data = list(data)
+    nonempty = [d for d in data if d is not None and d.size > 0]
+    if len(nonempty) > 0:
+      size_rest = nonempty[0].shape[:-1]
+      if dtype is None:
+        dtype = np.result_type(*nonempty)
+    else:
+      notnone = [d for d in data if d is not None and d.ndim > 1]
+      if len(notnone) > 0:
+        size_rest = notnone[0].shape[:-1]
+      else:
+        size_rest = () if self.size_rest is None else tuple(self.size_rest)
+      if dtype is None:
+        dtype = self.dtype
+    ntargets = len(data)
+    self.ncols = np.zeros(ntargets,dtype=int)
+    for itgt in range(ntargets):
+      if data[itgt] is not None and data[itgt].size > 0:
+        self.ncols[itgt] = data[itgt].shape[-1]
+    self.offsets = np.cumsum(self.ncols) - self.ncols
+    self.nbuf = int(np.sum(self.ncols))
+    self.buf = np.zeros(size_rest+(self.nbuf,),dtype=dtype)
+    for itgt in range(ntargets):
+      if self.ncols[itgt] > 0:
+        self.buf[...,self.offsets[itgt]:self.offsets[itgt]+self.ncols[itgt]] = data[itgt]
+    self.seglo = self.offsets.copy()
+    self.seghi = self.offsets + self.ncols
+    self.offsets[np.array([d is None for d in data],dtype=bool)] = -1
+    self.ngarbage = 0
+    self.isconsolidated = False
+    self.invalidate_frame_index()
+
+  def reserve(self,n):
+    """
+    reserve(self,n)
+    Make room for n more columns at the end of the buffer. If most of the buffer is garbage, it is compacted,
+    otherwise its capacity is (at least) doubled.
+    :param n: number of columns needed
+    :return:
+    """
+    size_rest = () if self.size_rest is None else tuple(self.size_rest)
+    if self.nbuf == 0:
+      self.buf = np.zeros(size_rest+(n,),dtype=self.dtype)
+    capacity = self.buf.shape[-1]
+    if self.nbuf + n <= capacity:
+      return
+    if 2*self.ngarbage > self.nbuf:
+      self.compact()
+      if self.nbuf + n <= capacity:
+        return
+    buf = np.zeros(self.buf.shape[:-1]+(max(2*capacity,self.nbuf+n),),dtype=self.buf.dtype)
+    buf[...,:self.nbuf] = self.buf[...,:self.nbuf]
+    self.buf = buf
+    
+  def compact(self):
+    """
+    compact(self)
+    Move all targets' data to the start of the buffer, dropping garbage and spare room in each target's segment.
+    :return:
+    """
+    ncols = np.where(self.offsets >= 0,self.ncols,0)
+    offsets = np.cumsum(ncols) - ncols
+    nbuf = int(np.sum(ncols))
+    _,_,cols = self.live_cols()
+    self.buf[...,:nbuf] = self.buf[...,cols]
+    self.offsets = np.where(self.offsets >= 0,offsets,-1)
+    self.seglo = offsets
+    self.seghi = offsets + ncols
+    self.nbuf = nbuf
+    self.ngarbage = 0
+    
+  def live_cols(self,targets=None):
+    """
+    live_cols(self,targets=None)
+    Find the columns of the buffer holding data for the input targets.
+    :param targets: 1-d array of target indices. Default = None: all targets.
+    :return: tidx, fidx, cols: target index, frame number and buffer column for every frame with data, ordered by
+    target, then frame.
+    """
+    if targets is None:
+      targets = np.arange(len(self.offsets),dtype=int)
+    targets = targets[self.offsets[targets] >= 0]
+    n = self.ncols[targets]
+    tidx = np.repeat(targets,n)
+    i = np.arange(np.sum(n),dtype=int) - np.repeat(np.cumsum(n)-n,n)
+    cols = self.offsets[tidx] + i
+    fidx = self.startframes[tidx] + i
+    return tidx,fidx,cols
+  
+  def frame_cols(self,targets,frames):
+    """
+    frame_cols(self,targets,frames)
+    Vectorized lookup of where the data for targets x frames is in the buffer.
+    :param targets: 1-d array of target indices.
+    :param frames: 1-d array of frame numbers.
+    :return: ti, fi, cols: indices into targets and frames, and buffer columns, for each target x frame pair with
+    data.
+    """
+    order = np.argsort(frames,kind='stable')
+    sortedframes = frames[order]
+    st = self.startframes[targets]
+    en = self.endframes[targets]
+    offsets = self.offsets[targets]
+    lo = np.searchsorted(sortedframes,st,side='left')
+    hi = np.searchsorted(sortedframes,en,side='right')
+    n = np.where(offsets >= 0,np.maximum(hi-lo,0),0)
+    ti = np.repeat(np.arange(targets.size,dtype=int),n)
+    fi = order[np.arange(np.sum(n),dtype=int) - np.repeat(np.cumsum(n)-n-lo,n)]
+    cols = (offsets[ti] + frames[fi] - st[ti]).astype(int)
+    return ti,fi,cols
+
+  def resize_target(self,itgt,sf,ef):
+    """
+    resize_target(self,itgt,sf,ef)
+    Set the interval target itgt stores to frames sf through ef. Data for frames already in the interval is kept,
+    new frames are set to defaultval.
+    :param itgt: target index
+    :param sf: new first frame
+    :param ef: new last frame
+    :return:
+    """
+    sf = int(sf)
+    ef = int(ef)
+    n = max(ef-sf+1,0)
+    hasdata = self.offsets[itgt] >= 0
+    self.invalidate_frame_index()
+    if hasdata:
+      off = self.offsets[itgt] + sf - self.startframes[itgt]
+      if off >= self.seglo[itgt] and off+n <= self.seghi[itgt]:
+        # fits in the target's segment, just fill in the new frames
+        off0 = self.offsets[itgt]
+        off1 = off0 + self.ncols[itgt]
+        if n > 0 and off < off0:
+          self.buf[...,off:min(off0,off+n)] = self.defaultval
+        if n > 0 and off+n > off1:
+          self.buf[...,max(off1,off):off+n] = self.defaultval
+        self.offsets[itgt] = off
+        self.ncols[itgt] = n
+        self.startframes[itgt] = sf
+        self.endframes[itgt] = ef
+        return
+      
+    # move to a new segment at the end of the buffer, with room to grow in the direction it is growing
+    self.reserve(2*n)
+    lo = self.nbuf
+    if hasdata and sf < self.startframes[itgt]:
+      off = lo + n
+    else:
+      off = lo
+    self.buf[...,off:off+n] = self.defaultval
+    if hasdata:
+      sf0 = max(sf,self.startframes[itgt])
+      ef0 = min(ef,self.startframes[itgt]+self.ncols[itgt]-1)
+      if sf0 <= ef0:
+        self.buf[...,off+sf0-sf:off+ef0-sf+1] = \
+          self.buf[...,self.offsets[itgt]+sf0-self.startframes[itgt]:self.offsets[itgt]+ef0-self.startframes[itgt]+1]
+      self.ngarbage += self.seghi[itgt] - self.seglo[itgt]
+    self.seglo[itgt] = lo
+    self.seghi[itgt] = lo + 2*n
+    self.nbuf += 2*n
+    self.offsets[itgt] = off
+    self.ncols[itgt] = n
+    self.startframes[itgt] = sf
+    self.endframes[itgt] = ef
       
   def allocate(self,size_rest,startframes,endframes):
     self.max_startframes = startframes.copy()
     self.min_endframes = endframes.copy()
     self.setntargets(len(startframes))
     self.size_rest = size_rest
-    for itgt in range(self.ntargets):
-      if self.data[itgt] is None or self.data[itgt].size == 0:
-        self.data[itgt] = np.zeros(self.size_rest+(endframes[itgt]-startframes[itgt]+1,),dtype=self.dtype)
-        self.data[itgt][:] = self.defaultval
-        continue
-      if self.startframes[itgt] > startframes[itgt]:
-        pad = np.zeros(self.size_rest + (self.startframes[itgt]-startframes[itgt],),dtype=self.dtype)
-        pad[:] = self.defaultval
-        self.data[itgt] = np.concatenate((pad,self.data[itgt]),axis=len(self.size_rest))
-      if self.endframes[itgt] < endframes[itgt]:
-        pad = np.zeros(self.size_rest + (endframes[itgt]-self.endframes[itgt],),dtype=self.dtype)
-        pad[:] = self.defaultval
-        self.data[itgt] = np.concatenate((self.data[itgt],pad),axis=len(self.size_rest))
+    if np.all(self.offsets < 0):
+      # nothing stored yet, lay all targets out back to back
+      ncols = np.maximum(endframes-startframes+1,0).astype(int)
+      self.offsets = np.cumsum(ncols) - ncols
+      self.ncols = ncols
+      self.seglo = self.offsets.copy()
+      self.seghi = self.offsets + ncols
+      self.nbuf = int(np.sum(ncols))
+      self.ngarbage = 0
+      self.buf = np.zeros(tuple(self.size_rest)+(self.nbuf,),dtype=self.dtype)
+      self.buf[:] = self.defaultval
+    else:
+      for itgt in range(self.ntargets):
+        self.resize_target(itgt,startframes[itgt],endframes[itgt])
     self.startframes[:] = startframes
     self.endframes[:] = endframes
+    self.isconsolidated = False
+    self.invalidate_frame_index()
     
   def setdefaultval(self,v):
     """
@@ -582,8 +800,52 @@ class Tracklet:
     :param kwargs: other arguments to the convert function, including ismatlab=False
     :return:
     """
-    self.data,self.startframes,self.endframes,_,self.size = convertdense2tracklet(dense,defaultval=self.defaultval,**kwargs)
+    self.data,startframes,endframes,_,self.size = convertdense2tracklet(dense,defaultval=self.defaultval,**kwargs)
+    # convertdense2tracklet returns the input startframes and endframes if they are given
+    self.startframes = np.array(startframes)
+    self.endframes = np.array(endframes)
   
+  def setdata_packed(self,buf,startframes,endframes,offsets):
+    """
+    setdata_packed(self,buf,startframes,endframes,offsets)
+    Set this tracklet to store the data in buf, which has all targets' data concatenated along frames, as in the
+    packed trk layout. buf is used as this object's buffer without copying.
+    :param buf: size_rest x N array. The data for target itgt is in columns offsets[itgt] through
+    offsets[itgt]+endframes[itgt]-startframes[itgt].
+    :param startframes, endframes, offsets: 1-d arrays with one element per target.
+    :return:
+    """
+    startframes = np.array(startframes,dtype=int)
+    endframes = np.array(endframes,dtype=int)
+    self.ncols = np.maximum(endframes-startframes+1,0)
+    self.offsets = np.array(offsets,dtype=int)
+    self.seglo = self.offsets.copy()
+    self.seghi = self.offsets + self.ncols
+    self.buf = buf
+    self.nbuf = buf.shape[-1]
+    self.ngarbage = self.nbuf - int(np.sum(self.ncols))
+    self.size_rest = tuple(buf.shape[:-1])
+    self.startframes = startframes
+    self.endframes = endframes
+    self.ntargets = len(startframes)
+    self.isconsolidated = False
+    self.invalidate_frame_index()
+
+  def getpacked(self):
+    """
+    getpacked(self)
+    Get all targets' data concatenated along frames, as stored in the packed trk layout.
+    :return: buf, startframes, endframes, offsets: buf is size_rest x N, and the data for target itgt is in columns
+    offsets[itgt] through offsets[itgt]+endframes[itgt]-startframes[itgt]. Targets without data have
+    startframes = -1, endframes = -2.
+    """
+    ncols = np.where(self.offsets >= 0,self.ncols,0)
+    offsets = np.cumsum(ncols) - ncols
+    _,_,cols = self.live_cols()
+    startframes = np.where(ncols > 0,self.startframes,-1)
+    endframes = np.where(ncols > 0,self.endframes,-2)
+    return self.buf[...,cols],startframes,endframes,offsets
+
   def setdata_tracklet(self,data,startframes,endframes,defaultval=None,docopy=False,ismatlab=False):
     """
     setdata_tracklet(self,data,starframes,endframes,defaultval=np.nan,docopy=False):
@@ -593,7 +855,9 @@ class Tracklet:
     :param startframes: array of length ntargets indicating the first frame of each target's tracklet
     :param endframes: array of length ntargets indicating the last frame of each target's tracklet
     :param defaultval: default value for sparsification. Default = None: use self.defaultval.
-    :param docopy: Whether to make a copy of the data, or use the direct pointer
+    :param docopy: Ignored, startframes and endframes are always copied since offsets and ncols of the packed buffer
+    have to stay in step with them, e.g. when the trkFields of a Trk are set with pTrk's startframes. data is always
+    copied into the packed buffer.
     :param ismatlab: whether to convert from matlab (1-indexed, fortran-order) indexing, values
     :return:
     """
@@ -606,26 +870,28 @@ class Tracklet:
       endframes = endframes.flatten()
 
     if ismatlab:
-      self.data = to_py(data,dtype=self.dtype)
+      data = to_py(data,dtype=self.dtype)
       self.startframes = to_py(startframes)
       self.endframes = to_py(endframes)
-    elif docopy:
-      self.data = map(lambda x: x.copy(),data)
+    else:
       self.startframes = startframes.copy()
       self.endframes = endframes.copy()
-    else:
-      self.data = data
-      self.startframes = startframes
-      self.endframes = endframes
     if defaultval is not None:
       self.setdefaultval(defaultval)
-    self.ntargets = len(self.data)
-    if len(self.data)>0:
-     self.size_rest = self.data[0].shape[:-1]
+    data = list(data)
+    self.ntargets = len(data)
+    # empty targets are stored as zeros(0), so take the size from a target with data
+    nonempty = [d for d in data if d is not None and d.size > 0]
+    if len(nonempty)>0:
+      self.size_rest = nonempty[0].shape[:-1]
+    elif len(data)>0:
+      self.size_rest = data[0].shape[:-1]
     else:
       self.size_rest = (0,0)
-    if len(self.data)>1 and self.data[0].dtype != self.dtype:
-      self.data = [d.astype(self.dtype) for d in self.data]
+    if len(data)>1 and len(nonempty)>0 and nonempty[0].dtype != self.dtype:
+      self.pack(data,dtype=self.dtype)
+    else:
+      self.pack(data)
   
   def getframe(self,fs):
     """
@@ -635,21 +901,116 @@ class Tracklet:
     :return: p: nlandmarks x d x len(frames) x ntargets with data
     """
     fs = np.atleast_1d(fs)
-    min_fs = fs.min()
-    max_fs = fs.max()
     p=np.zeros(self.size_rest+ (fs.size,self.ntargets),dtype=self.dtype)
     p[:]=self.defaultval
-    st = self.startframes
-    en = self.endframes
-    for itgt in range(self.ntargets):
-      if self.data[itgt] is None:
-        continue
-      if (st[itgt] > max_fs) or (en[itgt] < min_fs):
-        continue
-      idx = np.nonzero(np.logical_and(fs >= self.startframes[itgt],fs <= self.endframes[itgt]))[0]
-      if idx.size > 0:
-        p[...,idx,itgt] = self.data[itgt][...,fs[idx]-self.startframes[itgt]]
+    if fs.size == 1:
+      # single frame queries, e.g. once per frame while linking, only look at the targets alive in that frame
+      # the index is only built once startframes and endframes have not changed for a few queries, so that
+      # alternating between setting and getting frames does not rebuild it every time
+      if self.frame_index is None:
+        self.nframe_queries += 1
+      if self.frame_index is not None or self.nframe_queries >= 4:
+        t = fs[0]
+        alive = self.alive_targets(t)
+        p[...,0,alive] = self.buf[...,(self.offsets[alive]+t-self.startframes[alive]).astype(int)]
+        return p
+    ti,fi,cols = self.frame_cols(np.arange(self.ntargets,dtype=int),fs)
+    if cols.size > 0:
+      p[...,fi,ti] = self.buf[...,cols]
     return p
+
+  def isalive(self):
+    """
+    isalive(self)
+    :return: ntargets boolean array, whether each target has data for a nonempty interval of frames
+    """
+    return np.logical_and(self.offsets >= 0,self.endframes >= self.startframes)
+
+  def invalidate_frame_index(self):
+    self.frame_index = None
+    self.nframe_queries = 0
+
+  def get_frame_index(self,binsize=64):
+    """
+    get_frame_index(self,binsize=64)
+    Returns the index of which targets have data in each bin of binsize frames, building it if needed. It is
+    stored in CSR form: the targets overlapping bin b are targets[indptr[b]:indptr[b+1]], in increasing order.
+    Each target appears in nframes[itgt]/binsize+1 bins at most, so the index is small compared to the data.
+    :param binsize: number of frames per bin
+    :return: dict with entries T0 (first frame of bin 0), binsize, indptr and targets.
+    """
+    if self.frame_index is not None:
+      return self.frame_index
+    tgts = np.nonzero(self.isalive())[0]
+    T0 = int(np.min(self.startframes[tgts])) if tgts.size > 0 else 0
+    b0 = ((self.startframes[tgts]-T0)//binsize).astype(int)
+    b1 = ((self.endframes[tgts]-T0)//binsize).astype(int)
+    n = b1-b0+1
+    bins = np.repeat(b0,n) + np.arange(np.sum(n),dtype=int) - np.repeat(np.cumsum(n)-n,n)
+    order = np.argsort(bins,kind='stable')
+    nbins = int(np.max(b1))+1 if tgts.size > 0 else 0
+    indptr = np.searchsorted(bins[order],np.arange(nbins+1))
+    self.frame_index = {'T0': T0, 'binsize': binsize, 'indptr': indptr, 'targets': np.repeat(tgts,n)[order]}
+    return self.frame_index
+
+  def alive_targets(self,t):
+    """
+    alive_targets(self,t)
+    Find the targets with data in frame t using the frame index, in O(1 + number of targets in t's bin).
+    :param t: frame number
+    :return: increasing array of target indices
+    """
+    idx = self.get_frame_index()
+    b = int(t - idx['T0'])//idx['binsize']
+    if b < 0 or b >= len(idx['indptr'])-1:
+      return np.zeros(0,dtype=int)
+    tgts = idx['targets'][idx['indptr'][b]:idx['indptr'][b+1]]
+    return tgts[np.logical_and(self.startframes[tgts] <= t,self.endframes[tgts] >= t)]
+
+  def iter_frames(self,T0=None,T1=None,chunksize=256):
+    """
+    iter_frames(self,T0=None,T1=None,chunksize=256)
+    Iterate over frames T0 through T1, sweeping through the frames with the set of targets alive in them.
+    Targets are added to the active set when the sweep reaches their startframe and dropped after their endframe,
+    and data is read chunksize frames at a time, which is much faster than calling getframe for each frame.
+    Changes made to the tracklet while iterating are not seen in frames that have already been read.
+    :param T0: first frame. Default = None: self.T0
+    :param T1: last frame. Default = None: self.T1
+    :param chunksize: number of frames to read at a time
+    :return: generator of (t, p), where p is size_rest x 1 x ntargets, the same as getframe(t)
+    """
+    if T0 is None:
+      T0 = self.T0
+    if T1 is None:
+      T1 = self.T1
+    tgts = np.nonzero(self.offsets >= 0)[0]
+    order = tgts[np.argsort(self.startframes[tgts],kind='stable')]
+    starts = self.startframes[order]
+    nstarted = np.searchsorted(starts,T0,side='left')
+    active = order[:nstarted]
+    for t0 in range(T0,T1+1,chunksize):
+      t1 = min(t0+chunksize-1,T1)
+      # add targets starting by the end of this chunk, drop targets that ended before it
+      n = np.searchsorted(starts,t1,side='right')
+      active = np.concatenate((active,order[nstarted:n]))
+      nstarted = n
+      active = active[self.endframes[active] >= t0]
+      
+      # read all (frame, target) pairs with data in this chunk, sorted by frame
+      lo = np.maximum(self.startframes[active],t0).astype(int)
+      n = np.maximum(np.minimum(self.endframes[active],t1)-lo+1,0).astype(int)
+      ti = np.repeat(active,n)
+      fs = np.repeat(lo,n) + np.arange(np.sum(n),dtype=int) - np.repeat(np.cumsum(n)-n,n)
+      idx = np.argsort(fs,kind='stable')
+      ti = ti[idx]
+      fs = fs[idx]
+      vals = self.buf[...,(self.offsets[ti]+fs-self.startframes[ti]).astype(int)]
+      bounds = np.searchsorted(fs,np.arange(t0,t1+2))
+      for t in range(t0,t1+1):
+        p = np.zeros(self.size_rest+(1,self.ntargets),dtype=self.dtype)
+        p[:] = self.defaultval
+        p[...,0,ti[bounds[t-t0]:bounds[t-t0+1]]] = vals[...,bounds[t-t0]:bounds[t-t0+1]]
+        yield t,p
   
   def gettarget(self,itgts,T=None):
     """
@@ -662,17 +1023,7 @@ class Tracklet:
     
     if T is None:
       T = self.T
-    itgts = np.atleast_1d(itgts)
-
-    ntgts = len(itgts)
-    p = np.zeros(self.size_rest + (T,ntgts),dtype=self.dtype)
-    p[:] = self.defaultval
-    for i in range(len(itgts)):
-      itgt = itgts[i]
-      if self.data[itgt] is None:
-        continue
-      p[...,self.startframes[itgt]:self.endframes[itgt]+1,i] = self.data[itgt]
-    return p
+    return self.gettargetframe(itgts,np.arange(T,dtype=int))
   
   def gettargetframe(self,targets,frames):
     """
@@ -683,7 +1034,6 @@ class Tracklet:
     :return: p: nlandmarks x d x len(frames) x len(targets) with data.
     """
 
-    # sparse: more complicated
     frames = np.atleast_1d(frames)
     targets = np.atleast_1d(targets)
     
@@ -691,15 +1041,9 @@ class Tracklet:
     p = np.zeros(self.size_rest+(frames.size,targets.size),dtype=self.dtype)
     p[:] = self.defaultval
     
-    # Loop through all targets
-    for i in range(len(targets)):
-      itgt = targets[i]
-      # find frames in range
-      fidx0 = np.atleast_1d(frames-self.startframes[itgt])
-      fidx1 = np.nonzero(np.logical_and(fidx0 >= 0,fidx0 < self.nframes[itgt]))[0]
-      fidx0 = fidx0[fidx1]
-      if self.data[itgt] is not None:
-        p[...,fidx1,i] = self.data[itgt][...,fidx0]
+    ti,fi,cols = self.frame_cols(targets,frames)
+    if cols.size > 0:
+      p[...,fi,ti] = self.buf[...,cols]
     return p
   
   def axis_rest(self):
@@ -726,56 +1070,71 @@ class Tracklet:
 
     p = p.reshape(self.size_rest + (fs.size,targets.size))
     
-    for i in range(targets.size):
+    # grow targets to cover the real frames being set. targets with no data get all of fs
+    idx_real = self.real_idx(p)
+    hasdata = np.logical_and(self.offsets[targets] >= 0,self.ncols[targets] > 0)
+    sf = np.min(np.where(idx_real,fs[:,None],np.max(fs)),axis=0)
+    ef = np.max(np.where(idx_real,fs[:,None],np.min(fs)),axis=0)
+    grow = np.any(idx_real,axis=0) & ((sf < self.startframes[targets]) | (ef > self.endframes[targets]))
+    for i in np.nonzero(~hasdata | grow)[0]:
       itgt = targets[i]
-      idx_real = self.real_idx(p[...,i])
-      if self.data[itgt] is None:
-        sf = int(np.min(fs))
-        ef = int(np.max(fs))
-        self.data[itgt] = np.zeros(self.size_rest+(ef-sf+1,),dtype=self.dtype)
-        self.data[itgt][:] = self.defaultval
-        self.startframes[itgt] = sf
-        self.endframes[itgt] = ef
-      idx = np.logical_and(fs >= self.startframes[itgt],fs <= self.endframes[itgt])
-      if np.any(idx):
-        self.data[itgt][...,fs[idx] - self.startframes[itgt]] = p[...,idx,i]
-      idx = np.logical_and(fs < self.startframes[itgt],idx_real)
-      if np.any(idx):
-        sf = np.min(fs[idx])
-        pad = np.zeros(self.size_rest + (self.startframes[itgt]-sf,),dtype=self.dtype)
-        pad[:] = self.defaultval
-        self.data[itgt] = np.concatenate((pad,self.data[itgt]),axis=len(self.size_rest))
-        self.startframes[itgt] = sf
-        self.data[itgt][...,fs[idx] - self.startframes[itgt]] = p[...,idx,i]
-      idx = np.logical_and(fs > self.endframes[itgt],idx_real)
-      if np.any(idx):
-        ef = np.max(fs[idx])
-        pad = np.zeros(self.size_rest + (ef-self.endframes[itgt],),dtype=self.dtype)
-        pad[:] = self.defaultval
-        self.data[itgt] = np.concatenate((self.data[itgt],pad),axis=len(self.size_rest))
-        self.endframes[itgt] = ef
-        self.data[itgt][...,fs[idx] - self.startframes[itgt]] = p[...,idx,i]
-    self.consolidate()
+      if self.offsets[itgt] >= 0 and self.ncols[itgt] > 0:
+        self.resize_target(itgt,min(sf[i],self.startframes[itgt]),max(ef[i],self.endframes[itgt]))
+      else:
+        self.resize_target(itgt,np.min(fs),np.max(fs))
     
-  def consolidate(self,force=False):
+    ti,fi,cols = self.frame_cols(targets,fs)
+    self.buf[...,cols] = p[...,fi,ti]
+    self.consolidate(targets=targets)
+    
+  def consolidate(self,force=False,targets=None):
+    """
+    consolidate(self,force=False,targets=None)
+    Shrink each target's interval to be tight around its non-default data.
+    :param force: If False, don't shrink intervals to less than what was allocated. Default = False.
+    :param targets: 1-d array of targets that changed since the last consolidate. Only these need to be checked
+    if all other targets are already consolidated. Default = None: check all targets.
+    :return:
+    """
     
     # don't go smaller than allocated size
     if (not force) and (self.max_startframes is not None) and (self.min_endframes is not None):
       if np.all(self.startframes <= self.max_startframes) and np.all(self.endframes >= self.min_endframes):
         return
 
-    axis_rest = self.axis_rest()
-    for itgt in range(self.ntargets):
-      if self.data[itgt] is None:
-        continue
-      idx_real = np.where(~np.all(equals_nan(self.data[itgt],self.defaultval),axis=axis_rest))[0]
-      if len(idx_real) == 0 and (force or (self.max_startframes is None)):
-        self.startframes[itgt] = -1
-        self.endframes[itgt] = -2
-        self.data[itgt] = np.array(self.size_rest+(0,))
+    if targets is None or force or not self.isconsolidated:
+      targets = np.nonzero(self.offsets >= 0)[0]
+    else:
+      # only targets whose first or last frame is no longer real can shrink
+      targets = np.unique(targets)
+      targets = targets[np.logical_and(self.offsets[targets] >= 0,self.ncols[targets] > 0)]
+      if targets.size > 0:
+        isreal0 = self.real_idx(self.buf[...,self.offsets[targets]])
+        isreal1 = self.real_idx(self.buf[...,self.offsets[targets]+self.ncols[targets]-1])
+        targets = targets[~np.logical_and(isreal0,isreal1)]
+    
+    # first and last real frame of each target, in relation to its startframe
+    tidx,fidx,cols = self.live_cols(targets)
+    isreal = self.real_idx(self.buf[...,cols])
+    i = (fidx - self.startframes[tidx])[isreal]
+    tidx = tidx[isreal]
+    first = np.zeros(self.ntargets,dtype=int)-1
+    last = np.zeros(self.ntargets,dtype=int)-1
+    u,j = np.unique(tidx,return_index=True)
+    first[u] = i[j]
+    u,j = np.unique(tidx[::-1],return_index=True)
+    last[u] = i[::-1][j]
+    
+    for itgt in targets:
+      if first[itgt] < 0:
+        if force or (self.max_startframes is None):
+          self.startframes[itgt] = -1
+          self.endframes[itgt] = -2
+          self.ncols[itgt] = 0
+          self.invalidate_frame_index()
         continue
-      sf = idx_real[0] # in relation to startframe
-      ef = idx_real[-1]
+      sf = first[itgt]
+      ef = last[itgt]
       if (not force) and (self.max_startframes is not None):
         # max value sf can be is max_startframes[itgt] - startframes[itgt]
         sf = np.fmin(sf,self.max_startframes[itgt]-self.startframes[itgt])
@@ -784,9 +1143,8 @@ class Tracklet:
         ef = np.fmax(ef,self.min_endframes[itgt]-self.startframes[itgt])
       
       if sf > 0 or ef < self.nframes[itgt]-1:
-        self.data[itgt] = self.data[itgt][...,sf:ef+1]
-        self.endframes[itgt] = self.startframes[itgt] + ef # order here matters
-        self.startframes[itgt] = self.startframes[itgt] + sf
+        self.resize_target(itgt,self.startframes[itgt]+sf,self.startframes[itgt]+ef)
+    self.isconsolidated = True
         
     if force:
       if self.max_startframes is not None:
@@ -798,12 +1156,13 @@ class Tracklet:
     assert startframes.size == self.ntargets and endframes.size == self.ntargets
     if np.all(startframes == self.startframes) and np.all(endframes == self.endframes):
       return
-    data = [None,]*self.ntargets
     for itgt in range(self.ntargets):
-      data[itgt] = self.gettargetframe(itgt,np.arange(startframes[itgt],endframes[itgt]+1,dtype=int))
-    self.data = data
+      if self.offsets[itgt] < 0 or startframes[itgt] != self.startframes[itgt] or endframes[itgt] != self.endframes[itgt]:
+        self.resize_target(itgt,startframes[itgt],endframes[itgt])
     self.startframes[:] = startframes
     self.endframes[:] = endframes
+    self.isconsolidated = False
+    self.invalidate_frame_index()
     if self.max_startframes is not None:
       self.max_startframes = np.fmax(self.startframes,self.max_startframes)
     if self.min_endframes is not None:
@@ -812,12 +1171,13 @@ class Tracklet:
   def copy(self):
     
     trk = Tracklet()
-    trk.data = copy.deepcopy(self.data)
+    trk.dtype = self.dtype
+    trk.defaultval = self.defaultval
+    trk.size_rest = self.size_rest
+    trk.data = self.data
     trk.startframes = self.startframes.copy()
     trk.endframes = self.endframes.copy()
     trk.size = self.size
-    trk.dtype = self.dtype
-    trk.defaultval = self.defaultval
     trk.ntargets = self.ntargets
     
     return trk
@@ -846,7 +1206,7 @@ class Tracklet:
       T1 = T0+p.shape[2]-1
     self.settargetframe(p,targets,np.arange(T0,T1+1,dtype=int))
   
-  def getdense(self,T=None,consolidate=True,T0=None,**kwargs):
+  def getdense(self,T=None,consolidate=True,T0=None,tomatlab=False):
     """
     getdense(self,tomatlab=False)
     Returns a dense version of the tracklet data.
@@ -868,7 +1228,13 @@ class Tracklet:
       T1 = self.T1
       T = T1-T0+1
 
-    p = converttracklet2dense(self.data,self.startframes-T0,self.endframes-T0,T,defaultval=self.defaultval,**kwargs)
+    p = np.zeros(self.size_rest+(T,self.ntargets),dtype=type(self.defaultval))
+    p[:] = self.defaultval
+    ti,fi,cols = self.frame_cols(np.arange(self.ntargets,dtype=int),np.arange(T0,T0+T,dtype=int))
+    if cols.size > 0:
+      p[...,fi,ti] = self.buf[...,cols]
+    if tomatlab:
+      p = to_mat(p)
     return p,T0
 
   def getsparse(self,T=None,**kwargs):
@@ -897,10 +1263,11 @@ class Tracklet:
     vals: array of non-default values of pTrk corresponding to output idx
     """
   
+    data = self.data
     # count to allocate
     n=0
     for itgt in range(self.ntargets):
-      n+=np.count_nonzero(~equals_nan(self.defaultval,self.data[itgt]))
+      n+=np.count_nonzero(~equals_nan(self.defaultval,data[itgt]))
       
     # allocate
     ndim=len(self.size.shape)
@@ -914,10 +1281,10 @@ class Tracklet:
     off=0
     for itgt in range(self.ntargets):
       # find non-default values for this target, raveled index
-      idxt=np.where(~equals_nan(self.defaultval,self.data[itgt]))
+      idxt=np.where(~equals_nan(self.defaultval,data[itgt]))
       ncurr=idxt[0].size
       if get_vals:
-        vals[off:off+ncurr]=self.data[itgt][idxt]
+        vals[off:off+ncurr]=data[itgt][idxt]
       if get_idx:
         # store indices in raveled form
         for j in range(ndim-1):
@@ -952,39 +1319,42 @@ class Tracklet:
     if self.ntargets == 0:
       return minv,maxv
     
-    ax = len(self.size_rest)
-    
-    maxvs = np.ones( (self.ntargets,) + self.size_rest)*np.nan
-    minvs = np.ones( (self.ntargets,) + self.size_rest)*np.nan
-    for itgt in range(self.ntargets):
-      if self.data[itgt] is None or self.data[itgt].size==0:
-        continue
-      minvs[itgt] = np.nanmin(self.data[itgt],axis=ax)
-      maxvs[itgt] = np.nanmax(self.data[itgt],axis=ax)
+    _,_,cols = self.live_cols()
+    vals = self.buf[...,cols].astype(float)
 
-    if np.all(np.isnan(maxvs)):
+    if np.all(np.isnan(vals)):
       maxv = -1
-    else:
-      maxv = np.nanmax(maxvs).astype(self.dtype)
-
-    if np.all(np.isnan(minvs)):
       minv = -1
     else:
-      minv = np.nanmin(minvs).astype(self.dtype)
+      maxv = np.nanmax(vals).astype(self.dtype)
+      minv = np.nanmin(vals).astype(self.dtype)
 
     return minv,maxv
     
   def setntargets(self,ntargets,reinitialize=False):
     
-    if (self.data is not None) and not reinitialize:
-      if self.ntargets >= ntargets:
-        self.data = self.data[:ntargets]
+    n0 = len(self.offsets)
+    self.invalidate_frame_index()
+    if self.startframes is None:
+      self.startframes = np.zeros(n0,dtype=int)
+      self.endframes = np.zeros(n0,dtype=int)
+    if not reinitialize:
+      if n0 >= ntargets:
+        drop = self.offsets[ntargets:] >= 0
+        self.ngarbage += np.sum(self.seghi[ntargets:][drop]-self.seglo[ntargets:][drop])
+        self.offsets = self.offsets[:ntargets]
+        self.ncols = self.ncols[:ntargets]
+        self.seglo = self.seglo[:ntargets]
+        self.seghi = self.seghi[:ntargets]
         self.startframes = self.startframes[:ntargets]
         self.endframes=self.endframes[:ntargets]
       else:
-        self.data = self.data + [None]*(ntargets-self.ntargets)
-        self.startframes = np.concatenate((self.startframes,-np.ones(ntargets-self.ntargets,dtype=int)),axis=0)
-        self.endframes=np.concatenate((self.endframes,-2+np.zeros(ntargets-self.ntargets,dtype=int)),axis=0)
+        self.offsets = np.concatenate((self.offsets,-np.ones(ntargets-n0,dtype=int)),axis=0)
+        self.ncols = np.concatenate((self.ncols,np.zeros(ntargets-n0,dtype=int)),axis=0)
+        self.seglo = np.concatenate((self.seglo,np.zeros(ntargets-n0,dtype=int)),axis=0)
+        self.seghi = np.concatenate((self.seghi,np.zeros(ntargets-n0,dtype=int)),axis=0)
+        self.startframes = np.concatenate((self.startframes,-np.ones(ntargets-n0,dtype=int)),axis=0)
+        self.endframes=np.concatenate((self.endframes,-2+np.zeros(ntargets-n0,dtype=int)),axis=0)
 
     else:
       self.data = [None]*ntargets
@@ -994,35 +1364,28 @@ class Tracklet:
     self.ntargets = ntargets
     
   def where(self,val):
-    axis_rest = self.axis_rest()
-    fidx = np.zeros(0,dtype=int)
-    tidx = np.zeros(0,dtype=int)
-    for itgt in range(self.ntargets):
-      fidxcurr = np.where(np.all(equals_nan(self.data[itgt],val),axis=axis_rest))[-1]+self.startframes[itgt]
-      tidxcurr = np.zeros(fidxcurr.shape,dtype=int)+itgt
-      fidx = np.concatenate((fidx,fidxcurr),axis=0)
-      tidx = np.concatenate((tidx,tidxcurr),axis=0)
-
-    return tidx,fidx
+    tidx,fidx,cols = self.live_cols()
+    idx = np.all(equals_nan(self.buf[...,cols],val),axis=self.axis_rest())
+    return tidx[idx],fidx[idx]
 
   def where_all(self,nids):
-    nt = self.ntargets
     fidx = [np.zeros(0,dtype=int) for n in range(nids)]
     tidx = [np.zeros(0,dtype=int) for n in range(nids)]
-    if nt>0:
-      axis_rest = self.axis_rest()
-      ss = self.data[0].shape
-      zz = np.array([ss[z] for z in axis_rest])
-      assert np.all(zz==1), 'This is available only for single dim tracklets'
-    for itgt in range(self.ntargets):
-      [a,b] = np.unique(self.data[itgt],return_inverse=True)
-      for n in range(len(a)):
-        curid = a[n]
-        if np.all(equals_nan(curid,self.defaultval)): continue
-        fidxcurr = np.where(b==n)[0]+self.startframes[itgt]
-        tidxcurr =np.zeros(fidxcurr.shape,dtype=int) + itgt
-        fidx[curid] = np.concatenate((fidx[curid],fidxcurr),axis=0)
-        tidx[curid] = np.concatenate((tidx[curid],tidxcurr),axis=0)
+    if self.ntargets == 0:
+      return tidx,fidx
+    assert np.all(np.array(self.size_rest)==1), 'This is available only for single dim tracklets'
+    tidx_all,fidx_all,cols = self.live_cols()
+    vals = self.buf[...,cols].reshape(-1)
+    idx = ~equals_nan(vals,self.defaultval)
+    # stable sort by id keeps each id's entries ordered by target, then frame
+    order = np.argsort(vals[idx],kind='stable')
+    ids = vals[idx][order].astype(int)
+    tidx_all = tidx_all[idx][order]
+    fidx_all = fidx_all[idx][order]
+    bounds = np.searchsorted(ids,np.arange(nids+1))
+    for n in range(nids):
+      tidx[n] = tidx_all[bounds[n]:bounds[n+1]]
+      fidx[n] = fidx_all[bounds[n]:bounds[n+1]]
     return tidx,fidx
   
   def unique(self):
@@ -1031,18 +1394,19 @@ class Tracklet:
     count = 0
     newtrk = Tracklet(defaultval=-1,ntargets=self.ntargets)
     newtrk.allocate((1,),self.startframes,self.endframes)
+    data = self.data
     for itgt in range(self.ntargets):
       for i in range(self.nframes[itgt]):
         t = i + self.startframes[itgt]
-        if np.all(equals_nan(self.data[itgt][...,i],self.defaultval)):
+        if np.all(equals_nan(data[itgt][...,i],self.defaultval)):
           continue
         if uniquevals.size > 0:
-          idxcurr = np.all(equals_nan(self.data[itgt][...,i],uniquevals),axis=axis_rest)
+          idxcurr = np.all(equals_nan(data[itgt][...,i],uniquevals),axis=axis_rest)
           if np.any(idxcurr):
             idxcurr = np.where(idxcurr)[0][0]
             newtrk.settargetframe(idxcurr,itgt,t)
             continue
-        uniquevals = np.append(uniquevals,self.data[itgt][...,i].reshape(self.size_rest+(1,)),axis=len(self.size_rest))
+        uniquevals = np.append(uniquevals,data[itgt][...,i].reshape(self.size_rest+(1,)),axis=len(self.size_rest))
         newtrk.settargetframe(count,itgt,t)
         count += 1
     return uniquevals,newtrk
@@ -1055,11 +1419,11 @@ class Tracklet:
   #   return counts
   
   def replace(self,val0,val1):
-    axis_rest = self.axis_rest()
-    for itgt in range(self.ntargets):
-      idx = np.where(np.all(equals_nan(self.data[itgt],val0),axis=axis_rest))[-1]
-      if idx.size > 0:
-        self.data[itgt][...,idx] = val1 # this might need replicating ... size mismatch?
+    _,_,cols = self.live_cols()
+    idx = np.all(equals_nan(self.buf[...,cols],val0),axis=self.axis_rest())
+    if np.any(idx):
+      self.buf[...,cols[idx]] = val1 # this might need replicating ... size mismatch?
+    self.isconsolidated = False
       
   def real_idx(self,v):
     axis_rest = self.axis_rest()
@@ -1068,53 +1432,68 @@ class Tracklet:
   def apply_ids(self,ids,T0=0):
     _,maxv = ids.get_min_max_val()
     nids = np.max(maxv)+1
-    newdata = [None,]*nids
     newstartframes = np.ones(nids,dtype=int)*-1
     newendframes = np.ones(nids,dtype=int)*-2
-    idx_all = ids.where_all(nids)
-    assert len(idx_all) == 2
+    tidx,fidx = ids.where_all(nids)
+    hasdata = np.zeros(nids,dtype=bool)
     for id in range(nids):
-      # idx = ids.where(id)
-      # assert len(idx) == 2
-      idx = [idx_all[0][id],idx_all[1][id]]
-      if idx[1].size == 0:
+      if fidx[id].size == 0:
         print('target %d has no data, cleaning not run (correctly)'%id)
         continue
-      t0 = np.min(idx[1])
-      t1 = np.max(idx[1])
-      newdata[id] = np.zeros(self.size_rest+(t1-t0+1,),dtype=self.dtype)
-      newdata[id][:] = self.defaultval
-      newstartframes[id] = t0+T0
-      newendframes[id] = t1+T0
-      aa,bb = np.unique(idx[0],return_inverse=True)
-      for ndx,itgt in enumerate(aa):
-        idx1 = bb==ndx
-        fs = idx[1][idx1]
-        newdata[id][...,fs-t0] = self.data[itgt][...,fs-self.startframes[itgt]+T0]
+      hasdata[id] = True
+      newstartframes[id] = np.min(fidx[id])+T0
+      newendframes[id] = np.max(fidx[id])+T0
+    
+    # copy all (id, frame) entries in one go into a freshly packed buffer
+    ncols = np.where(hasdata,newendframes-newstartframes+1,0)
+    offsets = np.cumsum(ncols) - ncols
+    buf = np.zeros(self.buf.shape[:-1]+(int(np.sum(ncols)),),dtype=self.buf.dtype)
+    buf[:] = self.defaultval
+    idv = np.repeat(np.arange(nids,dtype=int),[f.size for f in fidx])
+    tv = np.concatenate(tidx).astype(int)
+    fv = np.concatenate(fidx).astype(int)
+    buf[...,offsets[idv]+fv+T0-newstartframes[idv]] = self.buf[...,self.offsets[tv]+fv+T0-self.startframes[tv]]
         
-    self.data = newdata
+    self.buf = buf
+    self.nbuf = buf.shape[-1]
+    self.ngarbage = 0
+    self.offsets = np.where(hasdata,offsets,-1)
+    self.ncols = ncols
+    self.seglo = offsets
+    self.seghi = offsets + ncols
     self.startframes = newstartframes
     self.endframes = newendframes
     self.ntargets = nids
+    self.isconsolidated = False
+    self.invalidate_frame_index()
 
   def del_short(self, min_len):
     sf = self.startframes
     ef = self.endframes
     to_keep = np.where( (ef-sf)>=min_len)[0]
-    self.data = [self.data[ndx] for ndx in to_keep]
+    drop = np.ones(len(self.offsets),dtype=bool)
+    drop[to_keep] = False
+    drop = np.logical_and(drop,self.offsets >= 0)
+    self.ngarbage += np.sum(self.seghi[drop]-self.seglo[drop])
+    self.offsets = self.offsets[to_keep]
+    self.ncols = self.ncols[to_keep]
+    self.seglo = self.seglo[to_keep]
+    self.seghi = self.seghi[to_keep]
     self.startframes = sf[to_keep]
     self.endframes = ef[to_keep]
     self.ntargets = len(to_keep)
+    self.invalidate_frame_index()
 
     
   def __repr__(self):
     s = '<%s instance at %s\n'%(self.__class__.__name__, id(self))
     s += 'ntargets:%d, T:%d, size:%s, defaultval:%f\n'%(self.ntargets,self.T,str(self.size),self.defaultval)
+    data = self.data
     for itgt in range(self.ntargets):
-      if self.data[itgt] is None:
+      if data[itgt] is None:
         s += 'Target %d: None\n'%itgt
       else:
-        s += 'Target:%d, startframe:%d, endframe:%d, data:%s\n'%(itgt,self.startframes[itgt],self.endframes[itgt],str(self.data[itgt]))
+        s += 'Target:%d, startframe:%d, endframe:%d, data:%s\n'%(itgt,self.startframes[itgt],self.endframes[itgt],str(data[itgt]))
     s+='>'
     return s
   
@@ -1125,6 +1504,237 @@ class Tracklet:
     return data,startframes,endframes
     
 
+class LazyTracklet(Tracklet):
+  """
+  LazyTracklet
+  Tracklet whose data stays in a tracklet or packed-format trk file until it is needed. startframes and endframes
+  are read when it is created, and each target's data is read from the file the first time it is accessed, only
+  for the frames in the window T0 through T1 if one is given. getframe, gettargetframe, gettarget and
+  iter_frames only read the targets they need. All other methods read all the data first, after which this
+  behaves like a regular Tracklet.
+  """
+  
+  @property
+  def data(self):
+    self.load_all()
+    return Tracklet.data.fget(self)
+
+  @data.setter
+  def data(self,data):
+    self.pack(data)
+    self.toload = np.zeros(len(self.offsets),dtype=bool)
+
+  def __init__(self,h5file,key,T0=None,T1=None,defaultval=np.nan,dtype=float):
+    """
+    Constructor.
+    :param h5file: open h5py File for the trk file
+    :param key: which tracking data to load, e.g. 'pTrk' or 'pTrkConf'
+    :param T0, T1: window of frames to load. Default = None: all frames.
+    :param defaultval: default value for sparsifying
+    :param dtype: data type
+    """
+    Tracklet.__init__(self,defaultval=defaultval,dtype=dtype)
+    self.key = key
+    self.fileoffsets = None # row of self.packed with each target's first frame
+    self.open_datasets(h5file)
+    if self.packed is not None:
+      self.fileoffsets = to_py(np.atleast_1d(hdf5_to_py(h5file['offsets'],h5file)).flatten().astype(int))
+      ntargets = len(self.fileoffsets)
+    else:
+      ntargets = len(self.refs)
+    if ntargets > 0:
+      self.filestartframes = to_py(np.atleast_1d(hdf5_to_py(h5file['startframes'],h5file)).flatten().astype(int))
+      self.fileendframes = to_py(np.atleast_1d(hdf5_to_py(h5file['endframes'],h5file)).flatten().astype(int))
+    else:
+      self.filestartframes = np.zeros(0,dtype=int)
+      self.fileendframes = np.zeros(0,dtype=int)
+    startframes = self.filestartframes.copy()
+    endframes = self.fileendframes.copy()
+    if T0 is not None:
+      startframes = np.maximum(startframes,T0)
+    if T1 is not None:
+      endframes = np.minimum(endframes,T1)
+    isempty = endframes < startframes
+    startframes[isempty] = -1
+    endframes[isempty] = -2
+
+    # size of the data, from the first target with data in the file. datasets are stored transposed
+    self.size_rest = (0,0)
+    if self.packed is not None:
+      self.size_rest = tuple(self.packed.shape[1:][::-1])
+    for itgt in range(ntargets if self.refs is not None else 0):
+      ds = h5file[self.refs[itgt]]
+      if ds.attrs.get('Python.Empty',0) != 1 and ds.size > 0:
+        self.size_rest = tuple(ds.shape[1:][::-1])
+        break
+    self.pack([np.zeros(self.size_rest+(0,),dtype=self.dtype) if isempty[itgt] else None for itgt in range(ntargets)])
+    self.startframes = startframes
+    self.endframes = endframes
+    self.ntargets = ntargets
+    self.toload = ~isempty
+
+  def open_datasets(self,h5file):
+    """
+    open_datasets(self,h5file)
+    Set the file and the datasets for self.key that the data is read from.
+    :param h5file: open h5py File for the trk file
+    """
+    self.h5file = h5file
+    self.refs = None # references to each target's dataset, tracklet layout
+    self.packed = None # dataset with all targets' data, packed layout
+    if Tracklet.isPacked(h5file):
+      self.packed = h5file[self.key]
+    else:
+      refs = h5file[self.key]
+      if refs.attrs.get('Python.Empty',0) == 1:
+        self.refs = np.zeros(0,dtype=object)
+      else:
+        self.refs = refs[()].flatten()
+
+  def __getstate__(self):
+    # h5py objects can't be pickled, so only the file name is pickled and the file is reopened when unpickled.
+    # This way, data that has not been read yet is read by the process that uses it, e.g. a linking worker.
+    state = self.__dict__.copy()
+    if self.h5file is not None:
+      state['h5file'] = self.h5file.filename
+      state['refs'] = None
+      state['packed'] = None
+    return state
+
+  def __setstate__(self,state):
+    self.__dict__.update(state)
+    if self.h5file is not None:
+      self.open_datasets(h5py.File(self.h5file,'r'))
+
+  def isalive(self):
+    return np.logical_or(Tracklet.isalive(self),self.toload)
+
+  def load_targets(self,targets):
+    """
+    load_targets(self,targets)
+    Read the data for the input targets from the file, if it has not been read yet.
+    :param targets: Scalar, list, or 1-d array of target indices.
+    :return:
+    """
+    targets = np.atleast_1d(targets).astype(int)
+    targets = np.unique(targets[self.toload[targets]])
+    if targets.size == 0:
+      return
+    n = (self.endframes[targets]-self.startframes[targets]+1).astype(int)
+    self.reserve(int(np.sum(n)))
+    for itgt,ncurr in zip(targets,n):
+      i0 = self.startframes[itgt]-self.filestartframes[itgt]
+      if self.packed is not None:
+        i0 += self.fileoffsets[itgt]
+        x = self.packed[i0:i0+ncurr]
+      else:
+        x = self.h5file[self.refs[itgt]][i0:i0+ncurr]
+      off = self.nbuf
+      self.buf[...,off:off+ncurr] = to_py(x.T,dtype=self.dtype)
+      self.offsets[itgt] = off
+      self.ncols[itgt] = ncurr
+      self.seglo[itgt] = off
+      self.seghi[itgt] = off+ncurr
+      self.nbuf += ncurr
+      self.toload[itgt] = False
+
+  def load_frames(self,T0,T1):
+    """
+    load_frames(self,T0,T1)
+    Read the data for all targets with data in frames T0 through T1 from the file.
+    """
+    if np.any(self.toload):
+      self.load_targets(np.nonzero(self.toload & (self.startframes <= T1) & (self.endframes >= T0))[0])
+
+  def load_all(self):
+    """
+    load_all(self)
+    Read all remaining data from the file. After this, the file is no longer needed.
+    """
+    if self.h5file is None:
+      return
+    isempty = self.endframes < self.startframes
+    if self.packed is not None and np.all(self.toload | isempty) and \
+        np.all((self.startframes == self.filestartframes) & (self.endframes == self.fileendframes) | isempty):
+      # nothing read yet and no window, the dataset is the buffer
+      buf = to_py(self.packed[()].T,dtype=self.dtype).astype(self.dtype)
+      self.setdata_packed(buf,np.where(isempty,-1,self.filestartframes),np.where(isempty,-2,self.fileendframes),
+                          np.where(isempty,0,self.fileoffsets))
+      self.toload[:] = False
+    else:
+      self.load_targets(np.nonzero(self.toload)[0])
+    self.h5file = None
+    self.refs = None
+    self.packed = None
+
+  def alive_targets(self,t):
+    alive = Tracklet.alive_targets(self,t)
+    self.load_targets(alive)
+    return alive
+
+  def getframe(self,fs):
+    fs = np.atleast_1d(fs)
+    if fs.size > 0:
+      self.load_frames(np.min(fs),np.max(fs))
+    return Tracklet.getframe(self,fs)
+
+  def gettargetframe(self,targets,frames):
+    self.load_targets(targets)
+    return Tracklet.gettargetframe(self,targets,frames)
+
+  def iter_frames(self,T0=None,T1=None,chunksize=256):
+    self.load_frames(self.T0 if T0 is None else T0,self.T1 if T1 is None else T1)
+    return Tracklet.iter_frames(self,T0=T0,T1=T1,chunksize=chunksize)
+
+  def getdense(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.getdense(self,*args,**kwargs)
+
+  def settargetframe(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.settargetframe(self,*args,**kwargs)
+
+  def consolidate(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.consolidate(self,*args,**kwargs)
+
+  def set_startendframes(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.set_startendframes(self,*args,**kwargs)
+
+  def allocate(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.allocate(self,*args,**kwargs)
+
+  def get_min_max_val(self):
+    self.load_all()
+    return Tracklet.get_min_max_val(self)
+
+  def setntargets(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.setntargets(self,*args,**kwargs)
+
+  def where(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.where(self,*args,**kwargs)
+
+  def where_all(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.where_all(self,*args,**kwargs)
+
+  def replace(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.replace(self,*args,**kwargs)
+
+  def apply_ids(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.apply_ids(self,*args,**kwargs)
+
+  def del_short(self,*args,**kwargs):
+    self.load_all()
+    return Tracklet.del_short(self,*args,**kwargs)
+
+
 class Trk:
   
   @property
@@ -1176,10 +1786,11 @@ class Trk:
   # endframes = None # 1-d array of last frame for each target
   # nframes = None # 1-d array of number of frames for each target
   
-  def __init__(self,trkfile=None,p=None,size=None,pTrkTS=None,pTrkTag=None,pTrkConf=None,**kwargs):
+  def __init__(self,trkfile=None,p=None,size=None,pTrkTS=None,pTrkTag=None,pTrkConf=None,fields=None,frames=None,lazy=False,**kwargs):
     """
     Constructor.
     :param trkfile: File to load from
+    :param fields, frames, lazy: options for loading from trkfile, see load
     :param p: dense matrix to initialize from.
     :param size: size of data to store, initialize
     :param kwargs: Can set any other attributes this way
@@ -1213,7 +1824,7 @@ class Trk:
         setattr(self,key,val)
     
     if trkfile is not None:
-      self.load(trkfile)
+      self.load(trkfile,fields=fields,frames=frames,lazy=lazy)
     elif p is not None:
       self.setdata(p,pTrkTS=pTrkTS,pTrkTag=pTrkTag,pTrkConf=pTrkConf)
     elif size is not None:
@@ -1303,14 +1914,30 @@ class Trk:
     
     return trk
 
-  def load(self,trkfile):
+  def load(self,trkfile,fields=None,frames=None,lazy=False):
     """
     Load data from file trkfile and convert it to the current objects storage format.
     :param trkfile: Name of file to import from.
+    :param fields: List of trkFields to load, e.g. ['pTrkTS']. Fields not in this list are set to None.
+    Default = None: load all fields.
+    :param frames: (first,last) frames to load. Default = None: load all frames.
+    :param lazy: If True, only read each target's data from the file when it is first accessed, see LazyTracklet.
+    The file is kept open until close() is called, so use the Trk as a context manager or call close() when done.
+    Only tracklet and packed-format files are loaded lazily.
     :return:
     """
     self.trkfile = trkfile
     trk_f = h5py.File(trkfile,'r')
+    if Tracklet.isPacked(trk_f) or \
+        (Tracklet.isTracklet(trk_f) and (lazy or (fields is not None) or (frames is not None))):
+      self.load_tracklet_lazy(trk_f,fields=fields,frames=frames)
+      if not lazy:
+        for k in ['pTrk',]+self.trkFields:
+          if self.__dict__[k] is not None:
+            self.__dict__[k].load_all()
+        trk_f.close()
+      return
+
     trk = hdf5_to_py(trk_f,trk_f)
     trk_f.close()
     #   trk = hdf5storage.loadmat(trkfile,appendmat=False)
@@ -1401,7 +2028,119 @@ class Trk:
         continue
         
       self.trkData[key] = val
-      
+
+    if fields is not None:
+      for k in self.trkFields:
+        if k not in fields:
+          self.__dict__[k] = None
+          self.trkData.pop(k,None)
+    if frames is not None:
+      self.crop_frames(frames[0],frames[1])
+
+  def load_tracklet_lazy(self,trk_f,fields=None,frames=None):
+    """
+    load_tracklet_lazy(self,trk_f,fields=None,frames=None)
+    Set up pTrk and the trkFields as LazyTracklets reading from the open tracklet or packed-format trk file trk_f,
+    and read everything else in the file.
+    :param trk_f: h5py File opened for reading.
+    :param fields: List of trkFields to load. Default = None: all fields.
+    :param frames: (first,last) frames to load. Default = None: all frames.
+    :return:
+    """
+    if frames is None:
+      T0,T1 = None,None
+    else:
+      T0,T1 = frames
+    self.issparse = True
+
+    if 'pTrkFrm' in trk_f.keys():
+      self.T0 = to_py(int(hdf5_to_py(trk_f['pTrkFrm'],trk_f).flatten()[0]))
+    else:
+      self.T0 = 0
+    # T0 stays the file's first frame even when loading a window of frames, the trkFields are indexed relative
+    # to it like in a full load
+
+    self.pTrk = LazyTracklet(trk_f,'pTrk',T0=T0,T1=T1,defaultval=self.defaultval)
+    self.size = self.pTrk.size
+    self.nlandmarks = self.size[0]
+    self.d = self.size[1]
+    self.ntargets = self.pTrk.ntargets
+
+    for k in self.trkFields:
+      if k in trk_f.keys() and (fields is None or k in fields):
+        self.__dict__[k] = LazyTracklet(trk_f,k,T0=T0,T1=T1,defaultval=self.defaultval_dict[k],dtype=self.dtype_dict[k])
+      else:
+        self.__dict__[k] = None
+
+    if 'pTrkiTgt' in trk_f.keys():
+      self.pTrkiTgt = to_py(np.atleast_1d(hdf5_to_py(trk_f['pTrkiTgt'],trk_f)).flatten())
+    else:
+      self.pTrkiTgt = np.arange(self.ntargets,dtype=int)
+    if self.pTrkiTgt.size != self.ntargets:
+      print('pTrkiTgt length does not match number of targets. Setting pTrkiTgt to [0,...,ntargets-1]')
+      self.pTrkiTgt = np.arange(self.ntargets,dtype=int)
+
+    for key in trk_f.keys():
+      if key in ['pTrk','pTrkFrm','pTrkiTgt','startframes','endframes','offsets','#refs#']+self.trkFields:
+        continue
+      self.trkData[key] = hdf5_to_py(trk_f[key],trk_f)
+
+  def crop_frames(self,T0,T1):
+    """
+    crop_frames(self,T0,T1)
+    Remove all data outside of frames T0 through T1.
+    """
+    if self.issparse:
+      startframes = np.maximum(self.pTrk.startframes,T0)
+      endframes = np.minimum(self.pTrk.endframes,T1)
+      isempty = endframes < startframes
+      startframes[isempty] = -1
+      endframes[isempty] = -2
+      for k in ['pTrk',]+self.trkFields:
+        if self.__dict__[k] is not None:
+          self.__dict__[k].set_startendframes(startframes.copy(),endframes.copy())
+    else:
+      i0 = max(T0-self.T0,0)
+      i1 = max(min(T1-self.T0+1,self.T),i0)
+      self.pTrk = self.pTrk[...,i0:i1,:]
+      for k in self.trkFields:
+        if self.__dict__[k] is not None:
+          self.__dict__[k] = self.__dict__[k][...,i0:i1,:]
+      self.T0 += i0
+      self.size = self.pTrk.shape
+
+  def lazy_files(self):
+    """
+    lazy_files(self)
+    Returns the open h5py Files that lazily loaded fields still read from.
+    """
+    files = []
+    for k in ['pTrk',]+self.trkFields:
+      v = self.__dict__[k]
+      if isinstance(v,LazyTracklet) and isinstance(v.h5file,h5py.File) and \
+          not any(f is v.h5file for f in files):
+        files.append(v.h5file)
+    return files
+
+  def close(self):
+    """
+    close(self)
+    Read all data that a lazy load has not read yet and close the trk file, after which the Trk no longer depends
+    on the file, e.g. it can be saved back to the same file.
+    """
+    files = self.lazy_files()
+    for k in ['pTrk',]+self.trkFields:
+      if isinstance(self.__dict__[k],LazyTracklet):
+        self.__dict__[k].load_all()
+    for f in files:
+      f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,tb):
+    self.close()
+
   def save(self,outtrkfile,saveformat=None,consolidate=True,**kwargs):
     """
     Save data in format saveformat to output file outtrkfile.
@@ -1411,6 +2150,10 @@ class Trk:
     :return:
     """
 
+    # h5 can't truncate a file that is still open for lazy reading
+    if any(os.path.realpath(f.filename) == os.path.realpath(outtrkfile) for f in self.lazy_files()):
+      self.close()
+
     if saveformat is None:
       if self.issparse:
         saveformat = 'tracklet'
@@ -1424,6 +2167,8 @@ class Trk:
       self.savesparse(outtrkfile)
     elif saveformat == 'tracklet':
       self.savetracklet(outtrkfile,**kwargs)
+    elif saveformat == 'packed':
+      self.savepacked(outtrkfile,**kwargs)
     else:
       self.savefull(outtrkfile,consolidate=consolidate)
       
@@ -1474,6 +2219,64 @@ class Trk:
 
     hdf5storage.savemat(outtrkfile,trkData,appendmat=False,truncate_existing=True)
       
+  def savepacked(self,outtrkfile,consolidate=False,chunk_frames=4096,compression='gzip',compression_opts=4,**kwargs):
+    """
+    Save data in the packed (v2) tracklet layout to file outtrkfile. Instead of one dataset per target, pTrk and
+    each trkField are saved as one dataset with all targets' data concatenated along frames, which is chunked and
+    compressed. The data for target itgt is in rows offsets[itgt] through offsets[itgt]+endframes[itgt]-startframes[itgt]
+    of each dataset. As in the tracklet layout, offsets, startframes and endframes are 1-indexed and datasets are
+    stored transposed, so in matlab target i is pTrk(:,:,offsets(i):offsets(i)+endframes(i)-startframes(i)).
+    :param outtrkfile: Name of file to save to.
+    :param consolidate: Whether to update startframes and endframes to be tight around non-default value data.
+    :param chunk_frames: number of frames in each HDF5 chunk.
+    :param compression: HDF5 compression filter, e.g. 'gzip' or 'lzf'. None for no compression.
+    :param compression_opts: options for the compression filter, e.g. the gzip level.
+    :return:
+    """
+
+    trkData = self.trkData.copy()
+    trk = self
+    if self.issparse:
+      if consolidate:
+        self.pTrk.consolidate(force=True)
+      T0 = self.T0
+      T1 = T0+self.pTrk.T-1
+    else:
+      T0 = self.T0
+      T1 = self.T + self.T0 - 1
+      trk = self.copy()
+      trk.convert2sparse()
+    trkData['pTrkFrm']=self.pTrkFrm(T0,T1)
+
+    fields = ['pTrk',] + [k for k in self.trkFields if trk.__dict__[k] is not None]
+    data = {}
+    for k in fields:
+      trkData.pop(k,None)
+      if k != 'pTrk':
+        trk.__dict__[k].set_startendframes(trk.pTrk.startframes.copy(),trk.pTrk.endframes.copy())
+      data[k],startframes,endframes,offsets = trk.__dict__[k].getpacked()
+      data[k] = data[k].astype(trk.__dict__[k].dtype,copy=False)
+    trkData['startframes'] = to_mat(startframes)
+    trkData['endframes'] = to_mat(endframes)
+    trkData['offsets'] = to_mat(offsets)
+    trkData['pTrkiTgt'] = to_mat(self.pTrkiTgt)
+    for k in kwargs.keys():
+      trkData[k] = kwargs[k]
+
+    # hdf5storage writes the metadata, the data is added with h5py so we can set the chunking
+    hdf5storage.savemat(outtrkfile,trkData,appendmat=False,truncate_existing=True)
+    with h5py.File(outtrkfile,'a') as h5:
+      for k in fields:
+        x = data[k]
+        shape_rest = x.shape[:-1][::-1]
+        if x.size > 0:
+          h5kwargs = {'maxshape':(None,)+shape_rest,'chunks':(chunk_frames,)+shape_rest,'compression':compression,
+                      'compression_opts':compression_opts,'shuffle':compression is not None}
+        else:
+          h5kwargs = {}
+        ds = h5.create_dataset(k,data=to_mat(x).T.astype(np.uint8 if x.dtype == bool else x.dtype,copy=False),**h5kwargs)
+        TrkWriter.set_mat_attrs(ds,x.dtype,x.shape)
+
   def savesparse(self,outtrkfile):
     """
     Save data in sparse format to file outtrkfile.
@@ -1579,11 +2382,67 @@ class Trk:
     if not extra:
       return p
 
+    # the trkFields share pTrk's startframes, so they are indexed by frame number like pTrk
     for k in self.trkFields:
       if self.__dict__[k] is not None:
-        edict[k] = self.__dict__[k].getframe(fs-self.T0)
+        edict[k] = self.__dict__[k].getframe(fs)
 
     return p,edict
+
+  def iter_frames(self,T0=None,T1=None,extra=False,chunksize=256):
+    """
+    iter_frames(self,T0=None,T1=None,extra=False,chunksize=256)
+    Iterate over frames T0 through T1. For sparse data this sweeps through the frames keeping track of which
+    targets are alive, reading chunksize frames at a time, instead of looking up every target in every frame
+    like calling getframe in a loop does.
+    :param T0: first frame. Default = None: self.T0
+    :param T1: last frame. Default = None: self.T1
+    :param extra: Whether to also return the pTrkTS, pTrkTag, etc data. Default=False.
+    :param chunksize: number of frames to read at a time.
+    :return: generator of (t, p) or, if extra == True, (t, p, edict). p is the same as getframe(t). edict has
+    the trkFields data for frame t.
+    """
+    if T0 is None:
+      T0 = self.T0
+    if T1 is None:
+      T1 = self.T1
+      
+    if not self.issparse:
+      for t in range(T0,T1+1):
+        if extra:
+          p,edict = self.getframe(t,extra=True)
+          yield t,p,edict
+        else:
+          yield t,self.getframe(t)
+      return
+
+    iters = {}
+    if extra:
+      for k in self.trkFields:
+        if self.__dict__[k] is not None:
+          iters[k] = self.__dict__[k].iter_frames(T0,T1,chunksize=chunksize)
+    for t,p in self.pTrk.iter_frames(T0,T1,chunksize=chunksize):
+      if not extra:
+        yield t,p
+        continue
+      edict = {}
+      for k in self.trkFields:
+        edict[k] = None
+        if k in iters:
+          _,edict[k] = next(iters[k])
+      yield t,p,edict
+
+  def alive_targets(self,t):
+    """
+    alive_targets(self,t)
+    Returns the targets that have data in frame t. For sparse data, this uses an index of the tracklet intervals
+    so it does not have to look at every target.
+    :param t: frame number
+    :return: increasing array of target indices
+    """
+    if self.issparse:
+      return self.pTrk.alive_targets(t)
+    return np.nonzero(self.real_idx(self.pTrk[:,:,[t-self.T0],:]).flatten())[0]
     
     # fs = np.atleast_1d(fs)
     #
@@ -2156,6 +3015,300 @@ class Trk:
     s+='\n>'
     return s
   
+class TrkWriter:
+  """
+  Writes a trk file in the tracklet format incrementally, e.g. to save partial results while tracking a movie.
+  Frames are added in order with append(). Only the new frames are written, by extending resizable HDF5
+  datasets, so each save costs O(new frames) instead of rewriting the whole file. The layout is the same as
+  the one written by Trk.savetracklet, so the file can be read with Trk(trkfile) at any point.
+  """
+
+  def __init__(self,outtrkfile,ntargets,T0=0,trkInfo=None,chunk_frames=256):
+    """
+    Creates the trk file outtrkfile for ntargets targets, with the first frame T0.
+    :param trkInfo: dict saved as trkInfo. Values can be updated later with set_info.
+    :param chunk_frames: number of frames in each HDF5 chunk.
+    """
+    self.outtrkfile = outtrkfile
+    self.ntargets = ntargets
+    self.T0 = T0
+    self.T = 0
+    self.chunk_frames = chunk_frames
+    self.startframes = -np.ones(ntargets,dtype=int)
+    self.endframes = -2*np.ones(ntargets,dtype=int)
+    self.fields = None # names of the stored data, set on the first append
+    self.datasets = {}
+    # data for the frames after each target's last prediction. It is written if the target has a prediction later on.
+    # The tails are copies of the target's own data, so they don't keep the appended trks in memory.
+    self.tails = [[] for _ in range(ntargets)]
+
+    # hdf5storage writes the matlab header and the metadata. Data is added with h5py.
+    trkData = {'pTrkiTgt':to_mat(np.arange(ntargets,dtype=int))}
+    if trkInfo is not None:
+      trkData['trkInfo'] = trkInfo
+    hdf5storage.savemat(outtrkfile,trkData,appendmat=False,truncate_existing=True)
+    self.h5 = h5py.File(outtrkfile,'a')
+    self.refs = self.h5.require_group('#refs#')
+
+    ds = self.h5.create_dataset('pTrkFrm',shape=(0,1),maxshape=(None,1),dtype=np.int64,chunks=(chunk_frames,1))
+    TrkWriter.set_mat_attrs(ds,np.int64,(1,0))
+    for k in ['startframes','endframes']:
+      ds = self.h5.create_dataset(k,data=to_mat(self.__dict__[k]).reshape(-1,1))
+      TrkWriter.set_mat_attrs(ds,np.int64,(ntargets,))
+
+  @staticmethod
+  def set_mat_attrs(ds,dtype,shape):
+    """
+    Sets the attributes that hdf5storage uses for numpy arrays, so that matlab and hdf5storage can read ds.
+    """
+    dtype = np.dtype(dtype)
+    ds.attrs['MATLAB_class'] = np.bytes_('logical' if dtype == bool else 'double' if dtype == float else dtype.name)
+    if dtype == bool:
+      ds.attrs['MATLAB_int_decode'] = np.int64(1)
+    ds.attrs['Python.Shape'] = np.array(shape,dtype=np.uint64)
+    ds.attrs['Python.Type'] = np.bytes_('numpy.ndarray')
+    ds.attrs['Python.numpy.Container'] = np.bytes_('ndarray')
+    ds.attrs['Python.numpy.UnderlyingType'] = np.bytes_(dtype.name)
+
+  @staticmethod
+  def create_target_dataset(refs,name,shape_rest,dtype,chunk_frames):
+    """
+    Creates the resizable dataset in group refs for one target's data, with no frames. Data is stored in matlab
+    order, with frames in the first dimension.
+    """
+    ds = refs.create_dataset(name,shape=(0,)+shape_rest[::-1],maxshape=(None,)+shape_rest[::-1],
+                             chunks=(chunk_frames,)+shape_rest[::-1],dtype=np.uint8 if dtype == bool else dtype)
+    TrkWriter.set_mat_attrs(ds,dtype,shape_rest+(0,))
+    ds.attrs['H5PATH'] = np.bytes_('/#refs#')
+    return ds
+
+  @staticmethod
+  def create_cell(h5,k,datasets):
+    """
+    Creates dataset k in h5 as a cell array with references to the per target datasets.
+    """
+    cell = h5.create_dataset(k,shape=(len(datasets),1),dtype=h5py.ref_dtype)
+    cell[:,0] = [ds.ref for ds in datasets]
+    cell.attrs['MATLAB_class'] = np.bytes_('cell')
+    cell.attrs['Python.Shape'] = np.array([len(datasets)],dtype=np.uint64)
+    cell.attrs['Python.Type'] = np.bytes_('list')
+    cell.attrs['Python.numpy.Container'] = np.bytes_('ndarray')
+    cell.attrs['Python.numpy.UnderlyingType'] = np.bytes_('object')
+
+  def create_datasets(self,trk):
+    self.fields = ['pTrk'] + [k for k in trk.trkFields if trk.__dict__[k] is not None]
+    for k in self.fields:
+      x = trk.__dict__[k]
+      self.datasets[k] = [TrkWriter.create_target_dataset(self.refs,f'{k}_{itgt}',x.shape[:-2],x.dtype,self.chunk_frames)
+                          for itgt in range(self.ntargets)]
+      TrkWriter.create_cell(self.h5,k,self.datasets[k])
+
+  def append(self,trk):
+    """
+    append(self,trk)
+    Appends the frames in dense Trk trk, which must start at the frame after the last frame written.
+    As in savetracklet, each target's tracklet spans from its first to its last frame with a prediction.
+    """
+    assert not trk.issparse, 'Only dense trks can be appended'
+    assert trk.T0 == self.T0+self.T, f'Expected frame {self.T0+self.T}, got {trk.T0}'
+    assert trk.ntargets == self.ntargets
+    if self.fields is None:
+      self.create_datasets(trk)
+    isreal = ~np.all(equals_nan(trk.pTrk,trk.defaultval),axis=(0,1))
+    data = {}
+    for k in self.fields:
+      data[k] = trk.__dict__[k]
+      if data[k] is None:
+        data[k] = np.zeros(self.datasets[k][0].shape[:0:-1]+trk.pTrk.shape[2:],dtype=bool if self.datasets[k][0].dtype == np.uint8 else self.datasets[k][0].dtype)
+        data[k][:] = trk.defaultval_dict[k]
+
+    for itgt in range(self.ntargets):
+      idx = np.nonzero(isreal[:,itgt])[0]
+      started = self.startframes[itgt] >= 0
+      if idx.size == 0:
+        if started:
+          self.tails[itgt].append({k: data[k][...,itgt].copy() for k in self.fields})
+        continue
+      if not started:
+        self.startframes[itgt] = trk.T0 + idx[0]
+      f0 = idx[0] if not started else 0
+      n0 = max(0,self.endframes[itgt]-self.startframes[itgt]+1)
+      for k in self.fields:
+        block = np.concatenate([tail[k] for tail in self.tails[itgt]]+[data[k][...,f0:idx[-1]+1,itgt]],axis=-1)
+        ds = self.datasets[k][itgt]
+        n1 = n0+block.shape[-1]
+        ds.resize(n1,axis=0)
+        ds[n0:n1] = to_mat(block).T
+        ds.attrs['Python.Shape'] = np.array(block.shape[:-1]+(n1,),dtype=np.uint64)
+      self.tails[itgt] = [{k: data[k][...,idx[-1]+1:,itgt].copy() for k in self.fields}]
+      self.endframes[itgt] = trk.T0+idx[-1]
+
+    self.T += trk.T
+    ds = self.h5['pTrkFrm']
+    n0 = ds.shape[0]
+    ds.resize(self.T,axis=0)
+    ds[n0:,0] = to_mat(np.arange(self.T0+n0,self.T0+self.T))
+    ds.attrs['Python.Shape'] = np.array([1,self.T],dtype=np.uint64)
+    self.h5['startframes'][:,0] = to_mat(self.startframes)
+    self.h5['endframes'][:,0] = to_mat(self.endframes)
+    self.h5.flush()
+
+  def set_info(self,key,val):
+    """
+    Updates the value of a scalar in trkInfo that was given when the file was created. Nested values are
+    specified using / e.g., set_info('part/next_frame',10)
+    """
+    self.h5['trkInfo/'+key][...] = val
+    self.h5.flush()
+
+  def remove_info(self,key):
+    """
+    Removes the top level value key from trkInfo, along with its entry in the struct field names that hdf5storage
+    writes, e.g. to drop progress records once the file is complete.
+    """
+    g = self.h5['trkInfo']
+    if key not in g:
+      return
+    del g[key]
+    names = [str(n) for n in g.attrs['Python.Fields']]
+    keep = [i for i,n in enumerate(names) if n != key]
+    g.attrs['Python.Fields'] = np.array([names[i] for i in keep],dtype=object)
+    mat_fields = np.empty(len(keep),dtype=object)
+    mat_fields[:] = [g.attrs['MATLAB_fields'][i] for i in keep]
+    g.attrs.create('MATLAB_fields',data=mat_fields,dtype=h5py.vlen_dtype(np.dtype('S1')))
+    # newer versions of hdf5storage also record the type of each key
+    if 'Python.dict.key_str_types' in g.attrs:
+      key_types = g.attrs['Python.dict.key_str_types'].decode()
+      g.attrs['Python.dict.key_str_types'] = np.bytes_(''.join(key_types[i] for i in keep))
+    self.h5.flush()
+
+  def close(self):
+    if self.h5 is not None:
+      self.h5.close()
+      self.h5 = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,tb):
+    self.close()
+
+
+class TrackletWriter:
+  """
+  Writes a trk file in the tracklet format one target at a time, e.g. the tracklets that
+  link_trajectories.OnlineLinker links while a movie is being tracked. Unlike TrkWriter, the number of targets
+  does not have to be known in advance. Targets are added with add_target() and their data is appended in blocks
+  of frames with append(), so only the data that has not been written yet has to be kept in memory. startframes,
+  endframes and the cell arrays that point to each target's data are written by close(), after which the file
+  can be read with Trk(trkfile).
+  """
+
+  def __init__(self,outtrkfile,T0=0,trkInfo=None,chunk_frames=256):
+    """
+    Creates the trk file outtrkfile for tracking that starts at frame T0.
+    :param trkInfo: dict saved as trkInfo.
+    :param chunk_frames: number of frames in each HDF5 chunk.
+    """
+    self.outtrkfile = outtrkfile
+    self.T0 = T0
+    self.chunk_frames = chunk_frames
+    self.startframes = []
+    self.endframes = []
+    self.fields = None # names of the stored data, set by set_fields
+    self.shapes = {} # size_rest and dtype of each field
+    self.datasets = {}
+
+    # hdf5storage writes the matlab header and the metadata. Data is added with h5py.
+    trkData = {}
+    if trkInfo is not None:
+      trkData['trkInfo'] = trkInfo
+    hdf5storage.savemat(outtrkfile,trkData,appendmat=False,truncate_existing=True)
+    self.h5 = h5py.File(outtrkfile,'a')
+    self.refs = self.h5.require_group('#refs#')
+
+  @property
+  def ntargets(self):
+    return len(self.startframes)
+
+  def set_fields(self,data):
+    """
+    set_fields(self,data)
+    Sets the stored fields from data, a dict with the data for pTrk and the trkFields to store, each of size
+    size_rest x nframes. Called by the first append, and needs to be called explicitly only if no data is appended.
+    """
+    self.fields = ['pTrk'] + [k for k in data if k != 'pTrk' and data[k] is not None]
+    for k in self.fields:
+      self.shapes[k] = (data[k].shape[:-1],data[k].dtype)
+      self.datasets[k] = []
+    for itgt in range(self.ntargets):
+      self.create_target(itgt)
+
+  def create_target(self,itgt):
+    for k in self.fields:
+      shape_rest,dtype = self.shapes[k]
+      self.datasets[k].append(TrkWriter.create_target_dataset(self.refs,f'{k}_{itgt}',shape_rest,dtype,self.chunk_frames))
+
+  def add_target(self,startframe):
+    """
+    itgt = add_target(self,startframe)
+    Adds a target whose first frame is startframe. Returns the index of the new target.
+    """
+    itgt = self.ntargets
+    self.startframes.append(startframe)
+    self.endframes.append(startframe-1)
+    if self.fields is not None:
+      self.create_target(itgt)
+    return itgt
+
+  def append(self,itgt,data):
+    """
+    append(self,itgt,data)
+    Appends the data for target itgt for the frames after the last frame written for it. data is a dict with the
+    data for pTrk and the trkFields, each of size size_rest x nframes.
+    """
+    if self.fields is None:
+      self.set_fields(data)
+    n0 = self.endframes[itgt]-self.startframes[itgt]+1
+    n1 = n0+data['pTrk'].shape[-1]
+    for k in self.fields:
+      ds = self.datasets[k][itgt]
+      ds.resize(n1,axis=0)
+      ds[n0:n1] = to_mat(data[k]).T
+      ds.attrs['Python.Shape'] = np.array(self.shapes[k][0]+(n1,),dtype=np.uint64)
+    self.endframes[itgt] += n1-n0
+
+  def close(self,T1=None):
+    """
+    close(self,T1=None)
+    Writes the per target metadata and closes the file.
+    :param T1: Last frame that was tracked. Default: last frame of any target.
+    """
+    if self.h5 is None:
+      return
+    if self.fields is None:
+      self.set_fields({'pTrk':np.zeros((0,0,0))})
+    if T1 is None:
+      T1 = max(self.endframes,default=self.T0-1)
+    for k in self.fields:
+      TrkWriter.create_cell(self.h5,k,self.datasets[k])
+    for k in ['startframes','endframes']:
+      ds = self.h5.create_dataset(k,data=to_mat(np.array(self.__dict__[k],dtype=int)).reshape(-1,1))
+      TrkWriter.set_mat_attrs(ds,np.int64,(self.ntargets,))
+    ds = self.h5.create_dataset('pTrkiTgt',data=to_mat(np.arange(self.ntargets,dtype=int)).reshape(-1,1))
+    TrkWriter.set_mat_attrs(ds,np.int64,(self.ntargets,))
+    ds = self.h5.create_dataset('pTrkFrm',data=to_mat(np.arange(self.T0,T1+1,dtype=np.int64)).reshape(-1,1))
+    TrkWriter.set_mat_attrs(ds,np.int64,(1,T1-self.T0+1))
+    self.h5.close()
+    self.h5 = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,tb):
+    self.close()
+
+
 def test_Trk_class():
   """
   Driver: test Trk class loading, data access, and conversion.
@@ -2691,6 +3844,59 @@ def save_trk(outtrkfile,trk):
   
   hdf5storage.savemat(outtrkfile,newtrk,appendmat=False,truncate_existing=True)
 
+def convert_trk_layout(intrkfile,outtrkfile,saveformat='packed',**kwargs):
+  """
+  convert_trk_layout(intrkfile,outtrkfile,saveformat='packed',**kwargs)
+  Convert trk file intrkfile to the layout saveformat, e.g. from the tracklet layout to the packed (v2) layout or
+  back. The layout of intrkfile is detected when it is loaded.
+  :param saveformat: 'packed' or 'tracklet'
+  :param kwargs: passed on to Trk.save, e.g. chunk_frames and compression for the packed layout.
+  :return:
+  """
+  trk = Trk(intrkfile)
+  trk.save(outtrkfile,saveformat=saveformat,**kwargs)
+
+def merge_trks(trks):
+  """
+  merge_trks(trks)
+  Merges dense Trk objects that hold the same landmarks and targets for different frames of a movie,
+  e.g. parts of a movie tracked in separate processes, into a single dense Trk spanning all of them.
+  Frames present in more than one trk are taken from the later one in the list. Frames that are not
+  in any trk, and fields that are missing in some of the trks, are set to the default values.
+  :param trks: list of dense Trk objects
+  :return:
+  trk: merged Trk object
+  """
+  assert len(trks) > 0, 'No trks to merge'
+  ref = trks[0]
+  for trk in trks:
+    assert not trk.issparse, 'Only dense trks can be merged'
+    assert (trk.nlandmarks,trk.d,trk.ntargets) == (ref.nlandmarks,ref.d,ref.ntargets), 'Trks to merge must have the same landmarks and targets'
+  T0 = min([trk.T0 for trk in trks])
+  T = max([trk.T1 for trk in trks]) - T0 + 1
+
+  p = np.zeros((ref.nlandmarks,ref.d,T,ref.ntargets),dtype=ref.pTrk.dtype)
+  p[:] = ref.defaultval
+  for trk in trks:
+    p[:,:,trk.T0-T0:trk.T1-T0+1,:] = trk.pTrk
+
+  kwargs = {}
+  for k in ref.trkFields:
+    vals = [trk.__dict__[k] for trk in trks if trk.__dict__[k] is not None]
+    if len(vals) == 0:
+      continue
+    # fields are nlandmarks x T x ntargets
+    x = np.zeros(vals[0].shape[:1]+(T,)+vals[0].shape[2:],dtype=vals[0].dtype)
+    x[:] = ref.defaultval_dict[k]
+    for trk in trks:
+      if trk.__dict__[k] is not None:
+        x[:,trk.T0-T0:trk.T1-T0+1,...] = trk.__dict__[k]
+    kwargs[k] = x
+
+  newtrk = Trk()
+  newtrk.setdata_dense(p,T0=T0,**kwargs)
+  return newtrk
+
 def test_sparse_load():
   
   """
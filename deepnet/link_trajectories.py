@@ -6,7 +6,9 @@ import APT_interface as apt
 import logging
 import os
 import scipy
+import scipy.sparse
 import pickle
+import hashlib
 
 # for now I'm just using loadmat and savemat here
 # when/if the format of trk files changes, then this will need to get fancier
@@ -20,7 +22,9 @@ import PoseTools
 import movies
 import tempfile
 import copy
+import contextlib
 import multiprocessing as mp
+from multiprocessing import shared_memory
 from tqdm.contrib.concurrent import process_map
 import hdf5storage
 
@@ -34,6 +38,10 @@ import scipy.spatial.distance as ssd
 from scipy.cluster.hierarchy import linkage, dendrogram, fcluster
 from torch.utils.data import Dataset,DataLoader
 
+# match_frame checks for a mutual best match (see match_mutual_best) before using the Hungarian algorithm when at
+# least this many animals are detected in both frames. For fewer, linear_sum_assignment is faster than the check.
+MUTUAL_BEST_MIN_N = 24
+
 def angle_span(pcurr,pnext):
   z = pcurr-pnext
   y = np.linalg.norm(z,axis=1)
@@ -105,35 +113,38 @@ def match_frame(pcurr, pnext, idscurr, params, lastid=np.nan, maxcost=None, forc
   C[ncurr:, nnext:] = 0
   pcurr = np.reshape(pcurr, (d * nlandmarks, ncurr, 1))
   pnext = np.reshape(pnext, (d * nlandmarks, 1, nnext))
-  C1 = np.nanmean(np.abs(pcurr-pnext), axis=0)*2
+  D = np.abs(pcurr-pnext)
+  isnan = np.isnan(D).any()
+  # nanmean is much slower than mean, only use it if needed
+  C1 = (np.nanmean(D, axis=0) if isnan else np.mean(D, axis=0))*2
   C[:ncurr, :nnext] = np.reshape(C1, (ncurr, nnext))
 
   strict_match_thres = params['strict_match_thres']
 
-  if not force_match:
+  if ncurr > 0 and nnext > 0:
+    # For each detection, which detections in the other frame cost less than strict_match_thres times its lowest
+    # cost. fmin ignores nans, rows or columns that are all nan have nan thresholds and so never match.
+    thres_curr = np.minimum(np.fmin.reduce(C1,axis=1)+0.0001,maxcost/2)*strict_match_thres
+    ismatch_curr = C1 < thres_curr[:,None]
+    nmatch_curr = np.count_nonzero(ismatch_curr,axis=1)
+    thres_next = np.minimum(np.fmin.reduce(C1,axis=0)+0.0001,maxcost/2)*strict_match_thres
+    ismatch_next = C1 < thres_next[None,:]
+    nmatch_next = np.count_nonzero(ismatch_next,axis=0)
+  else:
+    ismatch_curr = ismatch_next = nmatch_curr = nmatch_next = None
+
+  if not force_match and ncurr > 0 and nnext > 0 and (np.any(nmatch_curr > 1) or np.any(nmatch_next > 1)):
     # Don't do the ratio to second lowest match if force_match is on. This is used when estimating the maxcost parameter.
 
     # If a current detection has 2 matches then break the tracklet
-    for x1 in range(ncurr):
-      if np.all(np.isnan(C1[x1, :])): continue
-      x1_min = np.nanargmin(C1[x1, :])
-      c1 = C1[x1,x1_min]+0.0001
-      c1 = min(c1,maxcost/2)
-      x2 = np.where(C1[x1,:]< c1*strict_match_thres)[0]
-      if x2.size>1:
-        C[x1, :nnext] = maxcost*2
-        C[:ncurr,x2] = maxcost*2
-
+    isamb_curr = nmatch_curr > 1
     # If a next detection has 2 matches then break the tracklet
-    for x1 in range(nnext):
-      if np.all(np.isnan(C1[:,x1])): continue
-      x1_min = np.nanargmin(C1[:,x1])
-      c1 = C1[x1_min,x1] + 0.0001
-      c1 = min(c1,maxcost/2)
-      x2 = np.where(C1[:,x1]< c1*strict_match_thres)[0]
-      if x2.size>1:
-        C[:ncurr,x1] = maxcost*2
-        C[x2,:nnext] = maxcost*2
+    isamb_next = nmatch_next > 1
+
+    breakcurr = isamb_curr | np.any(ismatch_next[:,isamb_next],axis=1)
+    breaknext = isamb_next | np.any(ismatch_curr[isamb_curr,:],axis=0)
+    C[np.nonzero(breakcurr)[0],:nnext] = maxcost*2
+    C[:ncurr,np.nonzero(breaknext)[0]] = maxcost*2
 
     # for x1 in range(ncurr):
     #   for x2 in range(nnext):
@@ -150,7 +161,11 @@ def match_frame(pcurr, pnext, idscurr, params, lastid=np.nan, maxcost=None, forc
 
   # match
   #print('C:', C)
-  idxcurr, idxnext = opt.linear_sum_assignment(C)
+  idxcurr = None
+  if ncurr == nnext and ncurr >= MUTUAL_BEST_MIN_N and not isnan:
+    idxcurr, idxnext = match_mutual_best(C1, ismatch_curr, ismatch_next, nmatch_curr, nmatch_next, maxcost)
+  if idxcurr is None:
+    idxcurr, idxnext = opt.linear_sum_assignment(C)
 
   costs = C[idxcurr, idxnext]
   cost = np.sum(costs)
@@ -177,6 +192,32 @@ def match_frame(pcurr, pnext, idscurr, params, lastid=np.nan, maxcost=None, forc
   
   return idsnext, lastid, cost, costs
 
+def match_mutual_best(C1, ismatch_curr, ismatch_next, nmatch_curr, nmatch_next, maxcost):
+  """
+  match_mutual_best(C1, ismatch_curr, ismatch_next, nmatch_curr, nmatch_next, maxcost)
+  Fast path for match_frame in the common case that the same number n of animals is detected in both frames and
+  each animal's detection in the next frame is clearly the closest. If each current detection has exactly one
+  match (see match_frame), which has exactly one match back, and all these matches cost < maxcost, then each
+  matched cost is the unique minimum of its row and column, and matching them is the unique optimal assignment,
+  so the Hungarian algorithm isn't needed. (Half of each row's and each column's matched cost is a feasible dual
+  solution with the same value.) None of these detections are ambiguous, so C1 is the cost matrix.
+  Inputs:
+  C1: n x n matching costs
+  ismatch_curr, ismatch_next: n x n, matches for each current and each next detection
+  nmatch_curr, nmatch_next: n, number of matches for each current and each next detection
+  Outputs:
+  idxcurr, idxnext: the assignment in the format returned by scipy.optimize.linear_sum_assignment, or None, None
+  if the fast path doesn't apply.
+  """
+  n = C1.shape[0]
+  if np.count_nonzero(nmatch_curr == 1) != n or np.count_nonzero(nmatch_next == 1) != n or \
+      not np.array_equal(ismatch_curr, ismatch_next):
+    return None, None
+  if np.count_nonzero(C1[ismatch_curr] < maxcost) != n:
+    return None, None
+  # dummy rows are matched to dummy columns at 0 cost
+  return np.arange(2*n), np.concatenate((np.argmax(ismatch_curr, axis=1), np.arange(n, 2*n)))
+
 def assign_ids(trk, params, T=np.inf):
   """
   assign_ids(trk,params)
@@ -217,8 +258,7 @@ def assign_ids(trk, params, T=np.inf):
   
   set_default_params(params)
   
-  for t in tqdm(range(trk.T0, T1+1)):
-    pnext = trk.getframe(t)
+  for t,pnext in tqdm(trk.iter_frames(trk.T0, T1),total=T):
     idxnext = trk.real_idx(pnext)
     pnext = pnext[:, :, idxnext]
     idsnext, lastid, costs[t-1-trk.T0], _ = \
@@ -387,7 +427,7 @@ def assign_recognize_ids(trk, idcosts, params, T=np.inf):
   nlast[:] = params['maxframes_missed']
   pnext = pcurr
   
-  for t in tqdm(range(trk.T0+1, T1+1)):
+  for t,pnext_t in tqdm(trk.iter_frames(trk.T0+1, T1),total=T-1):
     
     # set pcurr based on pnext and idsnext from previous time point
     pcurr[:,:,idsnext[idsnext>=0]] = pnext[:,:,idsnext>=0]
@@ -398,7 +438,7 @@ def assign_recognize_ids(trk, idcosts, params, T=np.inf):
     pcurr[:,:,nlast>params['maxframes_missed']] = np.nan
 
     # read in the next frame positions
-    pnext = trk.getframe(t)
+    pnext = pnext_t
     isnext = trk.real_idx(pnext)
     pnext = pnext[:, :, isnext]
     # main matching
@@ -632,17 +672,37 @@ def estimate_motion_stats(trk,st,en):
   return vel_mag_eps
 
 
-def estimate_maxcost(trks, params, params_in=None, nsample=1000, nframes_skip=1):
+def estimate_maxcost(trks, params, params_in=None, nsample=1000, nframes_skip=1, pool=None):
+  """
+  maxcost = estimate_maxcost(trks, params, params_in=None, nsample=1000, nframes_skip=1, pool=None)
+  Estimate the threshold for the maximum cost for matching identities from the costs of all the trks.
+  :param trks: Trk object or list of Trk objects
+  :param pool: multiprocessing pool. If not None, the costs of each trk are computed in a separate process.
+  Returns threshold on cost.
+  """
   if type(trks) not in [list,tuple]:
     trks = [trks]
   if params_in is not None:
     params.update(params_in)
 
-  allcosts = []
-  for trk in trks:
-    allcosts.append(estimate_maxcost_ind(trk, params, nsample=nsample, nframes_skip=nframes_skip))
+  if pool is None:
+    allcosts = []
+    for trk in trks:
+      allcosts.append(estimate_maxcost_ind(trk, params, nsample=nsample, nframes_skip=nframes_skip))
+  else:
+    allcosts = pool.starmap(estimate_maxcost_ind, [(trk, params, nsample, nframes_skip) for trk in trks], chunksize=1)
   allcosts = np.concatenate(allcosts,axis=0)
+  return maxcost_from_costs(allcosts, params, nframes_skip=nframes_skip)
+
 
+def maxcost_from_costs(allcosts, params, nframes_skip=1):
+  """
+  maxcost = maxcost_from_costs(allcosts, params, nframes_skip=1)
+  Converts the sampled assignment costs to a threshold on cost using params['maxcost_heuristic'].
+  :param allcosts: 1D array of assignment costs from estimate_maxcost_ind
+  :param nframes_skip: Number of frames skipped when computing the costs, only used for logging.
+  Returns threshold on cost.
+  """
   mult = params['maxcost_mult']
   heuristic = params['maxcost_heuristic']
   prctile = params['maxcost_prctile']
@@ -766,7 +826,7 @@ def estimate_maxcost_ind(trk, params, nsample=1000, nframes_skip=1):
   #         logging.info('i = %d, t = %d, nmiss = %d, ncurr = %d, nnext = %d, costs removed: %s'%(i,t,nmiss,ntargets_curr,ntargets_next,str(sortedcosts[:nmiss])))
 
 
-def estimate_maxcost_missed(trk, params, nsample=1000):
+def estimate_maxcost_missed(trk, params, nsample=1000, pool=None):
   """
   maxcost_missed = estimate_maxcost_missed(trk,maxframes_missednsample=1000,prctile=95.,mult=None, heuristic='secondorder')
   Estimate the threshold for the maximum cost for matching identities across > 1 frame.
@@ -782,13 +842,24 @@ def estimate_maxcost_missed(trk, params, nsample=1000):
   :param heuristic: How to convert statistics of costs to a threshold.
   Options: 'secondorder' (Mayank's heuristic), 'prctile' (Kristin's heuristic).
   Default: 'secondorder'.
+  :param pool: multiprocessing pool. If not None, the costs for each trk and number of frames skipped are computed in parallel.
   Returns np.ndarray containing threshold on cost for each number of frames missed.
   """
 
   maxframes_missed = params['maxcost_framesfit']
   maxcost_missed = np.zeros(maxframes_missed)
-  for nframes_skip in range(2, maxframes_missed+2):
-    maxcost_missed[nframes_skip-2] = estimate_maxcost(trk, params,  nframes_skip=nframes_skip, nsample=nsample)
+  if pool is None:
+    for nframes_skip in range(2, maxframes_missed+2):
+      maxcost_missed[nframes_skip-2] = estimate_maxcost(trk, params,  nframes_skip=nframes_skip, nsample=nsample)
+    return maxcost_missed
+
+  # one job per trk and number of frames skipped. starmap keeps the order so the result is the same as above.
+  trks = trk if type(trk) in [list,tuple] else [trk]
+  skips = range(2, maxframes_missed+2)
+  allcosts = pool.starmap(estimate_maxcost_ind, [(cur_trk, params, nsample, nframes_skip) for nframes_skip in skips for cur_trk in trks], chunksize=1)
+  for ndx, nframes_skip in enumerate(skips):
+    curcosts = np.concatenate(allcosts[ndx*len(trks):(ndx+1)*len(trks)],axis=0)
+    maxcost_missed[nframes_skip-2] = maxcost_from_costs(curcosts, params, nframes_skip=nframes_skip)
   return maxcost_missed
 
 
@@ -1012,8 +1083,12 @@ def merge_ids(id1, id2, t0s, t1s, ids):
   return use_ndx
 
 
-def motion_link(trk,ids,T,t0s,t1s,params):
-
+def motion_link_stats(trk,ids,T):
+  """
+  vel_mag_eps, pred_error_thresh = motion_link_stats(trk,ids,T)
+  Estimates the thresholds used by check_motion_link from the constant velocity prediction errors of the ids
+  over 200 random windows of 3 frames.
+  """
   mpred_stats = []
   for ndx in range(200):
     ix = np.random.randint(int(T) - 3)
@@ -1032,6 +1107,12 @@ def motion_link(trk,ids,T,t0s,t1s,params):
   mpred_stats = np.array(mpred_stats)
   vel_mag_eps = np.percentile(mpred_stats[:, 0], 90)
   pred_error_thresh = np.percentile(mpred_stats[:, 1] / (mpred_stats[:, 0] + vel_mag_eps), 90)
+  return vel_mag_eps, pred_error_thresh
+
+
+def motion_link(trk,ids,T,t0s,t1s,params):
+
+  vel_mag_eps, pred_error_thresh = motion_link_stats(trk,ids,T)
 
   cur_ndx = 0
   mcount = 0
@@ -1177,6 +1258,200 @@ def link_pure(trk, conf, do_delete_short=False):
 
   return l_trk
 
+class OnlineLinker(object):
+  """
+  Pure linking (see link_pure) of the predictions for a movie while it is being tracked. Frames are added in
+  order with append() and the linked tracklets are written to a TrkFile.TrackletWriter. As in assign_ids,
+  detections in consecutive frames are matched with match_frame, and as in motion_link, a tracklet that ends in
+  a frame is joined to one that starts in the next frame if the motion of either predicts the other. Whether a
+  tracklet is joined to an earlier one is known one frame after it starts, so only the frames since then are
+  kept. Each tracklet's data is written in blocks of at most flush_frames frames and once it ends, so memory
+  does not grow with the length of the movie.
+  maxcost and the motion statistics are estimated from the first nframes_estimate frames rather than from the
+  whole movie, so for movies shorter than that the output is the same as that of link_pure.
+  """
+
+  def __init__(self, conf, writer, nframes_estimate=1000, flush_frames=256):
+    """
+    :param conf: poseConfig.config
+    :param writer: TrkFile.TrackletWriter to write the linked tracklets to. It is closed by close().
+    :param nframes_estimate: number of frames to estimate the linking parameters from.
+    :param flush_frames: maximum number of frames of a tracklet kept in memory before they are written.
+    """
+    self.params = get_default_params(conf)
+    self.params['maxframes_delete'] = conf.link_id_min_tracklet_len
+    self.writer = writer
+    self.nframes_estimate = nframes_estimate
+    self.flush_frames = flush_frames
+    self.estimate_trks = [] # dense trks added before the parameters are estimated
+    self.next_frame = None # frame the next trk must start at
+    self.fields = None # pTrk and the trkFields that are written
+    self.pcurr = None # detections in the last frame that was matched
+    self.idscurr = None
+    self.lastid = 0
+    self.frame = None # frame whose ids are not final yet: (t, ids, data)
+    self.tracklets = {} # tracklet id -> dict with t0, t1, the first two detections and the output target
+    self.targets = {} # output target -> dict with the data not written yet and the last two detections
+    self.vel_mag_eps = None
+    self.pred_error_thresh = None
+
+  def append(self, trk):
+    """
+    append(self, trk)
+    Adds the frames in dense Trk trk, which must start at the frame after the last frame added.
+    """
+    assert not trk.issparse, 'Only dense trks can be linked online'
+    assert self.next_frame is None or trk.T0 == self.next_frame, f'Expected frame {self.next_frame}, got {trk.T0}'
+    if self.fields is None:
+      self.fields = ['pTrk'] + [k for k in trk.trkFields if trk.__dict__[k] is not None]
+      self.writer.set_fields({k: trk.__dict__[k][...,0,:0] for k in self.fields})
+    self.next_frame = trk.T0 + trk.T
+    if self.vel_mag_eps is not None:
+      for t, ids, data in self.match_frames(trk):
+        self.add_frame(t, ids, data)
+      return
+
+    self.estimate_trks.append(trk)
+    if sum(cur_trk.T for cur_trk in self.estimate_trks) >= self.nframes_estimate:
+      self.estimate_params()
+
+  def estimate_params(self):
+    """
+    Estimates maxcost and the motion statistics from the frames added so far, as link_pure does for the whole movie,
+    and links these frames.
+    """
+    trk = TrkFile.merge_trks(self.estimate_trks)
+    self.estimate_trks = []
+    if 'maxcost' not in self.params:
+      self.params['maxcost'] = estimate_maxcost(trk, self.params)
+    logging.info('maxcost set to %f' % self.params['maxcost'])
+    set_default_params(self.params)
+
+    frames = list(self.match_frames(trk))
+    if trk.T > 3:
+      ids = np.zeros((1, trk.T, trk.ntargets), dtype=int) - 1
+      for t, idsnext, data in frames:
+        ids[0, t - trk.T0, trk.real_idx(trk.pTrk[:, :, t - trk.T0])] = idsnext
+      ids_trk = TrkFile.Tracklet(defaultval=-1)
+      ids_trk.setdata_dense(ids)
+      self.vel_mag_eps, self.pred_error_thresh = motion_link_stats(TrkFile.Trk(p=trk.pTrk), ids_trk, trk.T)
+    else:
+      # too few frames for motion statistics, no tracklets are joined
+      self.vel_mag_eps, self.pred_error_thresh = 0., 0.
+    for t, idsnext, data in frames:
+      self.add_frame(t, idsnext, data)
+
+  def match_frames(self, trk):
+    """
+    Generator that assigns tracklet ids to the detections in each frame of dense Trk trk using match_frame.
+    Yields the frame, the ids and a dict with the data for each field for the detections.
+    """
+    for i in range(trk.T):
+      pnext = trk.pTrk[:, :, i]
+      idxnext = trk.real_idx(pnext)
+      pnext = pnext[:, :, idxnext]
+      if self.idscurr is None:
+        idsnext = np.arange(pnext.shape[2], dtype=int)
+        self.lastid = 0 if idsnext.size == 0 else np.max(idsnext)
+      else:
+        idsnext, self.lastid, _, _ = match_frame(self.pcurr, pnext, self.idscurr, self.params, self.lastid)
+      self.pcurr = pnext
+      self.idscurr = idsnext
+      yield trk.T0 + i, idsnext, {k: trk.__dict__[k][..., i, idxnext] for k in self.fields}
+
+  def add_frame(self, t, ids, data):
+    for ndx, curid in enumerate(ids):
+      if curid in self.tracklets:
+        tracklet = self.tracklets[curid]
+        tracklet['t1'] = t
+        if len(tracklet['p']) < 2:
+          tracklet['p'].append(data['pTrk'][..., ndx])
+      else:
+        self.tracklets[curid] = {'t0': t, 't1': t, 'p': [data['pTrk'][..., ndx]], 'target': None, 'joined': False}
+    if self.frame is not None:
+      # the tracklets that start in the previous frame now have their second detection
+      self.link_boundary(self.frame[0])
+      self.write_frame(*self.frame)
+    self.frame = (t, ids, data)
+
+  def link_boundary(self, t):
+    """
+    Joins tracklets that end in frame t-1 to tracklets that start in frame t as motion_link does, and assigns
+    output targets to the tracklets that start in frame t. Tracklets that end in frame t-1 and are not joined are
+    finished and their data is written.
+    """
+    ending = sorted([curid for curid, tracklet in self.tracklets.items() if tracklet['t1'] == t - 1])
+    starting = sorted([curid for curid, tracklet in self.tracklets.items() if tracklet['t0'] == t])
+    # motion_link goes through the ids in order. ids of tracklets that end earlier are always smaller, so the
+    # ending tracklets are checked first.
+    for curid in list(ending):
+      tracklet = self.tracklets[curid]
+      # as in motion_link, tracklets that were joined to an earlier one when they started are not checked
+      if tracklet['joined'] or tracklet['t0'] == tracklet['t1'] or len(starting) == 0:
+        continue
+      target = self.targets[tracklet['target']]
+      p3 = np.stack([self.tracklets[sid]['p'][0] for sid in starting], axis=-1)
+      match_idx, _ = check_motion_link(target['p'][-1], target['p'][-2], p3, self.vel_mag_eps, self.pred_error_thresh)
+      if match_idx is not None:
+        self.tracklets[starting[match_idx]]['target'] = tracklet['target']
+        self.tracklets[starting[match_idx]]['joined'] = True
+        starting.pop(match_idx)
+        ending.remove(curid)
+    for curid in starting:
+      tracklet = self.tracklets[curid]
+      if len(tracklet['p']) > 1 and len(ending) > 0:
+        p3 = np.stack([self.targets[self.tracklets[eid]['target']]['p'][-1] for eid in ending], axis=-1)
+        match_idx, _ = check_motion_link(tracklet['p'][0], tracklet['p'][1], p3, self.vel_mag_eps, self.pred_error_thresh)
+        if match_idx is not None:
+          tracklet['target'] = self.tracklets[ending[match_idx]]['target']
+          ending.pop(match_idx)
+          continue
+      itgt = self.writer.add_target(t)
+      self.targets[itgt] = {'data': {k: [] for k in self.fields}, 'p': []}
+      tracklet['target'] = itgt
+
+    for curid in sorted([curid for curid, tracklet in self.tracklets.items() if tracklet['t1'] == t - 1]):
+      itgt = self.tracklets.pop(curid)['target']
+      if itgt not in [tracklet['target'] for tracklet in self.tracklets.values()]:
+        self.write_target(itgt)
+        del self.targets[itgt]
+
+  def write_frame(self, t, ids, data):
+    for ndx, curid in enumerate(ids):
+      itgt = self.tracklets[curid]['target']
+      target = self.targets[itgt]
+      for k in self.fields:
+        target['data'][k].append(data[k][..., ndx])
+      target['p'] = target['p'][-1:] + [data['pTrk'][..., ndx]]
+      if len(target['data']['pTrk']) >= self.flush_frames:
+        self.write_target(itgt)
+
+  def write_target(self, itgt):
+    target = self.targets[itgt]
+    if len(target['data']['pTrk']) == 0:
+      return
+    self.writer.append(itgt, {k: np.stack(target['data'][k], axis=-1) for k in self.fields})
+    target['data'] = {k: [] for k in self.fields}
+
+  def close(self):
+    """
+    close(self)
+    Links the remaining frames, writes all the tracklets and closes the writer.
+    """
+    if len(self.estimate_trks) > 0:
+      self.estimate_params()
+    if self.frame is not None:
+      t = self.frame[0]
+      self.link_boundary(t)
+      self.write_frame(*self.frame)
+      self.frame = None
+    for itgt in list(self.targets.keys()):
+      self.write_target(itgt)
+    self.targets = {}
+    self.tracklets = {}
+    self.writer.close(T1=None if self.next_frame is None else self.next_frame - 1)
+
+
 def link_trklets(trk_files, conf, movs, out_files):
   """
   Links pure tracklets using id liking or motion based on conf.link_id
@@ -1191,7 +1466,7 @@ def link_trklets(trk_files, conf, movs, out_files):
   :return: linked trk files
   :rtype: list
   """
-  in_trks = [TrkFile.Trk(tt) for tt in trk_files]
+  in_trks = [TrkFile.Trk(tt,lazy=True) for tt in trk_files]
 
   if conf.link_id:
     conf1 = copy.deepcopy(conf)
@@ -1241,30 +1516,46 @@ def link_trklets(trk_files, conf, movs, out_files):
         out_trks.append(linked_trks[count])
         count +=1
 
-    return out_trks
-
   else:
-    return simple_linking(in_trks,conf)
+    out_trks = simple_linking(in_trks,conf)
+
+  # release the trk files. Data that the linked trks still share with the inputs is read before the files are closed.
+  for trk in in_trks:
+    trk.close()
+  return out_trks
 
 def simple_linking(in_trks,conf):
+  """
+  Links the pure tracklets of in_trks using motion. The linking parameters are estimated jointly from all the trks.
+  If conf.link_n_procs > 1, the parameter estimation and the linking of the trks are done in a pool of
+  conf.link_n_procs processes. The output is the same as when linking in a single process.
+  :param in_trks: list of Trk objects
+  :param conf: poseConfig.config
+  :return: list of linked Trk objects
+  """
   if len(in_trks)<1: return []
   params = get_default_params(conf)
 
-  if 'maxcost' not in params:
-    params['maxcost'] = estimate_maxcost(in_trks, params)
-  logging.info('maxcost set to %f' % params['maxcost'])
+  n_procs = min(conf.get('link_n_procs',1), len(in_trks)*max(params['maxcost_framesfit'],1))
+  with (mp.get_context('spawn').Pool(n_procs) if n_procs>1 else contextlib.nullcontext()) as pool:
+    if 'maxcost' not in params:
+      params['maxcost'] = estimate_maxcost(in_trks, params, pool=pool)
+    logging.info('maxcost set to %f' % params['maxcost'])
 
-  if 'maxcost_missed' not in params:
-    params['maxcost_missed'] = estimate_maxcost_missed(in_trks, params)
-    logging.info('maxcost_missed set to ' + str(params['maxcost_missed']))
+    if 'maxcost_missed' not in params:
+      params['maxcost_missed'] = estimate_maxcost_missed(in_trks, params, pool=pool)
+      logging.info('maxcost_missed set to ' + str(params['maxcost_missed']))
 
-  params['maxframes_delete'] = conf.link_id_min_tracklet_len
+    params['maxframes_delete'] = conf.link_id_min_tracklet_len
 
-  # if 'nms_max' not in params:
-  # params['nms_max'] = estimate_maxcost(trk, prctile=params['nms_prctile'], mult=1, heuristic='prctile')
+    # if 'nms_max' not in params:
+    # params['nms_max'] = estimate_maxcost(trk, prctile=params['nms_prctile'], mult=1, heuristic='prctile')
 
-  #  nonmax_supp(trk, params)
-  out_trks = [link(trk, params) for trk in in_trks]
+    #  nonmax_supp(trk, params)
+    if pool is None:
+      out_trks = [link(trk, params) for trk in in_trks]
+    else:
+      out_trks = pool.starmap(link, [(trk, params) for trk in in_trks], chunksize=1)
   return out_trks
 
 
@@ -1363,19 +1654,26 @@ def link_id(trks, trk_files, mov_files, conf, out_files, id_wts=None,link_method
     all_trx.append(trx)
     cap.close()
 
+  # Image samples and embeddings of the tracklets are cached so that relinking only processes tracklets that have changed. The id network is retrained only if its training inputs have changed. When adding movies to a batch, pass the weights of the previous run as id_wts so that only the tracklets of the new movies are embedded.
+  cache_dir = get_id_cache_dir(conf, out_files)
+  wt_out_file = out_files[0].replace('.trk','_idwts.p')
+  train_key = id_train_key(all_trx, mov_files, conf) if cache_dir is not None else None
+
   if id_wts is not None and os.path.exists(id_wts):
     id_classifier = load_id_wts(id_wts)
+  elif train_key is not None and os.path.exists(wt_out_file) and torch.load(wt_out_file,map_location='cpu').get('train_key',None) == train_key:
+    logging.info(f'Using the ID network in {wt_out_file} that was trained on the same tracklets and movies')
+    id_classifier = load_id_wts(wt_out_file)
   else:
   # generate the training images
     train_data_args = [trks, all_trx, mov_files, conf]
     # train_data = get_id_train_images(trks, all_trx, mov_files, conf)
-    wt_out_file = out_files[0].replace('.trk','_idwts.p')
     # train the identity model
-    id_classifier, loss_history = train_id_classifier(train_data_args,conf, trks, save_file=wt_out_file,bsz=conf.link_id_batch_size)
+    id_classifier, loss_history = train_id_classifier(train_data_args,conf, trks, save_file=wt_out_file,bsz=conf.link_id_batch_size,train_key=train_key)
 
   # link using id model
   def_params = get_default_params(conf)
-  trk_out, debug_data = link_trklet_id(trks,id_classifier,mov_files,conf, all_trx,min_len_select=def_params['maxframes_sel'],keep_all_preds=conf.link_id_keep_all_preds,link_method=link_method)
+  trk_out, debug_data = link_trklet_id(trks,id_classifier,mov_files,conf, all_trx,min_len_select=def_params['maxframes_sel'],keep_all_preds=conf.link_id_keep_all_preds,link_method=link_method,cache_dir=cache_dir)
 
   if save_debug_data:
     debug_out_file = out_files[0].replace('.trk','_link_data.p')
@@ -1568,7 +1866,7 @@ def process_id_ims(curims, conf, distort, rescale):
 
 def read_ims_par(trx, trk_info, mov_file, conf):
   '''
-  Read images in parallel because otherwise it is really slow particularly for avis
+  Read images in parallel because otherwise it is really slow particularly for avis. The workers write the images directly into a shared memory array allocated here, so only the frame lists are pickled and the number of tracklets that can be read is not limited by the pickle size.
   :param trx:
   :type trx:
   :param trk_info:
@@ -1577,37 +1875,155 @@ def read_ims_par(trx, trk_info, mov_file, conf):
   :type mov_file:
   :param conf:
   :type conf:
-  :param n_ex:
-  :type n_ex:
-  :return:
+  :return: list of [images, tgt, start frame, end frame, [frame, tgt] list] for each tracklet in trk_info. Images of all the tracklets are views into a single array.
   :rtype:
   '''
 
   n_ex = conf.link_id_tracklet_samples
   n_trk = len(trk_info)
+  if n_trk == 0:
+    return []
   max_pool = 20
-  if n_trk < max_pool:
-    n_pool = n_trk
-    n_batches = n_trk
-  else:
-    bytes_per_trk = n_ex*conf.imsz[0]*conf.imsz[1]*3*8*1.1
-    # 1.1 is sort of extra buffer
-    max_pkl_bytes = 1024*1024*1024
-    n_trk_per_thrd = max_pkl_bytes//bytes_per_trk
-    n_trk_per_thrd = int(max(1,n_trk_per_thrd))
-    n_batches = int(np.ceil(n_trk/n_trk_per_thrd))
-    if n_batches <max_pool:
-      n_pool = n_batches
+  n_pool = min(n_trk, max_pool)
+  # a few batches per worker so that the workers stay busy when the tracklets take different amounts of time to read
+  n_batches = min(n_trk, 4*n_pool)
+
+  shape = (n_trk, n_ex) + tuple(conf.imsz) + (conf.img_dim,)
+  shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+  try:
+    # for debugging
+    # out = read_tracklet_ims(trx, trk_info[::n_jobs], mov_file, conf, n_ex, np.random.randint(100000))
+    trk_info_batches = split_parallel(trk_info,n_batches)
+    offsets = np.cumsum([0] + [len(b) for b in trk_info_batches])
+    with mp.get_context('spawn').Pool(n_pool,maxtasksperchild=10) as pool:
+      args = [(trx, trk_info_batches[n], mov_file, conf, n_ex, np.random.randint(100000), shm.name, shape, offsets[n]) for n in range(n_batches)]
+      data = pool.starmap(read_tracklet_ims_shm,args,chunksize=1)
+    data = merge_parallel(data)
+    all_ims = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+  finally:
+    shm.close()
+    shm.unlink()
+
+  for ndx in range(n_trk):
+    data[ndx][0] = all_ims[ndx]
+  return data
+
+def read_tracklet_ims_shm(trx, trk_info, mov_file, conf, n_ex, seed, shm_name, shape, offset):
+  '''
+  Worker for read_ims_par. Reads the images for the tracklets in trk_info into the shared memory array shm_name of size shape starting at offset and returns the tracklet info without the images.
+  '''
+  shm = shared_memory.SharedMemory(name=shm_name)
+  try:
+    ims = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    out = ims[offset:offset+len(trk_info)]
+    data = read_tracklet_ims(trx, trk_info, mov_file, conf, n_ex, seed, out=out)
+    del ims, out
+  finally:
+    shm.close()
+  return data
+
+def id_cache_key(*args):
+  '''
+  Content hash of args for the id linking cache. numpy arrays, dicts, lists and tuples are hashed by their content, everything else by its repr.
+  '''
+  h = hashlib.sha1()
+
+  def update(x):
+    if isinstance(x, np.ndarray):
+      h.update(repr((x.dtype.str, x.shape)).encode())
+      h.update(np.ascontiguousarray(x).tobytes())
+    elif isinstance(x, dict):
+      h.update(b'{')
+      for k in sorted(x):
+        h.update(repr(k).encode())
+        update(x[k])
+      h.update(b'}')
+    elif isinstance(x, (list, tuple)):
+      h.update(b'[')
+      for xx in x:
+        update(xx)
+      h.update(b']')
     else:
-      n_pool = max_pool
-
-  # for debugging
-  # out = read_tracklet_ims(trx, trk_info[::n_jobs], mov_file, conf, n_ex, np.random.randint(100000))
-  trk_info_batches = split_parallel(trk_info,n_batches)
-  with mp.get_context('spawn').Pool(n_pool,maxtasksperchild=10) as pool:
-    args = [(trx, trk_info_batches[n], mov_file, conf, n_ex, np.random.randint(100000)) for n in range(n_batches)]
-    data = pool.starmap(read_tracklet_ims,args,chunksize=1)
-  data = merge_parallel(data)
+      h.update(repr(x).encode())
+
+  update(args)
+  return h.hexdigest()
+
+def movie_cache_key(mov_file):
+  '''
+  Identifies a movie by its path, size and modification time so that the cache is invalidated if the movie is replaced.
+  '''
+  st = os.stat(mov_file)
+  return id_cache_key(os.path.abspath(mov_file), st.st_size, st.st_mtime_ns)
+
+def net_cache_key(net):
+  return id_cache_key([v.detach().cpu().numpy() for v in net.state_dict().values()])
+
+def tracklet_ims_keys(trx, trk_info, mov_file, conf):
+  '''
+  Cache keys for the image samples of the tracklets in trk_info. A key depends on the movie, the trx of the tracklet and the parameters used to crop the images, but not on the index of the tracklet so that the key stays the same when the tracklets are renumbered.
+  '''
+  mov_key = movie_cache_key(mov_file)
+  crop_params = [conf.imsz, conf.img_dim, conf.trx_align_theta, conf.link_id_tracklet_samples]
+  keys = []
+  for tgt, sf, ef in trk_info:
+    cur_trx = {k: trx[tgt][k] for k in ['x', 'y', 'theta', 'firstframe']}
+    keys.append(id_cache_key(mov_key, crop_params, int(sf), int(ef), cur_trx))
+  return keys
+
+def id_train_key(all_trx, mov_files, conf):
+  '''
+  Cache key for the inputs used to train the id network.
+  '''
+  train_params = [conf.imsz, conf.img_dim, conf.trx_align_theta, conf.max_n_animals, conf.link_id_tracklet_samples, conf.link_id_rescale, conf.link_id_training_iters, conf.link_id_mining_steps, conf.link_id_min_train_track_len, conf.link_id_batch_size]
+  trx_data = [[{k: cur_trx[k] for k in ['x', 'y', 'theta', 'firstframe']} for cur_trx in trx] for trx in all_trx]
+  return id_cache_key([movie_cache_key(m) for m in mov_files], trx_data, train_params)
+
+def get_id_cache_dir(conf, out_files):
+  if not conf.get('link_id_cache', False):
+    return None
+  cache_dir = conf.get('link_id_cache_dir', None)
+  if cache_dir is None:
+    cache_dir = os.path.splitext(out_files[0])[0] + '_idcache'
+  return cache_dir
+
+def load_id_cache(cache_dir, kind, key):
+  cache_file = os.path.join(cache_dir, kind, key + '.p')
+  if not os.path.exists(cache_file):
+    return None
+  return PoseTools.pickle_load(cache_file)
+
+def save_id_cache(cache_dir, kind, key, data):
+  # write to a temp file and rename so that a partially written entry is never read, e.g., if linking of another view is using the same cache
+  os.makedirs(os.path.join(cache_dir, kind), exist_ok=True)
+  cache_file = os.path.join(cache_dir, kind, key + '.p')
+  tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+  with open(tmp_file, 'wb') as f:
+    pickle.dump(data, f)
+  os.replace(tmp_file, cache_file)
+
+def read_ims_cached(trx, trk_info, mov_file, conf, cache_dir, keys=None):
+  '''
+  Same as read_ims_par, but image samples of tracklets that are in the cache are loaded from the cache. Only the remaining tracklets are read from the movie and they are added to the cache.
+  '''
+  if keys is None:
+    keys = tracklet_ims_keys(trx, trk_info, mov_file, conf)
+  data = [None] * len(trk_info)
+  to_read = []
+  for ndx, (cur_info, key) in enumerate(zip(trk_info, keys)):
+    cached = load_id_cache(cache_dir, 'ims', key)
+    if cached is None:
+      to_read.append(ndx)
+      continue
+    tgt, sf, ef = cur_info
+    data[ndx] = [cached['ims'], tgt, sf, ef, [[fr, tgt] for fr in cached['frames']]]
+
+  logging.info(f'Image samples for {len(trk_info) - len(to_read)} of {len(trk_info)} tracklets found in the cache {cache_dir}')
+  if len(to_read) > 0:
+    new_data = read_ims_par(trx, [trk_info[n] for n in to_read], mov_file, conf)
+    for ndx, cur_data in zip(to_read, new_data):
+      data[ndx] = cur_data
+      save_id_cache(cache_dir, 'ims', keys[ndx], {'ims': cur_data[0], 'frames': [c[0] for c in cur_data[4]]})
   return data
 
 def read_data_files(data_files):
@@ -1620,9 +2036,9 @@ def read_data_files(data_files):
   return data
 
 
-def read_tracklet_ims(trx, trk_info, mov_file, conf, n_ex,seed):
+def read_tracklet_ims(trx, trk_info, mov_file, conf, n_ex,seed,out=None):
   '''
-  Read n_ex number of random images from tracklets specified in trk_info. The number of the images that can be returned is limited by pickle to 2GB. So saving the images to temp file and returning the file. Uses existing code that extracts animal images based on trx
+  Read n_ex number of random images from tracklets specified in trk_info. Uses existing code that extracts animal images based on trx. If out (n_tracklets x n_ex x imsz x img_dim) is given, the images are written into it and None is returned in place of the images.
   :param trx:
   :type trx:
   :param trk_info:
@@ -1635,16 +2051,18 @@ def read_tracklet_ims(trx, trk_info, mov_file, conf, n_ex,seed):
   :type n_ex:
   :param seed:
   :type seed:
+  :param out:
+  :type out: np.ndarray
   :return:
   :rtype:
   '''
 
   # Very important to set the seed as otherwise same set of images would be returned
   np.random.seed(seed)
-  cap = movies.Movie(mov_file)
+  cap = movies.Movie(mov_file, use_keyframe_index=conf.get('movie_keyframe_index', False))
 
   all_ims = []
-  for cur_trk in trk_info:
+  for ndx, cur_trk in enumerate(trk_info):
     rand_frs = []
     while len(rand_frs) < n_ex:
       cur_fr = np.random.choice(np.arange(cur_trk[1], cur_trk[2]+1))
@@ -1655,7 +2073,11 @@ def read_tracklet_ims(trx, trk_info, mov_file, conf, n_ex,seed):
     cur_list = [[fr, cur_trk[0]] for fr in rand_frs]
 
     # Use trx based image patch generator
-    ims = apt.create_batch_ims(cur_list, conf, cap, False, trx, None, use_bsize=False)
+    if out is None:
+      ims = apt.create_batch_ims(cur_list, conf, cap, False, trx, None, use_bsize=False)
+    else:
+      apt.create_batch_ims(cur_list, conf, cap, False, trx, None, use_bsize=False, all_f=out[ndx])
+      ims = None
     all_ims.append([ims, cur_trk[0],cur_trk[1],cur_trk[2],cur_list])
 
   # tfile = tempfile.mkstemp()[1]
@@ -1886,7 +2308,7 @@ def get_id_net():
   net = net.cuda()
   return net
 
-def train_id_classifier(train_data_args, conf, trks, save=False,save_file=None, bsz=16):
+def train_id_classifier(train_data_args, conf, trks, save=False,save_file=None, bsz=16, train_key=None):
   """
   Trains the identity classifier/embedder
   :param all_data:
@@ -1901,6 +2323,8 @@ def train_id_classifier(train_data_args, conf, trks, save=False,save_file=None,
   :type save_file:
   :param bsz:
   :type bsz:
+  :param train_key: cache key of the training inputs that is saved with the weights (see id_train_key)
+  :type train_key: str
   :return:
   :rtype:
   """
@@ -2034,13 +2458,58 @@ def train_id_classifier(train_data_args, conf, trks, save=False,save_file=None,
     loss_history.append(loss_contrastive.item())
 
   wt_out_file = f'{save_file}'
-  torch.save({'model_state_params': net.state_dict(), 'loss_history': loss_history}, wt_out_file)
+  torch.save({'model_state_params': net.state_dict(), 'loss_history': loss_history, 'train_key': train_key}, wt_out_file)
 
   del train_iter, train_loader, train_dset
   return net, loss_history
 
 
-def get_id_dist_xmat(linked_trks,net,mov_files,conf,all_trx,rescale,min_len_select,debug):
+def embed_tracklet_ims(data, net, conf, rescale):
+  '''
+  Embeddings of the image samples in data (as returned by read_ims_par). Returns an array of size n_tracklets x n_samples x embedding size.
+  '''
+  preds = None
+  s_sz = 200
+  # find ceil
+  n_split = int(np.ceil(len(data)/s_sz))
+  for idx in tqdm(range(n_split)):
+    ids1 = s_sz*idx
+    ids2 = min(s_sz*(idx+1), len(data))
+    ims = [dd[0] for dd in data[ids1:ids2]]
+
+    # Find the embeddings for the images
+    cur_preds = tracklet_pred(ims, net, conf, rescale)
+
+    if cur_preds.size>0:
+      if preds is None:
+        preds = cur_preds
+      else:
+        preds = np.concatenate([preds, cur_preds],axis=0)
+  return preds
+
+def embed_tracklets_cached(trx, trk_info, mov_file, net, net_key, conf, rescale, cache_dir, keep_ims=False):
+  '''
+  Embeddings of the tracklets in trk_info using the cache. Embeddings are cached by the image samples, the network weights and rescale, and only tracklets whose embeddings are not in the cache are embedded. If keep_ims is True, image samples of all the tracklets are returned, otherwise only of the tracklets that had to be embedded.
+  '''
+  ims_keys = tracklet_ims_keys(trx, trk_info, mov_file, conf)
+  emb_keys = [id_cache_key(k, net_key, rescale) for k in ims_keys]
+  preds = [load_id_cache(cache_dir, 'emb', k) for k in emb_keys]
+  to_embed = [n for n in range(len(preds)) if preds[n] is None]
+  logging.info(f'Embeddings for {len(preds) - len(to_embed)} of {len(preds)} tracklets found in the cache {cache_dir}')
+
+  sel = list(range(len(trk_info))) if keep_ims else to_embed
+  data = read_ims_cached(trx, [trk_info[n] for n in sel], mov_file, conf, cache_dir, [ims_keys[n] for n in sel])
+  data_embed = [data[sel.index(n)] for n in to_embed] if keep_ims else data
+  if len(to_embed) > 0:
+    new_preds = embed_tracklet_ims(data_embed, net, conf, rescale)
+    for n, cur_preds in zip(to_embed, new_preds):
+      preds[n] = cur_preds
+      save_id_cache(cache_dir, 'emb', emb_keys[n], cur_preds)
+
+  preds = np.array(preds)
+  return data, preds
+
+def get_id_dist_xmat(linked_trks,net,mov_files,conf,all_trx,rescale,min_len_select,debug,cache_dir=None):
 
 
   net.eval()
@@ -2049,6 +2518,7 @@ def get_id_dist_xmat(linked_trks,net,mov_files,conf,all_trx,rescale,min_len_sele
   pred_map = []
   # pred_map keeps track of which sample belongs to which trajectory
 
+  net_key = net_cache_key(net) if cache_dir is not None else None
 
   # sample images for each tracklet and then find the embeddings for them
   for ndx in range(len(linked_trks)):
@@ -2064,44 +2534,27 @@ def get_id_dist_xmat(linked_trks,net,mov_files,conf,all_trx,rescale,min_len_sele
     trk_info = list(zip(sel_tgt, sel_ss, sel_ee))
     logging.info(f'Sampling images from {len(sel_ss)} tracklets to assign identity to the tracklets ...')
     start_t = time.time()
-    cur_data = read_ims_par(trx, trk_info, mov_file, conf)
-    end_t = time.time()
-    logging.info(f'Sampling images took {round((end_t-start_t)/60)} minutes')
-
-    merge_data = []
-    merge_tgt_id = []
-    s_sz = 200
-    # find ceil
-    n_split = int(np.ceil(len(cur_data)/s_sz))
-    for idx in tqdm(range(n_split)):
-
-      # data = read_data_files([curf])
-      ids1 = s_sz*idx
-      ids2 = min(s_sz*(idx+1), len(cur_data))
-      data = cur_data[ids1:ids2]
-      tgt_id = np.array([r[1] for r in data])
-      merge_tgt_id.extend(tgt_id.tolist())
-
-      if debug:
-        merge_data.extend(data)
-
-      # pred_map keeps track of which sample belongs to which trajectory
-      ims = []
-      for curndx in range(len(data)):
-        curims = data[curndx][0]
-        ims.append(curims)
-        pred_map.append([ndx, tgt_id[curndx]])
-
-      # Find the embeddings for the images
-      cur_preds = tracklet_pred(ims, net, conf, rescale)
-
-      if cur_preds.size>0:
-        if preds is None:
-          preds = cur_preds
-        else:
-          preds = np.concatenate([preds, cur_preds],axis=0)
+    if cache_dir is None:
+      cur_data = read_ims_par(trx, trk_info, mov_file, conf)
+      end_t = time.time()
+      logging.info(f'Sampling images took {round((end_t-start_t)/60)} minutes')
+      cur_preds = embed_tracklet_ims(cur_data, net, conf, rescale)
+    else:
+      cur_data, cur_preds = embed_tracklets_cached(trx, trk_info, mov_file, net, net_key, conf, rescale, cache_dir, keep_ims=debug)
+      end_t = time.time()
+      logging.info(f'Sampling images and embedding took {round((end_t-start_t)/60)} minutes')
+
+    merge_data = cur_data if debug else []
+    merge_tgt_id = np.array([r[0] for r in trk_info],dtype=int)
+    # pred_map keeps track of which sample belongs to which trajectory
+    pred_map.extend([[ndx, tgt] for tgt in merge_tgt_id])
+
+    if cur_preds is not None and cur_preds.size>0:
+      if preds is None:
+        preds = cur_preds
+      else:
+        preds = np.concatenate([preds, cur_preds],axis=0)
 
-    merge_tgt_id = np.array(merge_tgt_id)
     cur_d = [merge_data, sel_tgt, merge_tgt_id, ss, ee, sel_ss, sel_ee]
     all_data.append(cur_d)
 
@@ -2123,18 +2576,16 @@ def get_id_thresh(dist_mat, pred_map, all_data):
 
   # use distance to overlapping tracklets to find the far thresholds. Using just the first movie for now
   mov1_sel = pred_map[:,0]==0
-  sel = pred_map[mov1_sel, 1]
   st_sel = all_data[0][-2]
   en_sel = all_data[0][-1]
-  ns = sel.size
 
-  overlap = np.zeros([ns,ns])
-  for ndx in range(ns):
-    aa, bb = get_overlap(st_sel, en_sel, st_sel[ndx], en_sel[ndx], ndx)
-    if aa.size > 0:
-      overlap[ndx, aa] = bb
+  # overlap of each tracklet with the other tracklets as a fraction of its length (as in get_overlap), only for the pairs that overlap
+  ii, jj, amt = interval_overlaps(st_sel, en_sel)
+  tr_len = en_sel - st_sel + 1
+  ii, jj = np.concatenate([ii, jj]), np.concatenate([jj, ii])
+  overlap = np.concatenate([amt, amt]) / tr_len[ii]
   mov1_dist = dist_mat[np.ix_(mov1_sel,mov1_sel)]
-  overlap_dist = mov1_dist[overlap>0.1]
+  overlap_dist = mov1_dist[ii[overlap>0.1], jj[overlap>0.1]]
   far_thresh = np.percentile(overlap_dist,thresh_perc)
   return close_thresh, far_thresh
 
@@ -2479,6 +2930,85 @@ def group_tracklets_motion(dist_mat,linked_trk,link_costs,close_thresh,min_len_s
   mgrs = [list(set(m)) for m in mgrs]
   return mgrs, link_type
 
+def interval_overlaps(st, en):
+  '''
+  Finds the pairs of intervals [st, en] (both inclusive) that overlap by sorting the intervals by their start, so that only the overlapping pairs are compared. Returns the indices i, j and the number of overlapping frames for each pair, with each pair appearing once.
+  '''
+  st = np.asarray(st)
+  en = np.asarray(en)
+  order = np.argsort(st, kind='stable')
+  st_s = st[order]
+  en_s = en[order]
+  # intervals that start after interval k in the sorted order but before it ends
+  n = len(st)
+  n_pairs = np.maximum(np.searchsorted(st_s, en_s, side='right') - np.arange(n) - 1, 0)
+  k = np.repeat(np.arange(n), n_pairs)
+  j = k + 1 + np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+  amt = np.minimum(en_s[k], en_s[j]) - st_s[j] + 1
+  valid = amt > 0
+  return order[k[valid]], order[j[valid]], amt[valid]
+
+def group_overlaps(groups, ss, ee, maxn):
+  '''
+  Number of frames in which pairs of groups of tracklets overlap (as a sparse matrix) and the number of frames covered by each group. Only frames before maxn are counted.
+  '''
+  g_st = []
+  g_en = []
+  g_ndx = []
+  glens = np.zeros(len(groups))
+  for ndx, gr in enumerate(groups):
+    # union of the intervals of the tracklets in the group
+    st = np.array([ss[g] for g in gr])
+    en = np.minimum(np.array([ee[g] for g in gr]), maxn-1)
+    order = np.argsort(st)
+    cur_st, cur_en = None, None
+    for o in order:
+      if en[o] < st[o]:
+        continue
+      if cur_st is not None and st[o] <= cur_en + 1:
+        cur_en = max(cur_en, en[o])
+        continue
+      if cur_st is not None:
+        g_st.append(cur_st); g_en.append(cur_en); g_ndx.append(ndx)
+      cur_st, cur_en = st[o], en[o]
+    if cur_st is not None:
+      g_st.append(cur_st); g_en.append(cur_en); g_ndx.append(ndx)
+
+  g_st = np.array(g_st, dtype=int)
+  g_en = np.array(g_en, dtype=int)
+  g_ndx = np.array(g_ndx, dtype=int)
+  np.add.at(glens, g_ndx, g_en - g_st + 1)
+  ii, jj, amt = interval_overlaps(g_st, g_en)
+  gi, gj = g_ndx[ii], g_ndx[jj]
+  overlaps = scipy.sparse.coo_matrix((np.concatenate([amt, amt]).astype('float'), (np.concatenate([gi, gj]), np.concatenate([gj, gi]))), shape=(len(groups), len(groups))).tocsr()
+  return overlaps, glens
+
+def group_id_dist(dist_mat, sel_ids, tlen):
+  '''
+  Identity distance between groups of tracklets. For a pair of groups, each tracklet of one group is matched to the closest tracklet of the other group and the distances are averaged weighted by the tracklet length (tlen). The distance is the mean of the averages in both directions. For a group with itself, the tracklets aren't matched to themselves.
+  '''
+  nsel = len(sel_ids)
+  # gmin[x,t] is the distance from tracklet t to the closest tracklet in group x
+  gmin = np.array([dist_mat[s1].min(axis=0) for s1 in sel_ids])
+  rows = np.concatenate([np.array(s1, dtype=int) for s1 in sel_ids])
+  cols = np.repeat(np.arange(nsel), [len(s1) for s1 in sel_ids])
+  member = scipy.sparse.csr_matrix((tlen[rows].astype('float'), (rows, cols)), shape=(dist_mat.shape[0], nsel))
+  wts = np.asarray(member.sum(axis=0)).flatten()
+  # mx[x1,x2] is the weighted average over tracklets of x2 of the distance to the closest tracklet of x1
+  mx = np.asarray(member.T @ gmin.T).T / wts[None]
+  xmat = (mx + mx.T)/2
+
+  for x1, s1 in enumerate(sel_ids):
+    cmat = dist_mat[s1][:, s1].copy()
+    if len(s1) == 1:
+      cmat[range(len(s1)), range(len(s1))] = np.nan
+    else:
+      cmat[range(len(s1)), range(len(s1))] = 2.
+    mx1 = np.average(np.min(cmat,axis=0),weights=tlen[s1])
+    mx2 = np.average(np.min(cmat,axis=1),weights=tlen[s1])
+    xmat[x1,x1] = (mx1+mx2)/2
+  return xmat
+
 def overlap_dist(dmat, c1, c2, overlap,mgr_lens):
   l1 = np.sum(mgr_lens[c1])
   l2 = np.sum(mgr_lens[c2])
@@ -2491,33 +3021,89 @@ def overlap_dist(dmat, c1, c2, overlap,mgr_lens):
 
 
 def weighted_linkage(xmat, overlap, mgr_lens, thresh):
-  ymat = xmat.copy()
-  clusters = [[i] for i in range(xmat.shape[0])]
+  '''
+  Average linkage clustering where clusters that overlap in time by more than 10% (see overlap_dist) are not merged. overlap can be a sparse matrix.
+  Gives the same clusters as merging the closest pair of clusters after searching over all the pairs, but the closest later cluster for each cluster is cached and only the distances to the merged cluster are updated after a merge. The overlaps between the clusters are kept as a sparse graph.
+  The distances to the merged cluster are the mean of xmat over the two clusters computed as in overlap_dist, so that tied distances are broken the same way.
+  '''
+  n = xmat.shape[0]
+  clusters = [[i] for i in range(n)]
+  alive = np.ones(n, dtype=bool)
+  clens = np.array(mgr_lens, dtype='float')
+  ymat = np.array(xmat, dtype='float')
+  ymat[np.isnan(ymat)] = np.inf
+
+  coo = scipy.sparse.coo_matrix(overlap)
+  cov = [{} for _ in range(n)]
+  for i, j, v in zip(coo.row, coo.col, coo.data):
+    if i != j:
+      cov[i][j] = cov[i].get(j, 0.) + v
+
+  def row_min(i):
+    # closest alive cluster after i. Ties go to the first one, as in the exhaustive search
+    y = ymat[i, i+1:].copy()
+    y[~alive[i+1:]] = np.inf
+    if y.size == 0:
+      return np.inf, -1
+    j = np.argmin(y)
+    return y[j], i + 1 + j
+
+  best = np.full(n, np.inf)
+  best_j = np.full(n, -1)
+  for i in range(n):
+    best[i], best_j[i] = row_min(i)
+
   while True:
-    min_d = np.inf
-    for i in range(len(clusters)):
-      for j in range(i + 1, len(clusters)):
-        dcur = ymat[i, j]
-        if dcur < min_d:
-          min_d = dcur
-          min_i, min_j = i, j
-
-    if min_d > thresh:
+    min_i = np.argmin(best)
+    min_d = best[min_i]
+    if not (min_d <= thresh):
       break
+    min_j = best_j[min_i]
 
     clusters[min_i] += clusters[min_j]
-    del clusters[min_j]
+    clusters[min_j] = None
+    alive[min_j] = False
+    best[min_j] = np.inf
+    clens[min_i] += clens[min_j]
+    for k, v in cov[min_j].items():
+      del cov[k][min_j]
+      if k == min_i:
+        continue
+      cov[min_i][k] = cov[min_i].get(k, 0.) + v
+      cov[k][min_i] = cov[k].get(min_i, 0.) + v
+    cov[min_j] = None
+
+    # distances to the merged cluster
+    ovec = np.zeros(n)
+    if len(cov[min_i]) > 0:
+      ovec[list(cov[min_i].keys())] = list(cov[min_i].values())
+    with np.errstate(divide='ignore', invalid='ignore'):
+      ov = ovec / np.minimum(clens, clens[min_i])
+    dnew = np.full(n, np.inf)
+    c2 = clusters[min_i]
+    for k in np.where(alive)[0]:
+      if k == min_i:
+        continue
+      if ov[k] > 0.1:
+        dnew[k] = 2.
+      else:
+        c1 = clusters[k]
+        dnew[k] = np.mean(xmat[c1][:, c2])
+    dnew[np.isnan(dnew)] = np.inf
+    ymat[:, min_i] = dnew
+    ymat[min_i, :] = dnew
 
-    ymat[min_j:-1, :] = ymat[min_j + 1:]
-    ymat[:, min_j:-1] = ymat[:, min_j + 1:]
-    for i in range(len(clusters)):
-      if i != min_i:
-        c1 = clusters[i]
-        c2 = clusters[min_i]
-        ymat[i, min_i] = overlap_dist(xmat[c1][:, c2], c1, c2, overlap, mgr_lens)
-        ymat[min_i, i] = ymat[i, min_i]
+    # update the cached closest clusters
+    ndx = np.arange(n)
+    recompute = alive & ((best_j == min_j) | ((best_j == min_i) & (ndx < min_i)))
+    recompute[min_i] = True
+    for i in np.where(recompute)[0]:
+      best[i], best_j[i] = row_min(i)
+    upd = alive & ~recompute & (ndx < min_i) & ((dnew < best) | ((dnew == best) & (min_i < best_j)))
+    best[upd] = dnew[upd]
+    best_j[upd] = min_i
 
-  return clusters
+  return [c for c in clusters if c is not None]
 
 
 def group_tracklets_motion_all(dist_mat,pred_map_orig,linked_trks,conf,maxcosts_all,all_data,link_costs_arr,close_thresh,far_thresh,min_len_select):
@@ -2544,13 +3130,13 @@ def group_tracklets_motion_all(dist_mat,pred_map_orig,linked_trks,conf,maxcosts_
     cur_dist_mat = dist_mat[cur_sel][:,cur_sel]
     motion_grs,link_type = group_tracklets_motion(cur_dist_mat,trk,link_cost,close_thresh,min_len_select)
     link_data.append(link_type)
+    # index of the first entry in pred_map for each tracklet
+    pred_ndx = {}
+    for ix in cur_sel[::-1]:
+      pred_ndx[pred_map[ix,1]] = ix
     for m in motion_grs:
       motion_grs_all.append([ndx,m])
-      cur_sel_ids = []
-      for mm in m:
-        gndx = np.where(np.all(pred_map==np.array([ndx,mm]),axis=1))[0]
-        if len(gndx)>0:
-          cur_sel_ids.append(gndx[0])
+      cur_sel_ids = [pred_ndx[mm] for mm in m if mm in pred_ndx]
       sel_ids.append(cur_sel_ids)
 
   tlen = []
@@ -2559,22 +3145,7 @@ def group_tracklets_motion_all(dist_mat,pred_map_orig,linked_trks,conf,maxcosts_
   tlen = np.array(tlen)
 
   nsel = len(sel_ids)
-  xmat = np.zeros([nsel, nsel])
-  for x1, s1 in enumerate(sel_ids):
-    for x2, s2 in enumerate(sel_ids):
-      cmat = dist_mat[s1][:, s2].copy()
-      if x1 == x2:
-        if len(s1) == 1:
-          cmat[range(len(s1)), range(len(s1))] = np.nan
-        else:
-          cmat[range(len(s1)), range(len(s1))] = 2.
-      mx1 = np.average(np.min(cmat,axis=0),weights=tlen[s2])
-      mx2 = np.average(np.min(cmat,axis=1),weights=tlen[s1])
-      xmat[x1,x2] = (mx1+mx2)/2
-      # mxx = np.concatenate([np.min(cmat, axis=0), np.min(cmat, axis=1)])
-      # wxx = np.concatenate([tlen[s2], tlen[s1]]).astype('float')
-      # xmat[x1, x2] = np.average(mxx, weights=wxx)
-      # xmat[x1,x2] = np.median(mxx)
+  xmat = group_id_dist(dist_mat, sel_ids, tlen)
 
   xthresh = np.nanpercentile(np.diag(xmat), 90)
   xthresh = max(close_thresh,xthresh)
@@ -2582,25 +3153,21 @@ def group_tracklets_motion_all(dist_mat,pred_map_orig,linked_trks,conf,maxcosts_
 
   xmat[range(nsel), range(nsel)] = 0.
 
-  overlaps = np.zeros([nsel,nsel])
+  # number of frames in which the motion groups overlap. Only groups from the same movie overlap, and they are found from the intervals of their tracklets so this stays sparse for long movies with many tracklets.
+  ov_rows = []
+  ov_cols = []
+  ov_data = []
   mgr_lens = np.zeros(nsel)
   mov_ndx = np.array([p[0] for p in motion_grs_all])
   for ndx in range(len(linked_trks)):
     cur_mgrs = np.where(mov_ndx==ndx)[0]
-    lenso = np.zeros([len(cur_mgrs), maxn])
-    for nxx, gndx in enumerate(cur_mgrs):
-      gi = motion_grs_all[gndx][1]
-      for gii in gi:
-        lenso[nxx, ss_all[ndx][gii]:ee_all[ndx][gii] + 1] = 1
-
-    for x1 in range(len(lenso)):
-        mgr_lens[cur_mgrs[x1]] = np.sum(lenso[x1]>0)
-    for x1 in range(len(lenso)):
-      for x2 in range(len(lenso)):
-        if x1 >= x2: continue
-        ll = np.sum((lenso[x1] * lenso[x2]) > 0)
-        overlaps[cur_mgrs[x1],cur_mgrs[x2]] = ll
-        overlaps[cur_mgrs[x2],cur_mgrs[x1]] = ll
+    cur_ov, cur_lens = group_overlaps([motion_grs_all[gndx][1] for gndx in cur_mgrs], ss_all[ndx], ee_all[ndx], maxn)
+    mgr_lens[cur_mgrs] = cur_lens
+    cur_ov = cur_ov.tocoo()
+    ov_rows.append(cur_mgrs[cur_ov.row])
+    ov_cols.append(cur_mgrs[cur_ov.col])
+    ov_data.append(cur_ov.data)
+  overlaps = scipy.sparse.coo_matrix((np.concatenate(ov_data), (np.concatenate(ov_rows), np.concatenate(ov_cols))), shape=(nsel, nsel)).tocsr()
 
   F1 = weighted_linkage(xmat,overlaps,mgr_lens,xthresh)
   F = np.zeros(nsel).astype('int')
@@ -2641,7 +3208,7 @@ def group_tracklets_motion_all(dist_mat,pred_map_orig,linked_trks,conf,maxcosts_
   return grs, new_pred_map, debug_data
 
 
-def link_trklet_id(linked_trks, net, mov_files, conf, all_trx, rescale=1, min_len_select=5, debug=False, keep_all_preds=False,link_method='motion'):
+def link_trklet_id(linked_trks, net, mov_files, conf, all_trx, rescale=1, min_len_select=5, debug=False, keep_all_preds=False,link_method='motion',cache_dir=None):
   '''
   Links the pure tracklets using identity
 
@@ -2653,11 +3220,12 @@ def link_trklet_id(linked_trks, net, mov_files, conf, all_trx, rescale=1, min_le
   :param rescale:
   :param min_len_select:
   :param debug:
+  :param cache_dir: directory of the cache of image samples and embeddings. If None, the cache is not used.
   :return: list of id linked tracklets
   '''
 
 
-  dist_mat, pred_map, all_data = get_id_dist_xmat(linked_trks,net,mov_files,conf,all_trx,rescale,min_len_select,debug)
+  dist_mat, pred_map, all_data = get_id_dist_xmat(linked_trks,net,mov_files,conf,all_trx,rescale,min_len_select,debug,cache_dir=cache_dir)
   close_thresh, far_thresh = get_id_thresh(dist_mat,pred_map,all_data)
 
 
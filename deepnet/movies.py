@@ -9,6 +9,8 @@ import sys
 import traceback
 import importlib
 import glob
+import hashlib
+import tempfile
 
 import cv2
 import numpy as num
@@ -42,6 +44,17 @@ DEBUG = False
 if not DEBUG:
     DEBUG_MOVIES = False
 
+# If USE_KEYFRAME_INDEX is True, compressed AVIs use the keyframes listed in the
+# AVI's own index to decide whether to seek or decode forward to a frame. It is the
+# default for movies opened without use_keyframe_index (see conf.movie_keyframe_index).
+# The index is cached in KEYFRAME_INDEX_DIR, or in the temp directory if that is not
+# set, so nothing is written next to the movies.
+USE_KEYFRAME_INDEX = False
+KEYFRAME_INDEX_DIR = None
+KEYFRAME_INDEX_EXT = '.kfidx'
+# OpenCV's ffmpeg backend seeks to a keyframe at least this many frames before the target
+OPENCV_SEEK_DELTA = 16
+
 
 def known_extensions():
     return ['.fmf', '.avi', '.sbfmf', '.ufmf'] # must sync with line 75
@@ -77,13 +90,16 @@ class Movie:
                   parentframe=None,
                   open_now=True,
                   open_multiple=False,
-                  default_extension='.fmf' ):
+                  default_extension='.fmf',
+                  use_keyframe_index=None ):
         """Prepare to open a movie (awaiting call to self.open()).
 If initpath is a filename, just use it.
 If initpath is a directory and interactive is True, then ask user for a filename.
-If initpath is a directory and not in interactive mode, it's an error."""
+If initpath is a directory and not in interactive mode, it's an error.
+use_keyframe_index is passed on to CompressedAvi. If None, USE_KEYFRAME_INDEX is used."""
 
         self.interactive = interactive
+        self.use_keyframe_index = use_keyframe_index
         self.dirname = ""
         self.filename = ""
         self.fullpath = ""
@@ -236,7 +252,7 @@ If initpath is a directory and not in interactive mode, it's an error."""
                 self.type = 'avi'
             except:
                 try:
-                    self.h_mov = CompressedAvi( self.fullpath )
+                    self.h_mov = CompressedAvi( self.fullpath, use_keyframe_index=self.use_keyframe_index )
                     self.type = 'cavi'
                 except Exception as details:
                     msgtxt = "Failed opening file \"%s\"."%( self.fullpath )
@@ -272,7 +288,7 @@ If initpath is a directory and not in interactive mode, it's an error."""
         # unknown movie type
         else:
             try:
-                self.h_mov = CompressedAvi( self.fullpath )
+                self.h_mov = CompressedAvi( self.fullpath, use_keyframe_index=self.use_keyframe_index )
                 self.type = 'cavi'
             except:
                 if self.interactive:
@@ -343,6 +359,27 @@ If initpath is a directory and not in interactive mode, it's an error."""
         frame, stamp = self.h_mov.get_frame( framenumber )
         return frame, stamp
 
+    def iter_frames( self, start=0, end=None, step=1 ):
+        """Generator over (framenumber, frame, stamp) for frames in range(start,end,step).
+Readers that can stream (CompressedAvi) decode the frames in a single forward pass
+without seeking, other readers fall back to get_frame. The single-frame buffer used
+by get_frame is not updated."""
+        n_frames = self.get_n_frames()
+        if end is None or end > n_frames:
+            end = n_frames
+        if hasattr( self.h_mov, 'iter_frames' ):
+            frames = self.h_mov.iter_frames( start, end, step )
+        else:
+            frames = ((f,) + tuple( self.h_mov.get_frame( f ) ) for f in range( start, end, step ))
+
+        while True:
+            with self.file_lock:
+                try:
+                    framenumber, frame, stamp = next( frames )
+                except StopIteration:
+                    return
+            yield framenumber, frame, stamp
+
     def get_n_frames( self ):
         with self.file_lock:
             return self.h_mov.get_n_frames()
@@ -1117,11 +1154,12 @@ class Avi:
 class CompressedAvi:
     """Use OpenCV to read compressed avi files."""
 
-    def __init__(self,filename):
+    def __init__(self,filename,use_keyframe_index=None):
 
         if DEBUG_MOVIES: print('Trying to read compressed AVI')
         self.issbfmf = False
         self.filename = filename
+        self.use_keyframe_index = USE_KEYFRAME_INDEX if use_keyframe_index is None else use_keyframe_index
 
         index_file = os.path.splitext(filename)[0] + '.txt'
         if os.path.splitext(filename)[1] == '.mjpg' and os.path.exists(index_file):
@@ -1142,7 +1180,8 @@ class CompressedAvi:
             self.color_depth = im.size//self.width//self.height
 
         else:
-            if os.path.splitext(filename)[1] in ['.jpg','.png','.jpeg']:
+            self.is_image_seq = os.path.splitext(filename)[1] in ['.jpg','.png','.jpeg']
+            if self.is_image_seq:
                 self.source = cv2.VideoCapture( filename,cv2.CAP_IMAGES )
             else:
                 self.source = cv2.VideoCapture( filename )
@@ -1187,6 +1226,9 @@ class CompressedAvi:
         self.bufferts = num.zeros(self.buffersize)
 
         self.frame_delay_us = 1e6 / self.fps
+        # keyframe index, loaded the first time we need to seek
+        self.keyframes = None
+        self.keyframe_index_loaded = False
         # added to help masquerade as FMF file:
 
         if not self.indexed_mjpg:
@@ -1244,15 +1286,70 @@ class CompressedAvi:
             if DEBUG_MOVIES: print("frame %d is the next frame, just calling get_next_frame"%framenumber)
             return self.get_next_frame()
 
-        # otherwise, we need to seek
-        if DEBUG_MOVIES: print("seeking to frame %d" % framenumber)
-        self.seek( framenumber )
+        # otherwise, we need to seek. With the keyframe index, decode forward instead if that is quicker
         try:
+            if self.use_keyframe_index and self.currframe < framenumber and self.currframe >= self.seek_start_frame(framenumber):
+                # seeking would decode at least as many frames as decoding forward from here
+                if DEBUG_MOVIES: print("decoding forward from frame %d to frame %d" % (self.currframe,framenumber))
+                self._grab_to(framenumber)
+            else:
+                if DEBUG_MOVIES: print("seeking to frame %d" % framenumber)
+                self.seek( framenumber )
             return self.get_next_frame_and_reset_buffer()
         except IOError:
             print("error reading frame %d from compressed AVI (curr %d, buff0 %d, buff1 %d)" % (framenumber, self.currframe, self.bufferframe0, self.bufferframe1))
             raise
 
+    def iter_frames(self,start,end,step=1):
+        """Generator over (framenumber, frame, ts) for frames in range(start,end,step).
+        After the first frame the movie is only read forward. Frames in between are
+        skipped with grab(), which doesn't convert them, so there are no seeks even when step > 1."""
+
+        if self.indexed_mjpg:
+            for framenumber in range(start,end,step):
+                yield (framenumber,) + self.get_frame(framenumber)
+            return
+
+        for framenumber in range(start,end,step):
+            if framenumber < self.currframe:
+                # buffered or behind the current position. get_frame handles it
+                (frame,ts) = self.get_frame(framenumber)
+            else:
+                self._grab_to(framenumber)
+                (frame,ts) = self.get_next_frame_and_reset_buffer()
+            yield (framenumber,frame,ts)
+
+    def _grab_to(self,framenumber):
+        """Skip forward to framenumber without converting or buffering the frames in between."""
+        while self.currframe < framenumber:
+            if not self.source.grab():
+                raise IOError( "OpenCV failed reading frame %d" % self.currframe )
+            self.currframe += 1
+
+    def seek_start_frame(self,framenumber):
+        """Frame that seek(framenumber) starts decoding from. OpenCV seeks to the last keyframe
+        at least OPENCV_SEEK_DELTA frames before framenumber and decodes forward from there.
+        Without a keyframe index, assume that the keyframe is right there."""
+        start = max(framenumber - OPENCV_SEEK_DELTA, 0)
+        keyframe = self.nearest_keyframe(start)
+        return start if keyframe is None else keyframe
+
+    def nearest_keyframe(self,framenumber):
+        """Last keyframe at or before framenumber, or None if there is no keyframe index."""
+        if not self.keyframe_index_loaded:
+            self.keyframe_index_loaded = True
+            if self.use_keyframe_index and not self.is_image_seq:
+                try:
+                    index = get_keyframe_index(self.filename,self.n_frames)
+                except (IOError, OSError):
+                    logging.warning('Could not build keyframe index for {}, seeking without it'.format(self.filename))
+                    index = None
+                self.keyframes = index
+        if self.keyframes is None:
+            return None
+        ndx = num.searchsorted(self.keyframes,framenumber,side='right') - 1
+        return int(self.keyframes[ndx])
+
 
     def get_next_frame_and_reset_buffer(self):
 
@@ -1449,6 +1546,174 @@ class CompressedAvi:
             self.source.set( cv2.CAP_PROP_POS_FRAMES, self.currframe )
         return self.currframe
 
+def _read_riff_chunks(f,start,end):
+    """Return list of (fourcc, listtype, data_start, data_size) for the chunks in [start,end) of a RIFF file.
+    listtype is None for chunks that are not LISTs."""
+    chunks = []
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        fourcc, size = struct.unpack('<4sI', f.read(8))
+        if fourcc == b'LIST':
+            listtype = f.read(4)
+            chunks.append((fourcc,listtype,pos+12,size-4))
+        else:
+            chunks.append((fourcc,None,pos+8,size))
+        pos += 8 + size + (size % 2)
+    return chunks
+
+
+def read_avi_keyframes(filename):
+    """Read keyframe frame numbers for the first video stream of an AVI file from its
+    index. Uses the OpenDML index (indx/ix##) if present and idx1 otherwise.
+    Returns (n_frames, keyframes), or None if the file doesn't have an index."""
+
+    with open(filename,'rb') as f:
+        riff, riff_size, form = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or form != b'AVI ':
+            return None
+        file_size = os.fstat(f.fileno()).st_size
+        top = _read_riff_chunks(f,12,min(12+riff_size-4,file_size))
+
+        vid_stream = None
+        super_index = None
+        idx1 = None
+        for fourcc, listtype, dstart, dsize in top:
+            if listtype == b'hdrl':
+                strls = [c for c in _read_riff_chunks(f,dstart,dstart+dsize) if c[1] == b'strl']
+                for stream, strl in enumerate(strls):
+                    subchunks = _read_riff_chunks(f,strl[2],strl[2]+strl[3])
+                    strh = [c for c in subchunks if c[0] == b'strh']
+                    if len(strh) == 0:
+                        continue
+                    f.seek(strh[0][2])
+                    if f.read(4) != b'vids':
+                        continue
+                    vid_stream = stream
+                    indx = [c for c in subchunks if c[0] == b'indx']
+                    if len(indx) > 0:
+                        super_index = indx[0]
+                    break
+            elif fourcc == b'idx1':
+                idx1 = (dstart,dsize)
+
+        if vid_stream is None:
+            return None
+
+        iskey = []
+        if super_index is not None:
+            f.seek(super_index[2])
+            longs_per_entry, sub_type, index_type, n_entries = struct.unpack('<HBBI', f.read(8))
+            f.read(16) # chunk id and reserved
+            if index_type == 0: # AVI_INDEX_OF_INDEXES
+                std_indices = [struct.unpack('<QII', f.read(16))[0] for _ in range(n_entries)]
+            else:
+                std_indices = [super_index[2]-8]
+            for std_start in std_indices:
+                f.seek(std_start+8)
+                longs_per_entry, sub_type, index_type, n_entries = struct.unpack('<HBBI', f.read(8))
+                f.read(16) # chunk id, base offset and reserved
+                entries = num.frombuffer(f.read(8*n_entries),dtype='<u4').reshape([-1,2])
+                iskey.append((entries[:,1] & 0x80000000) == 0)
+        if len(iskey) == 0 and idx1 is not None:
+            f.seek(idx1[0])
+            entries = num.frombuffer(f.read(idx1[1] - idx1[1] % 16),dtype=[('id','S4'),('flags','<u4'),('offset','<u4'),('size','<u4')])
+            ids = entries['id']
+            vid_ids = [b'%02ddc' % vid_stream, b'%02ddb' % vid_stream]
+            entries = entries[(ids == vid_ids[0]) | (ids == vid_ids[1])]
+            if entries.size == 0:
+                return None
+            iskey.append((entries['flags'] & 0x10) > 0) # AVIIF_KEYFRAME
+        if len(iskey) == 0:
+            return None
+
+    iskey = num.concatenate(iskey)
+    return iskey.size, num.where(iskey)[0]
+
+
+def keyframe_index_files(filename):
+    """Candidate locations for the keyframe index of a movie, in the order they are tried."""
+    fullpath = os.path.abspath(filename)
+    cache_name = os.path.basename(fullpath) + '_' + hashlib.md5(fullpath.encode()).hexdigest()[:12] + KEYFRAME_INDEX_EXT
+    if KEYFRAME_INDEX_DIR is not None:
+        return [os.path.join(KEYFRAME_INDEX_DIR,cache_name)]
+    return [os.path.join(tempfile.gettempdir(),'apt_keyframe_index',cache_name)]
+
+
+def load_keyframe_index(filename,n_frames):
+    """Load a keyframe index saved by save_keyframe_index. Returns the keyframes,
+    or None if there isn't an index that matches the current movie file."""
+    file_size = os.path.getsize(filename)
+    for index_file in keyframe_index_files(filename):
+        if not os.path.exists(index_file):
+            continue
+        try:
+            with open(index_file) as f:
+                header = f.readline().split()
+                keyframes = num.loadtxt(f,dtype='int64',ndmin=1)
+        except (IOError, ValueError):
+            logging.warning('Could not read keyframe index {}'.format(index_file))
+            continue
+        if len(header) != 3 or header[0] != 'kfidx2' or int(header[1]) != file_size or int(header[2]) != n_frames:
+            if DEBUG_MOVIES: print('Keyframe index %s is out of date'%index_file)
+            continue
+        return keyframes
+    return None
+
+
+def save_keyframe_index(filename,n_frames,keyframes):
+    """Save the keyframe index to the first writable location from keyframe_index_files.
+    The file has a header line with the movie size in bytes and the number of frames,
+    followed by the frame number of each keyframe, one per line."""
+    file_size = os.path.getsize(filename)
+    for index_file in keyframe_index_files(filename):
+        tmp_file = index_file + '.tmp%d'%os.getpid()
+        try:
+            os.makedirs(os.path.dirname(index_file),exist_ok=True)
+            with open(tmp_file,'w') as f:
+                f.write('kfidx2 %d %d\n'%(file_size,n_frames))
+                num.savetxt(f,keyframes,fmt='%d')
+            # written to a temp file and renamed so that other processes never see a partial index
+            os.replace(tmp_file,index_file)
+            return index_file
+        except OSError:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    logging.warning('Could not save the keyframe index for {}'.format(filename))
+    return None
+
+
+def get_keyframe_index(filename,n_frames):
+    """Keyframe frame numbers for a compressed AVI. The index is read
+    from the cache if it has been saved before, and otherwise built from the AVI index
+    and then saved. Other containers are not indexed: the movie would have to be read
+    through completely, and OpenCV can already seek in them using their own index.
+    Returns None if there is no usable index."""
+    if os.path.splitext(filename)[1].lower() != '.avi':
+        return None
+    index = load_keyframe_index(filename,n_frames)
+    if index is not None:
+        return index
+
+    try:
+        index = read_avi_keyframes(filename)
+    except (struct.error, ValueError, IOError):
+        logging.warning('Could not read the AVI index of {}'.format(filename))
+        return None
+    if index is None:
+        return None
+    if index[0] != n_frames:
+        # eg, dropped frames that are in the index but not returned by OpenCV
+        if DEBUG_MOVIES: print('AVI index has %d frames, expected %d'%(index[0],n_frames))
+        return None
+
+    _, keyframes = index
+    if keyframes.size == 0 or keyframes[0] != 0:
+        return None
+    save_keyframe_index(filename,n_frames,keyframes)
+    return keyframes
+
+
 def write_results_to_avi(movie,tracks,filename,f0=None,f1=None):
 
     nframes = len(tracks)
@@ -460,25 +460,46 @@ def get_patch(cap, fnum, conf, locs, offset=0, stationary=True, cur_trx=None, fl
         return get_patch_trx(cap, cur_trx, fnum, conf, locs, offset, stationary,flipud)
     else:
         frame_in, _, _, _ = read_frame(cap,fnum,cur_trx,flipud=flipud, offset=offset)
-        frame_in = frame_in[:,:,0:conf.img_dim]
-        if crop_loc is not None:
-            xlo, xhi, ylo, yhi = crop_loc
-            xhi += 1; yhi += 1
-            assert xlo >= 0, 'xlo must be >= 0'
-            assert ylo >= 0, 'ylo must be >= 0'
-        else:
-            xlo = 0; ylo = 0
-            yhi, xhi = frame_in.shape[0:2]
-
-            # convert grayscale to color if the conf says so.
-        #c_loc = conf.cropLoc[tuple(frame_in.shape[0:2])]
-        #frame_in = PoseTools.crop_images(frame_in, conf)
-        frame_in = frame_in[ylo:yhi,xlo:xhi,:]
-        cur_loc = locs.copy()
-        cur_loc[:, 0] = cur_loc[:, 0] - xlo    # ugh, the nasty x-y business.
-        cur_loc[:, 1] = cur_loc[:, 1] - ylo
-        cur_loc = cur_loc.clip(min=0, max=[(xhi-xlo) + 7, (yhi-ylo) + 7])
-        return  frame_in, cur_loc
+        return crop_patch_loc(conf, frame_in, locs, crop_loc)
+
+
+def get_patch_from_frame(framein, fnum, conf, locs, cur_trx=None, flipud=False, crop_loc=None):
+    '''
+    Same as get_patch with offset=0, but for a frame framein that has already been read from the movie.
+    Used to crop patches for all the animals in a frame while decoding the frame only once.
+    '''
+    if flipud:
+        framein = np.flipud(framein)
+    if framein.ndim == 2:
+        framein = framein[:, :, np.newaxis]
+    if cur_trx is not None:
+        x, y, theta = read_trx(cur_trx, fnum)
+        return crop_patch_trx(conf, framein, x, y, theta, locs)
+    else:
+        return crop_patch_loc(conf, framein, locs, crop_loc)
+
+
+def crop_patch_loc(conf, frame_in, locs, crop_loc):
+    ''' return patch for movies without trx file. crop_loc is 0-indexed and can be None for no cropping'''
+    frame_in = frame_in[:,:,0:conf.img_dim]
+    if crop_loc is not None:
+        xlo, xhi, ylo, yhi = crop_loc
+        xhi += 1; yhi += 1
+        assert xlo >= 0, 'xlo must be >= 0'
+        assert ylo >= 0, 'ylo must be >= 0'
+    else:
+        xlo = 0; ylo = 0
+        yhi, xhi = frame_in.shape[0:2]
+
+        # convert grayscale to color if the conf says so.
+    #c_loc = conf.cropLoc[tuple(frame_in.shape[0:2])]
+    #frame_in = PoseTools.crop_images(frame_in, conf)
+    frame_in = frame_in[ylo:yhi,xlo:xhi,:]
+    cur_loc = locs.copy()
+    cur_loc[:, 0] = cur_loc[:, 0] - xlo    # ugh, the nasty x-y business.
+    cur_loc[:, 1] = cur_loc[:, 1] - ylo
+    cur_loc = cur_loc.clip(min=0, max=[(xhi-xlo) + 7, (yhi-ylo) + 7])
+    return  frame_in, cur_loc
 
 
 
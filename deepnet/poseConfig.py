@@ -26,6 +26,10 @@ class config(object):
     def __init__(self):
         self.rescale = 1  # how much to downsize the base image.
         self.label_blur_rad = 3.  # 1.5
+        # paste gaussians centered on the exact landmark locations instead of the pixel-centered label template
+        self.label_subpixel = False
+        # use a gaussian label template. The default template is a single-pixel spike
+        self.label_gaussian = False
         self.imsz = [100,100]
         self.n_classes = 10
         self.img_dim = 3
@@ -63,6 +67,8 @@ class config(object):
         self.normalize_img_mean = False
         self.normalize_batch_mean = False
         self.perturb_color = False
+        # Compose the flips and affine augmentation into one warp per image and do the intensity augmentation on the whole batch at once (PoseTools.preprocess_ims_fused). Faster, but the augmented images differ by a few gray levels, mask edges can shift by a pixel and the images are float32 instead of float64. If False, each augmentation is applied as a separate pass.
+        self.fused_preprocess = False
         self.flipLandmarkMatches = {}
         self.learning_rate_multiplier = 1.
         self.predict_occluded = False
@@ -246,6 +252,22 @@ class config(object):
         self.use_bbox_trx = False
         self.stage = None
 
+        # ============== TRACKING ===============
+        # Number of batches read and cropped ahead of the network while tracking a movie. 0 reads batches serially.
+        self.track_prefetch_depth = 4
+        # Number of threads reading batches. Each extra worker opens its own reader on the movie.
+        self.track_prefetch_workers = 1
+        # Read the movie in a single forward pass and crop all the targets in a frame from one decoded image. Only used with a single prefetch worker.
+        self.track_stream_frames = True
+        # Number of processes that track a movie in parallel. The frames are split into contiguous shards, one per process, and each process loads its own copy of the network.
+        self.track_n_shards = 1
+        # GPUs used by the tracking processes, assigned round robin. If empty, the processes run only on the CPU.
+        self.track_shard_gpus = []
+        # Number of CPU threads for each tracking process when running on the CPU. 0 divides the cores equally between the processes.
+        self.track_shard_threads = 0
+        # Use the keyframes listed in the index of compressed AVIs to decide whether to seek to a frame or decode forward to it, when tracking and when reading tracklet images for id linking. The index is cached in the temp directory.
+        self.movie_keyframe_index = False
+
         # ============== LINKING ===============
         self.link_stage = 'second'
         self.link_maxcost_heuristic = 'secondorder'
@@ -257,6 +279,11 @@ class config(object):
         self.link_minconf_delete = 0.5
         self.link_maxcost_secondorder_thresh = 1.
         self.link_strict_match_thres = 2.
+        # Number of processes used to estimate the linking parameters and to link the movies of a view with motion linking. 1 links in the main process.
+        self.link_n_procs = 1
+        # Do pure linking while tracking, with the linking parameters estimated from the first link_online_estimate_frames frames. The linked tracklets are written as they are linked, so memory does not grow with the length of the movie.
+        self.link_online = False
+        self.link_online_estimate_frames = 1000
 
         self.link_id = False
         self.link_id_cropsz = -1
@@ -269,6 +296,9 @@ class config(object):
         self.link_id_keep_all_preds = False
         self.link_id_batch_size = 16
         self.link_id_ignore_far = False
+        # Cache image samples and embeddings of the tracklets for id linking in link_id_cache_dir so that relinking only processes new or changed tracklets. If link_id_cache_dir is None, the cache is stored next to the output trk file of the first movie. The cache is not pruned, and it grows with the number of tracklets that are linked.
+        self.link_id_cache = False
+        self.link_id_cache_dir = None
 
         # ============= MMPOSE =================
         self.mmpose_net = 'multi_hrnet'
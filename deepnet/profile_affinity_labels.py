@@ -0,0 +1,80 @@
+# Profile part affinity field generation with tfdatagen.create_affinity_labels
+# against the sampled rasterization in tfdatagen.create_affinity_labels_loop on
+# random multi-animal labels, and compare the fields they produce.
+#
+# python profile_affinity_labels.py -nanimals 1 20 -npts 17 -imsz 128 128 -bsize 8
+# python profile_affinity_labels.py -nanimals 20 -tubeblur -tubeblursig 0.95
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import tfdatagen
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-nanimals', dest='nanimals', type=int, nargs='+', default=[1, 20],
+                        help='max_n_animals values to profile')
+    parser.add_argument('-npts', dest='npts', type=int, default=17, help='number of landmarks')
+    parser.add_argument('-imsz', dest='imsz', type=int, nargs=2, default=[128, 128],
+                        help='size of the affinity maps (rows cols)')
+    parser.add_argument('-bsize', dest='bsize', type=int, default=8, help='batch size')
+    parser.add_argument('-animal_sz', dest='animal_sz', type=float, default=20.,
+                        help='std of the landmarks around the animal center in px')
+    parser.add_argument('-tubewidth', dest='tubewidth', type=float, default=0.95, help='op_paf_lores_tubewidth')
+    parser.add_argument('-tubeblur', dest='tubeblur', action='store_true', help='op_paf_lores_tubeblur')
+    parser.add_argument('-tubeblursig', dest='tubeblursig', type=float, default=0.95, help='op_paf_lores_tubeblursig')
+    parser.add_argument('-pmiss', dest='pmiss', type=float, default=0.2,
+                        help='fraction of animals that are missing, as in batches with fewer than max_n_animals')
+    parser.add_argument('-n', dest='n', type=int, default=3, help='number of batches')
+    parser.add_argument('-seed', dest='seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def make_locs(args, nanimals):
+    '''
+    Random locs, bsize x nanimals x npts x 2 with missing animals set to -100000.
+    '''
+    rng = np.random.RandomState(args.seed)
+    ctr = rng.uniform(0, 1, [args.bsize, nanimals, 1, 2]) * [args.imsz[1], args.imsz[0]]
+    locs = ctr + rng.randn(args.bsize, nanimals, args.npts, 2) * args.animal_sz
+    locs[rng.rand(args.bsize, nanimals) < args.pmiss] = -100000
+    return locs
+
+
+def time_fn(fn, locs, graph, args):
+    '''
+    Returns the time per batch and the pafs.
+    '''
+    t0 = time.time()
+    for _ in range(args.n):
+        pafs = fn(locs, args.imsz, graph, tubewidth=args.tubewidth, tubeblur=args.tubeblur,
+                  tubeblursig=args.tubeblursig)
+    return (time.time() - t0) / args.n, pafs
+
+
+def main(argv):
+    args = parse_args(argv)
+    # chain through the landmarks, as in a typical skeleton
+    graph = [[i, i + 1] for i in range(args.npts - 1)]
+    print('Batch of {} with {} landmarks, {} limbs, maps of size {}x{}, {}'.format(
+        args.bsize, args.npts, len(graph), args.imsz[0], args.imsz[1],
+        'tubeblursig {}'.format(args.tubeblursig) if args.tubeblur else 'tubewidth {}'.format(args.tubewidth)))
+    for nanimals in args.nanimals:
+        locs = make_locs(args, nanimals)
+        t_loop, paf_loop = time_fn(tfdatagen.create_affinity_labels_loop, locs, graph, args)
+        t_vec, paf_vec = time_fn(tfdatagen.create_affinity_labels, locs, graph, args)
+        on_loop = np.any(paf_loop != 0, axis=-1)
+        on_vec = np.any(paf_vec != 0, axis=-1)
+        print('{:3d} animals: loop {:.1f}ms, vectorized {:.1f}ms ({:.1f}x). '
+              '{} pixels in loop pafs, {} only in loop, {} only in vectorized. Mean abs diff {:.2g}'.format(
+                  nanimals, 1000 * t_loop, 1000 * t_vec, t_loop / t_vec, np.count_nonzero(on_loop),
+                  np.count_nonzero(on_loop & ~on_vec), np.count_nonzero(on_vec & ~on_loop),
+                  np.abs(paf_vec - paf_loop).mean()))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,87 @@
+# Profile the memory and throughput of reading image batches into float64
+# batches allocated for every batch (the old behaviour) and into uint8 batches
+# that are reused across batches, followed by PoseTools.preprocess_ims.
+#
+# python profile_batch_ims.py -imsz 1024 1024 -bsize 16 -n 20
+# python profile_batch_ims.py -mov /path/to/movie.avi -bsize 16 -n 20
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import movies
+import poseConfig
+import PoseTools
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-mov', dest='mov', default=None,
+                        help='read frames from this movie. If not specified random frames of size imsz are used')
+    parser.add_argument('-imsz', dest='imsz', type=int, nargs=2, default=[1024, 1024], help='image size (rows cols)')
+    parser.add_argument('-img_dim', dest='img_dim', type=int, default=1, help='number of channels')
+    parser.add_argument('-bsize', dest='bsize', type=int, default=16, help='batch size')
+    parser.add_argument('-n', dest='n', type=int, default=20, help='number of batches')
+    return parser.parse_args(argv)
+
+
+def get_frames(args):
+    if args.mov is None:
+        rng = np.random.RandomState(0)
+        return rng.randint(0, 256, [args.bsize] + args.imsz + [args.img_dim]).astype('uint8')
+    cap = movies.Movie(args.mov)
+    frames = []
+    for fnum in range(min(args.bsize, cap.get_n_frames())):
+        frame = cap.get_frame(fnum)[0]
+        if frame.ndim == 2:
+            frame = frame[..., np.newaxis]
+        frames.append(frame)
+    cap.close()
+    return np.array(frames)
+
+
+def time_batches(frames, conf, n_batches, dtype, reuse):
+    '''
+    Copies frames into a batch and preprocesses it n_batches times. Returns the time per batch and the peak memory allocated.
+    '''
+    bsize = conf.batch_size
+    locs = np.zeros([bsize, conf.n_classes, 2])
+    tracemalloc.start()
+    all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,), dtype=dtype)
+    t0 = time.time()
+    for _ in range(n_batches):
+        if not reuse:
+            all_f = np.zeros((bsize,) + tuple(conf.imsz) + (conf.img_dim,), dtype=dtype)
+        for ndx in range(bsize):
+            all_f[ndx, ...] = frames[ndx % frames.shape[0]]
+        ims, _ = PoseTools.preprocess_ims(all_f, locs, conf, False, conf.rescale)
+    t_batch = (time.time() - t0) / n_batches
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return t_batch, peak, all_f.nbytes
+
+
+def main(argv):
+    args = parse_args(argv)
+    frames = get_frames(args)
+    conf = poseConfig.config()
+    conf.imsz = frames.shape[1:3]
+    conf.img_dim = frames.shape[3]
+    conf.batch_size = args.bsize
+    conf.n_classes = 1
+    conf.rescale = 1
+
+    print('Batch of {} images of size {}x{}x{}'.format(args.bsize, conf.imsz[0], conf.imsz[1], conf.img_dim))
+    for name, dtype, reuse in [('float64, new batch', np.float64, False),
+                               ('uint8, new batch', np.uint8, False),
+                               ('uint8, reused batch', np.uint8, True)]:
+        t_batch, peak, nbytes = time_batches(frames, conf, args.n, dtype, reuse)
+        print('{:>20s}: batch {:.1f}MB, peak memory {:.1f}MB, {:.1f}ms/batch, {:.1f} images/s'.format(
+            name, nbytes / 1024 ** 2, peak / 1024 ** 2, 1000 * t_batch, args.bsize / t_batch))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
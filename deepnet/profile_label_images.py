@@ -0,0 +1,69 @@
+# Profile heatmap target generation with PoseTools.create_label_images against
+# the per-point PoseTools.create_label_images_loop on random multi-animal
+# labels, and check that both produce the same targets.
+#
+# python profile_label_images.py -nanimals 1 20 -npts 32 -imsz 256 256 -bsize 8
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import PoseTools
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-nanimals', dest='nanimals', type=int, nargs='+', default=[1, 20],
+                        help='max_n_animals values to profile')
+    parser.add_argument('-npts', dest='npts', type=int, default=32, help='number of landmarks')
+    parser.add_argument('-imsz', dest='imsz', type=int, nargs=2, default=[256, 256], help='image size (rows cols)')
+    parser.add_argument('-bsize', dest='bsize', type=int, default=8, help='batch size')
+    parser.add_argument('-scale', dest='scale', type=int, default=1, help='downsample factor of the targets')
+    parser.add_argument('-blur_rad', dest='blur_rad', type=float, default=3., help='label_blur_rad')
+    parser.add_argument('-pmiss', dest='pmiss', type=float, default=0.2,
+                        help='fraction of animals that are missing, as in batches with fewer than max_n_animals')
+    parser.add_argument('-n', dest='n', type=int, default=10, help='number of batches')
+    parser.add_argument('-seed', dest='seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def make_locs(args, nanimals):
+    '''
+    Random locs, bsize x nanimals x npts x 2 with missing animals set to -100000.
+    '''
+    rng = np.random.RandomState(args.seed)
+    locs = rng.uniform(0, 1, [args.bsize, nanimals, args.npts, 2]) * [args.imsz[1], args.imsz[0]]
+    locs[rng.rand(args.bsize, nanimals) < args.pmiss] = -100000
+    return locs
+
+
+def time_fn(fn, locs, args, **kwargs):
+    '''
+    Returns the time per batch and the targets.
+    '''
+    t0 = time.time()
+    for _ in range(args.n):
+        hmaps = fn(locs, args.imsz, args.scale, args.blur_rad, **kwargs)
+    return (time.time() - t0) / args.n, hmaps
+
+
+def main(argv):
+    args = parse_args(argv)
+    print('Batch of {} with {} landmarks, image size {}x{}, scale {}, blur_rad {}'.format(
+        args.bsize, args.npts, args.imsz[0], args.imsz[1], args.scale, args.blur_rad))
+    for nanimals in args.nanimals:
+        locs = make_locs(args, nanimals)
+        t_loop, hm_loop = time_fn(PoseTools.create_label_images_loop, locs, args)
+        t_vec, hm_vec = time_fn(PoseTools.create_label_images, locs, args)
+        t_gauss, _ = time_fn(PoseTools.create_label_images, locs, args, gaussian=True)
+        t_sub, _ = time_fn(PoseTools.create_label_images, locs, args, subpixel=True)
+        print('{:3d} animals: loop {:.1f}ms, vectorized {:.1f}ms ({:.1f}x), gaussian {:.1f}ms, subpixel {:.1f}ms. '
+              'Same targets as loop: {}'.format(
+                  nanimals, 1000 * t_loop, 1000 * t_vec, t_loop / t_vec, 1000 * t_gauss, 1000 * t_sub,
+                  np.array_equal(hm_vec, hm_loop)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+# Profile per-frame linking throughput of link_trajectories.match_frame on
+# synthetic detections of animals doing random walks, with and without the
+# mutual best match fast path, and of assign_ids on a synthetic trk.
+#
+# python profile_match_frame.py -nanimals 5 20 50 -nframes 5000
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import link_trajectories as lnk
+import poseConfig
+import TrkFile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-nanimals', dest='nanimals', type=int, nargs='+', default=[5, 20, 50],
+                        help='numbers of animals to profile')
+    parser.add_argument('-nframes', dest='nframes', type=int, default=5000, help='number of frames')
+    parser.add_argument('-npts', dest='npts', type=int, default=17, help='number of landmarks')
+    parser.add_argument('-step', dest='step', type=float, default=2., help='std of the per-frame motion in px')
+    parser.add_argument('-pmiss', dest='pmiss', type=float, default=0.01,
+                        help='probability that an animal is not detected in a frame')
+    parser.add_argument('-maxcost', dest='maxcost', type=float, default=100., help='maxcost linking parameter')
+    parser.add_argument('-seed', dest='seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def make_frames(args, nanimals):
+    '''
+    Synthetic detections, npts x 2 x nframes x nanimals with nan for missed detections.
+    '''
+    rng = np.random.RandomState(args.seed)
+    ctr = np.cumsum(rng.randn(2, args.nframes, nanimals) * args.step, axis=1) + \
+        rng.uniform(0, 4096, (2, 1, nanimals))
+    p = ctr[np.newaxis] + rng.randn(args.npts, 2, 1, nanimals) * 20 + \
+        rng.randn(args.npts, 2, args.nframes, nanimals)
+    p[..., rng.rand(args.nframes, nanimals) < args.pmiss] = np.nan
+    return p
+
+
+def time_match_frame(p, params):
+    '''
+    Matches each frame to the next with match_frame. Returns the time per frame and the ids.
+    '''
+    pcurr = p[:, :, 0]
+    pcurr = pcurr[:, :, TrkFile.real_idx(pcurr)]
+    idscurr = np.arange(pcurr.shape[2])
+    lastid = idscurr.size - 1
+    allids = []
+    t0 = time.time()
+    for t in range(1, p.shape[2]):
+        pnext = p[:, :, t]
+        pnext = pnext[:, :, TrkFile.real_idx(pnext)]
+        idscurr, lastid, _, _ = lnk.match_frame(pcurr, pnext, idscurr, params, lastid)
+        allids.append(idscurr)
+        pcurr = pnext
+    return (time.time() - t0) / (p.shape[2] - 1), allids
+
+
+def profile(args, nanimals, params):
+    p = make_frames(args, nanimals)
+    print('{} animals x {} frames, {} landmarks'.format(nanimals, args.nframes, args.npts))
+
+    # count how often the fast path applies
+    match_mutual_best = lnk.match_mutual_best
+    nfast = [0, 0]
+
+    def counted(*fargs):
+        out = match_mutual_best(*fargs)
+        nfast[out[0] is None] += 1
+        return out
+
+    lnk.match_mutual_best = counted
+    time_match_frame(p, params)
+    lnk.match_mutual_best = match_mutual_best
+    t_fast, ids_fast = time_match_frame(p, params)
+    print('  match_frame:                 {:7.3f} ms/frame, {:8.1f} frames/s, fast path used for {:.1%} of frames'.format(
+        t_fast * 1e3, 1 / t_fast, nfast[0] / (p.shape[2] - 1)))
+
+    # same thing, always using the Hungarian algorithm
+    lnk.match_mutual_best = lambda *fargs: (None, None)
+    t_slow, ids_slow = time_match_frame(p, params)
+    lnk.match_mutual_best = match_mutual_best
+    print('  match_frame, Hungarian only: {:7.3f} ms/frame, {:8.1f} frames/s'.format(t_slow * 1e3, 1 / t_slow))
+    assert all(np.array_equal(a, b) for a, b in zip(ids_fast, ids_slow)), 'Fast path changed the ids'
+
+    trk = TrkFile.Trk(p=p)
+    trk.convert2sparse()
+    t0 = time.time()
+    lnk.assign_ids(trk, params)
+    t_assign = (time.time() - t0) / args.nframes
+    print('  assign_ids:                  {:7.3f} ms/frame, {:8.1f} frames/s'.format(t_assign * 1e3, 1 / t_assign))
+
+
+def main(argv):
+    args = parse_args(argv)
+    params = lnk.get_default_params(poseConfig.config())
+    params['maxcost'] = args.maxcost
+    params['verbose'] = 0
+    for nanimals in args.nanimals:
+        profile(args, nanimals, params)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,71 @@
+# Profile random access into a movie with and without the keyframe index
+# used by movies.CompressedAvi.
+#
+# python profile_movie_seek.py /path/to/movie.avi -n 200
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import movies
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mov', help='movie to profile')
+    parser.add_argument('-n', dest='n', type=int, default=200, help='number of random frames to read')
+    parser.add_argument('-seed', dest='seed', type=int, default=0, help='seed for the random frames')
+    parser.add_argument('-sorted', dest='sorted', action='store_true',
+                        help='read the random frames in increasing order, as when sampling frames within tracklets')
+    parser.add_argument('-check', dest='check', action='store_true',
+                        help='check that both modes return the same frames')
+    return parser.parse_args(argv)
+
+
+def time_random_access(mov, frms, use_keyframe_index):
+    '''
+    Read frms in order from a freshly opened movie. Returns per-frame latencies in seconds and the frames read.
+    '''
+    cap = movies.Movie(mov, use_keyframe_index=use_keyframe_index)
+    if use_keyframe_index and cap.type == 'cavi':
+        # build or load the index before timing
+        t0 = time.time()
+        cap.h_mov.nearest_keyframe(0)
+        print('Keyframe index ready in {:.2f}s'.format(time.time() - t0))
+    latency = []
+    ims = []
+    for f in frms:
+        t0 = time.time()
+        im = cap.get_frame_unbuffered(int(f))[0]
+        latency.append(time.time() - t0)
+        ims.append(im.copy())
+    cap.close()
+    return np.array(latency), ims
+
+
+def main(argv):
+    args = parse_args(argv)
+    cap = movies.Movie(args.mov)
+    n_frames = cap.get_n_frames()
+    cap.close()
+    frms = np.random.RandomState(args.seed).randint(0, n_frames, args.n)
+    if args.sorted:
+        frms = np.sort(frms)
+
+    results = {}
+    for use_index in [False, True]:
+        lat, ims = time_random_access(args.mov, frms, use_index)
+        results[use_index] = ims
+        print('{:>22s}: mean {:.2f}ms, median {:.2f}ms, 95th prctile {:.2f}ms, max {:.2f}ms, total {:.2f}s'.format(
+            'with keyframe index' if use_index else 'without keyframe index',
+            1000 * lat.mean(), 1000 * np.median(lat), 1000 * np.percentile(lat, 95), 1000 * lat.max(), lat.sum()))
+
+    if args.check:
+        n_diff = sum([not np.array_equal(a, b) for a, b in zip(results[False], results[True])])
+        print('{} of {} frames differ'.format(n_diff, len(frms)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
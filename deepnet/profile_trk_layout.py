@@ -0,0 +1,121 @@
+# Profile file size and save/load time of trk files in the tracklet layout
+# (one dataset per target) and in the packed layout (one chunked, compressed
+# dataset per field, see TrkFile.Trk.savepacked) on synthetic tracking data.
+#
+# python profile_trk_layout.py -nanimals 20 -nframes 100000
+# python profile_trk_layout.py -nanimals 20 -nframes 100000 -compression lzf
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import TrkFile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-nanimals', dest='nanimals', type=int, default=20, help='number of animals')
+    parser.add_argument('-nframes', dest='nframes', type=int, default=100000, help='number of frames')
+    parser.add_argument('-npts', dest='npts', type=int, default=17, help='number of landmarks')
+    parser.add_argument('-tracklet_len', dest='tracklet_len', type=int, default=2000,
+                        help='mean length of the tracklets each animal track is broken into')
+    parser.add_argument('-compression', dest='compression', default='gzip', help='compression for the packed layout')
+    parser.add_argument('-level', dest='level', type=int, default=4, help='gzip compression level')
+    parser.add_argument('-nqueries', dest='nqueries', type=int, default=100,
+                        help='number of random frames to read after opening lazily')
+    parser.add_argument('-outdir', dest='outdir', default=None, help='where to write the trk files. Default: a temp dir')
+    parser.add_argument('-seed', dest='seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def make_trk(args):
+    '''
+    Synthetic sparse trk: each animal does a random walk for all frames and its track is broken into tracklets.
+    '''
+    rng = np.random.RandomState(args.seed)
+    pTrk = []
+    ts = []
+    tag = []
+    conf = []
+    startframes = []
+    endframes = []
+    for _ in range(args.nanimals):
+        ctr = np.cumsum(rng.randn(2, args.nframes), axis=1) + rng.uniform(0, 1024, (2, 1))
+        p = ctr[np.newaxis] + rng.randn(args.npts, 1, 1) * 20 + rng.randn(args.npts, 2, args.nframes)
+        breaks = np.sort(rng.choice(np.arange(1, args.nframes), args.nframes // args.tracklet_len, replace=False))
+        for sf, ef in zip(np.r_[0, breaks], np.r_[breaks, args.nframes] - 1):
+            n = ef - sf + 1
+            pTrk.append(p[..., sf:ef + 1])
+            ts.append(np.tile(np.arange(sf, ef + 1) / 30., (args.npts, 1)))
+            tag.append(rng.rand(args.npts, n) < 0.05)
+            conf.append(rng.rand(args.npts, n))
+            startframes.append(sf)
+            endframes.append(ef)
+    startframes = np.array(startframes)
+    endframes = np.array(endframes)
+
+    trk = TrkFile.Trk()
+    trk.pTrk = TrkFile.Tracklet(defaultval=trk.defaultval)
+    trk.pTrk.setdata_tracklet(pTrk, startframes, endframes)
+    for k, data in [('pTrkTS', ts), ('pTrkTag', tag), ('pTrkConf', conf)]:
+        trk.__dict__[k] = TrkFile.Tracklet(defaultval=trk.defaultval_dict[k], dtype=trk.dtype_dict[k])
+        trk.__dict__[k].setdata_tracklet(data, startframes, endframes)
+    trk.issparse = True
+    trk.size = trk.pTrk.size
+    trk.pTrkiTgt = np.arange(trk.ntargets, dtype=int)
+    return trk
+
+
+def profile_layout(trk, outfile, saveformat, args, **kwargs):
+    t0 = time.time()
+    trk.save(outfile, saveformat=saveformat, **kwargs)
+    t_save = time.time() - t0
+    sz = os.path.getsize(outfile)
+
+    t0 = time.time()
+    TrkFile.Trk(outfile)
+    t_load = time.time() - t0
+
+    rng = np.random.RandomState(args.seed)
+    frms = rng.randint(0, args.nframes, args.nqueries)
+    t0 = time.time()
+    lazy = TrkFile.Trk(outfile, lazy=True)
+    for f in frms:
+        lazy.getframe(f)
+    t_lazy = time.time() - t0
+    del lazy
+
+    t0 = time.time()
+    TrkFile.Trk(outfile, fields=['pTrkTS'], frames=(args.nframes // 2, args.nframes // 2 + 999))
+    t_window = time.time() - t0
+
+    print('{:10s} size {:8.1f} MB, save {:6.2f}s, load {:6.2f}s, lazy open + {} frames {:6.2f}s, '
+          '1000 frame window {:6.2f}s'.format(saveformat, sz / 1e6, t_save, t_load, args.nqueries, t_lazy, t_window))
+
+
+def main(argv):
+    args = parse_args(argv)
+    t0 = time.time()
+    trk = make_trk(args)
+    print('{} animals x {} frames, {} tracklets, created in {:.1f}s'.format(
+        args.nanimals, args.nframes, trk.ntargets, time.time() - t0))
+
+    outdir = tempfile.mkdtemp() if args.outdir is None else args.outdir
+    level = args.level if args.compression == 'gzip' else None
+    profile_layout(trk, os.path.join(outdir, 'tracklet.trk'), 'tracklet', args)
+    profile_layout(trk, os.path.join(outdir, 'packed.trk'), 'packed', args,
+                   compression=args.compression, compression_opts=level)
+
+    trk0 = TrkFile.Trk(os.path.join(outdir, 'tracklet.trk'), lazy=True)
+    trk1 = TrkFile.Trk(os.path.join(outdir, 'packed.trk'), lazy=True)
+    for f in np.random.RandomState(args.seed + 1).randint(0, args.nframes, args.nqueries):
+        assert np.array_equal(trk0.getframe(f), trk1.getframe(f), equal_nan=True), \
+            'Packed and tracklet layouts do not match'
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
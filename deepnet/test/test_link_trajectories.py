@@ -0,0 +1,62 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import numpy as np
+import scipy.sparse
+import link_trajectories as lnk
+
+
+def weighted_linkage_loop(xmat, overlap, mgr_lens, thresh):
+  # weighted_linkage before the closest clusters were cached, searching over all the pairs after every merge
+  ymat = xmat.copy()
+  clusters = [[i] for i in range(xmat.shape[0])]
+  while True:
+    min_d = np.inf
+    for i in range(len(clusters)):
+      for j in range(i + 1, len(clusters)):
+        dcur = ymat[i, j]
+        if dcur < min_d:
+          min_d = dcur
+          min_i, min_j = i, j
+
+    if min_d > thresh:
+      break
+
+    clusters[min_i] += clusters[min_j]
+    del clusters[min_j]
+
+    ymat[min_j:-1, :] = ymat[min_j + 1:]
+    ymat[:, min_j:-1] = ymat[:, min_j + 1:]
+    for i in range(len(clusters)):
+      if i != min_i:
+        c1 = clusters[i]
+        c2 = clusters[min_i]
+        ymat[i, min_i] = lnk.overlap_dist(xmat[c1][:, c2], c1, c2, overlap, mgr_lens)
+        ymat[min_i, i] = ymat[i, min_i]
+
+  return clusters
+
+
+def random_linkage_inputs(rs, n):
+  # symmetric distances rounded to 0.1 so that there are many ties, and tracklets that overlap in time
+  xmat = np.round(rs.uniform(0, 1.5, [n, n]), 1)
+  xmat = np.triu(xmat, 1)
+  xmat = xmat + xmat.T
+  xmat[range(n), range(n)] = np.nan
+  st = rs.randint(0, 200, n)
+  en = st + rs.randint(1, 60, n)
+  mgr_lens = en - st + 1
+  overlap = np.maximum(0, np.minimum(en[:, None], en[None]) - np.maximum(st[:, None], st[None]) + 1)
+  overlap[range(n), range(n)] = 0
+  return xmat, overlap, mgr_lens
+
+
+def test_weighted_linkage_matches_loop():
+  rs = np.random.RandomState(0)
+  for itr in range(300):
+    n = rs.randint(2, 40)
+    xmat, overlap, mgr_lens = random_linkage_inputs(rs, n)
+    thresh = rs.choice([0.3, 0.6, 1.])
+    expected = weighted_linkage_loop(xmat.copy(), overlap, mgr_lens, thresh)
+    assert lnk.weighted_linkage(xmat.copy(), overlap, mgr_lens, thresh) == expected, itr
+    assert lnk.weighted_linkage(xmat.copy(), scipy.sparse.csr_matrix(overlap), mgr_lens, thresh) == expected, itr
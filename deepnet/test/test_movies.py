@@ -0,0 +1,58 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import cv2
+import numpy as np
+import movies
+
+
+def synthetic_avi(filename, n_frames=120, sz=(48, 64)):
+  # mpeg4 avi with a keyframe every 12 frames. Each frame is different so that frames that are read wrongly show up.
+  writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'XVID'), 30, sz[::-1], False)
+  assert writer.isOpened()
+  for fr in range(n_frames):
+    im = np.zeros(sz, np.uint8)
+    im[:, fr % 60:fr % 60 + 4] = 255
+    im[fr % sz[0], :] = 128
+    writer.write(im)
+  writer.release()
+  return n_frames
+
+
+def read_frames(mov_file, frms, use_keyframe_index):
+  cap = movies.Movie(mov_file, use_keyframe_index=use_keyframe_index)
+  ims = [cap.get_frame_unbuffered(int(f))[0].copy() for f in frms]
+  cap.close()
+  return ims
+
+
+def test_keyframe_index(tmp_path, monkeypatch):
+  # reading with the keyframe index, which decodes forward instead of seeking when that is quicker, gives the same frames as seeking
+  monkeypatch.setattr(movies, 'KEYFRAME_INDEX_DIR', str(tmp_path / 'kfidx'))
+  mov_file = str(tmp_path / 'mov.avi')
+  n_frames = synthetic_avi(mov_file)
+  assert np.array_equal(movies.get_keyframe_index(mov_file, n_frames), np.arange(0, n_frames, 12))
+  # the second time the index is read from the cache
+  assert len(os.listdir(tmp_path / 'kfidx')) == 1
+  assert np.array_equal(movies.get_keyframe_index(mov_file, n_frames), np.arange(0, n_frames, 12))
+
+  rs = np.random.RandomState(0)
+  for frms in [np.sort(rs.randint(0, n_frames, 50)), rs.randint(0, n_frames, 50), np.arange(3, n_frames, 5)]:
+    seek_ims = read_frames(mov_file, frms, False)
+    index_ims = read_frames(mov_file, frms, True)
+    for f, a, b in zip(frms, seek_ims, index_ims):
+      assert np.array_equal(a, b), f
+
+
+def test_keyframe_index_off(tmp_path, monkeypatch):
+  # without the index, frames that are not buffered or next are always read by seeking
+  mov_file = str(tmp_path / 'mov.avi')
+  synthetic_avi(mov_file)
+  cap = movies.Movie(mov_file, use_keyframe_index=False)
+  seeks = []
+  seek = cap.h_mov.seek
+  monkeypatch.setattr(cap.h_mov, 'seek', lambda f: seeks.append(f) or seek(f))
+  cap.get_frame(5)
+  cap.get_frame(9)
+  cap.close()
+  assert seeks == [5, 9]
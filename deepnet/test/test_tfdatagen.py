@@ -0,0 +1,33 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import numpy as np
+import tfdatagen
+
+
+def random_locs(seed, nbatch=3, nanimals=6, npts=5, imsz=(40, 52)):
+  # animals that overlap, are missing or go past the image edges, and a limb with identical start and end labels
+  rs = np.random.RandomState(seed)
+  ctr = rs.uniform(0, 1, [nbatch, nanimals, 1, 2]) * [imsz[1], imsz[0]]
+  locs = ctr + rs.randn(nbatch, nanimals, npts, 2) * 8
+  locs[rs.rand(nbatch, nanimals) < 0.2] = -100000
+  locs[0, 0, 1] = locs[0, 0, 0]
+  return locs
+
+
+def test_affinity_labels_match_loop():
+  # the vectorized pafs are the same as the sampled rasterization in create_affinity_labels_loop
+  imsz = (40, 52)
+  graph = [[0, 1], [1, 2], [2, 3], [1, 4]]
+  for seed in range(4):
+    locs = random_locs(seed, imsz=imsz)
+    for kwargs in [{'tubewidth': 0.95}, {'tubewidth': 2.5}, {'tubeblur': True, 'tubeblursig': 0.95}]:
+      paf_loop = tfdatagen.create_affinity_labels_loop(locs, imsz, graph, **kwargs)
+      for max_samples in [2**22, 1000]:
+        paf = tfdatagen.create_affinity_labels(locs, imsz, graph, max_samples=max_samples, **kwargs)
+        assert np.array_equal(paf != 0, paf_loop != 0), (seed, kwargs)
+        # np.exp can differ in the last bit between vector lengths
+        assert np.allclose(paf, paf_loop, rtol=0, atol=1e-12), (seed, kwargs)
+      # single animal locs without the animal dimension
+      paf = tfdatagen.create_affinity_labels(locs[:, 1], imsz, graph, **kwargs)
+      assert np.allclose(paf, tfdatagen.create_affinity_labels_loop(locs[:, 1], imsz, graph, **kwargs), rtol=0, atol=1e-12)
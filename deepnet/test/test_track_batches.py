@@ -0,0 +1,106 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import cv2
+import numpy as np
+import APT_interface as apt
+import movies
+import poseConfig
+
+
+def synthetic_avi(filename, n_frames=60, sz=(48, 64)):
+  # mpeg4 avi with a keyframe every 12 frames. Each frame is different so that frames that are read wrongly show up.
+  writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'XVID'), 30, sz[::-1], False)
+  assert writer.isOpened()
+  rs = np.random.RandomState(0)
+  for fr in range(n_frames):
+    im = cv2.GaussianBlur(rs.randint(0, 256, sz).astype(np.uint8), (5, 5), 0)
+    im[fr % sz[0], :] = 255
+    writer.write(im)
+  writer.release()
+  return n_frames
+
+
+def synthetic_trx(rs, n_frames, n_trx, sz):
+  # trx as read by read_trx_file, 1-indexed, with targets that start and end at different frames and are missing in some
+  trx = []
+  first_frames, end_frames = [], []
+  for itgt in range(n_trx):
+    first = rs.randint(0, n_frames // 3)
+    end = rs.randint(2 * n_frames // 3, n_frames + 1)
+    n = end - first
+    x = rs.uniform(10, sz[1] - 10, [1, n])
+    y = rs.uniform(10, sz[0] - 10, [1, n])
+    x[0, rs.rand(n) < 0.1] = np.nan
+    trx.append({'x': x, 'y': y, 'theta': rs.uniform(-np.pi, np.pi, [1, n]),
+                'firstframe': np.array([[first + 1]]), 'endframe': np.array([[end]])})
+    first_frames.append(first)
+    end_frames.append(end)
+  return trx, np.array(first_frames), np.array(end_frames)
+
+
+def get_to_do_list(trx, first_frames, end_frames, start_frame, end_frame, skip_rate):
+  # same as in track_movie_frames
+  to_do_list = []
+  for cur_f in range(start_frame, end_frame, skip_rate):
+    for t in range(len(trx)):
+      if (end_frames[t] > cur_f) and (first_frames[t] <= cur_f):
+        if trx[t] is None or (not np.isnan(trx[t]['x'][0, cur_f - first_frames[t]])):
+          to_do_list.append([cur_f, t])
+  return to_do_list
+
+
+def check_batches(mov_file, conf, to_do_list, trx, flipud):
+  bsize = conf.batch_size
+  cap = movies.Movie(mov_file)
+  serial = [apt.create_batch_ims(to_do_list[s:s + bsize], conf, cap, flipud, trx, None)
+            for s in range(0, len(to_do_list), bsize)]
+  cap.close()
+  assert len(serial) > 1
+
+  cap = movies.Movie(mov_file)
+  streamed = [b.copy() for b in apt.iter_batch_ims(to_do_list, conf, cap, flipud, trx, None)]
+  cap.close()
+  assert len(streamed) == len(serial)
+  for a, b in zip(serial, streamed):
+    assert np.array_equal(a, b)
+
+  for queue_depth, n_workers, stream in [(0, 1, False), (0, 1, True), (4, 1, False), (4, 1, True), (4, 3, False)]:
+    cap = movies.Movie(mov_file)
+    batches = [(cur_b, b.copy()) for cur_b, b in apt.prefetch_batch_ims(to_do_list, conf, cap, flipud, trx, None,
+                                                                        n_workers=n_workers, queue_depth=queue_depth, stream=stream)]
+    cap.close()
+    assert [cur_b for cur_b, _ in batches] == list(range(len(serial)))
+    for a, (_, b) in zip(serial, batches):
+      assert np.array_equal(a, b), (queue_depth, n_workers, stream)
+
+
+def test_batches_trx(tmp_path):
+  # prefetched and streamed batches are the same as the batches read serially with create_batch_ims
+  mov_file = str(tmp_path / 'mov.avi')
+  n_frames = synthetic_avi(mov_file)
+  conf = poseConfig.config()
+  conf.imsz = (24, 24)
+  conf.img_dim = 1
+  conf.batch_size = 7
+  conf.n_classes = 2
+  conf.trx_align_theta = True
+  rs = np.random.RandomState(1)
+  trx, first_frames, end_frames = synthetic_trx(rs, n_frames, 3, (48, 64))
+  for start_frame, end_frame, skip_rate in [(0, n_frames, 1), (5, n_frames - 3, 3), (2, n_frames, 13)]:
+    to_do_list = get_to_do_list(trx, first_frames, end_frames, start_frame, end_frame, skip_rate)
+    check_batches(mov_file, conf, to_do_list, trx, flipud=False)
+
+
+def test_batches_no_trx(tmp_path):
+  mov_file = str(tmp_path / 'mov.avi')
+  n_frames = synthetic_avi(mov_file)
+  conf = poseConfig.config()
+  conf.imsz = (48, 64)
+  conf.img_dim = 1
+  conf.batch_size = 4
+  conf.n_classes = 2
+  trx = [None]
+  for start_frame, end_frame, skip_rate, flipud in [(0, n_frames, 1, False), (3, n_frames, 5, True), (1, n_frames - 10, 11, False)]:
+    to_do_list = get_to_do_list(trx, np.zeros(1, int), np.array([n_frames]), start_frame, end_frame, skip_rate)
+    check_batches(mov_file, conf, to_do_list, trx, flipud=flipud)
@@ -0,0 +1,158 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import numpy as np
+import TrkFile
+
+
+def random_trk(seed, T0=None):
+  rs = np.random.RandomState(seed)
+  nl, T, nt = 3, rs.randint(20, 200), rs.randint(1, 5)
+  if T0 is None:
+    T0 = rs.randint(0, 150)
+  p = rs.rand(nl, 2, T, nt) * 100
+  for itgt in range(nt):
+    s = rs.randint(0, T)
+    e = rs.randint(s + 1, T + 1)
+    p[:, :, :s, itgt] = np.nan
+    p[:, :, e:, itgt] = np.nan
+  src = {'pTrk': p, 'pTrkConf': rs.rand(nl, T, nt), 'pTrkTS': rs.rand(nl, T, nt), 'pTrkTag': rs.rand(nl, T, nt) > .5}
+  trk = TrkFile.Trk(p=p.copy(), pTrkConf=src['pTrkConf'].copy(), pTrkTS=src['pTrkTS'].copy(),
+                    pTrkTag=src['pTrkTag'].copy(), T0=T0)
+  trk.convert2sparse()
+  return trk, rs, src
+
+
+def check_frames_equal(trk0, trk1, fs):
+  p0, e0 = trk0.getframe(fs, extra=True)
+  p1, e1 = trk1.getframe(fs, extra=True)
+  assert np.allclose(p0, p1, equal_nan=True)
+  for k in trk0.trkFields:
+    if e0[k] is None:
+      assert e1[k] is None, k
+    else:
+      assert np.allclose(e0[k], e1[k], equal_nan=True), k
+
+
+def test_windowed_load(tmp_path):
+  # windowed and lazy loads give the same data for every field as a full load
+  for seed in range(40):
+    trk, rs, _ = random_trk(seed)
+    for saveformat in ['tracklet', 'packed']:
+      trkfile = str(tmp_path / f'{seed}_{saveformat}.trk')
+      trk.save(trkfile, saveformat=saveformat)
+      full = TrkFile.Trk(trkfile)
+      a = rs.randint(trk.T0, trk.T1 + 1)
+      b = rs.randint(a, trk.T1 + 1)
+      fs = np.arange(a, b + 1)
+      for lazy in [False, True]:
+        win = TrkFile.Trk()
+        win.load(trkfile, frames=(a, b), lazy=lazy)
+        with win:
+          check_frames_equal(full, win, fs)
+          for k in ['pTrk', ] + trk.trkFields:
+            if full.__dict__[k] is not None:
+              assert np.array_equal(full.__dict__[k].getframe(fs), win.__dict__[k].getframe(fs), equal_nan=True)
+
+
+def test_full_load_fields(tmp_path):
+  # the trkFields of a sparse trk that does not start at frame 0 are read at the same frames as pTrk
+  T0 = 100
+  trk, _, src = random_trk(38, T0=T0)
+  trkfile = str(tmp_path / 'full.trk')
+  trk.save(trkfile)
+  loaded = TrkFile.Trk(trkfile)
+  T = src['pTrk'].shape[2]
+  p, edict = loaded.getframe(np.arange(T0, T0 + T), extra=True)
+  assert np.allclose(p, src['pTrk'], equal_nan=True)
+  isreal = ~np.isnan(src['pTrk'][:, 0])
+  for k in ['pTrkConf', 'pTrkTS', 'pTrkTag']:
+    assert np.allclose(edict[k][isreal], src[k][isreal]), k
+
+
+def test_getframe_fields_T0():
+  # the trkFields of a sparse trk are looked up at the same absolute frames as pTrk. They used to be looked up at
+  # fs-T0, which returned the wrong frames or nan whenever T0 != 0
+  for T0 in [0, 7, 120]:
+    trk, rs, src = random_trk(5, T0=T0)
+    T = src['pTrk'].shape[2]
+    fs = np.sort(rs.choice(np.arange(T0, T0 + T), 15, replace=False))
+    p, edict = trk.getframe(fs, extra=True)
+    assert np.allclose(p, src['pTrk'][:, :, fs - T0], equal_nan=True)
+    isreal = ~np.isnan(src['pTrk'][:, 0, fs - T0])
+    assert isreal.any()
+    for k in ['pTrkConf', 'pTrkTS', 'pTrkTag']:
+      assert np.allclose(edict[k][isreal], src[k][:, fs - T0][isreal]), (T0, k)
+
+
+def test_lazy_save_same_file(tmp_path):
+  # a lazily loaded trk can be saved back to the file it reads from
+  trk, _, _ = random_trk(1)
+  for saveformat in ['tracklet', 'packed']:
+    trkfile = str(tmp_path / f'{saveformat}.trk')
+    trk.save(trkfile, saveformat=saveformat)
+    lazy = TrkFile.Trk(trkfile, lazy=True)
+    lazy.getframe(trk.T0)
+    lazy.save(trkfile, saveformat='packed')
+    check_frames_equal(trk, TrkFile.Trk(trkfile), np.arange(trk.T0, trk.T1 + 1))
+
+
+def test_settargetframe_fields():
+  # setting pTrk data must not change the intervals of the trkFields, which were set with pTrk's startframes
+  for trial in range(100):
+    trk, rs, src = random_trk(trial, T0=trial % 5)
+    T0 = trk.T0
+    nl, _, T, nt = src['pTrk'].shape
+    sf = trk.pTrk.startframes.copy()
+    ef = trk.pTrk.endframes.copy()
+    expected = np.full(src['pTrkConf'].shape, np.nan)
+    for itgt in range(nt):
+      expected[:, sf[itgt] - T0:ef[itgt] - T0 + 1, itgt] = src['pTrkConf'][:, sf[itgt] - T0:ef[itgt] - T0 + 1, itgt]
+    for step in range(10):
+      v = rs.rand(nl, 2, 1, 1)
+      if rs.rand() < 0.4:
+        v[:] = np.nan
+      trk.settargetframe(v, np.array([rs.randint(nt)]), np.array([T0 + rs.randint(T)]))
+      if rs.rand() < 0.5:
+        trk.pTrk.consolidate()
+    # used to raise IndexError once the trkFields' offsets were out of step with the shared startframes
+    trk.gettarget(np.arange(nt), extra=True)
+    _, edict = trk.gettargetframe(np.arange(nt), np.arange(T0, T0 + T), extra=True)
+    assert np.allclose(edict['pTrkConf'], expected, equal_nan=True)
+
+
+def test_writer_remove_info(tmp_path):
+  # progress records removed from a part file don't show up in the loaded trkInfo
+  trk, _, src = random_trk(2)
+  trkfile = str(tmp_path / 'part.trk')
+  info = {'mov_file': 'mov.avi', 'part': {'start_frame': trk.T0, 'next_frame': trk.T0}, 'params': {'n_classes': 3}}
+  with TrkFile.TrkWriter(trkfile, trk.ntargets, T0=trk.T0, trkInfo=info) as writer:
+    writer.append(TrkFile.Trk(p=src['pTrk'].copy(), T0=trk.T0))
+    writer.set_info('part/next_frame', trk.T0 + src['pTrk'].shape[2])
+    writer.remove_info('part')
+  loaded = TrkFile.Trk(trkfile)
+  assert set(loaded.trkData['trkInfo'].keys()) == {'mov_file', 'params'}
+  assert loaded.trkData['trkInfo']['params']['n_classes'] == 3
+  assert np.allclose(loaded.getframe(np.arange(trk.T0, trk.T0 + src['pTrk'].shape[2])), src['pTrk'], equal_nan=True)
+
+
+def test_writer_tails_are_copies(tmp_path):
+  # frames of targets without predictions are buffered without keeping the appended trks alive
+  nl, T, nt = 3, 50, 4
+  trkfile = str(tmp_path / 'tails.trk')
+  rs = np.random.RandomState(3)
+  src = np.full((nl, 2, 10 * T, nt), np.nan)
+  with TrkFile.TrkWriter(trkfile, nt, T0=0) as writer:
+    for ichunk in range(10):
+      p = np.full((nl, 2, T, nt), np.nan)
+      p[..., :nt - 1] = rs.rand(nl, 2, T, nt - 1)
+      if ichunk in [0, 7]:
+        p[:, :, 0, nt - 1] = rs.rand(nl, 2)
+      src[:, :, ichunk * T:(ichunk + 1) * T] = p
+      writer.append(TrkFile.Trk(p=p, T0=ichunk * T))
+      for tails in writer.tails:
+        for tail in tails:
+          for v in tail.values():
+            assert v.base is None
+  loaded = TrkFile.Trk(trkfile)
+  assert np.allclose(loaded.getframe(np.arange(10 * T)), src, equal_nan=True)
@@ -72,7 +72,8 @@ def create_affinity_labels(locs, imsz, graph,
                            tubewidth=1.0,
                            tubeblur=False,
                            tubeblursig=None,
-                           tubeblurclip=0.05):
+                           tubeblurclip=0.05,
+                           max_samples=2**22):
     """
     Create/return part affinity fields
 
@@ -80,6 +81,124 @@ def create_affinity_labels(locs, imsz, graph,
         upper-left pixel.
     imsz: [2] (nr, nc) size of affinity maps to create/return
 
+    graph: (nlimb) array of 2-element tuples; connectivity/skeleton
+    tubewidth: width of "limb". 
+               - if tubeBlurred=False, the tube has "hard" edges with width==tubewidth.
+                 *Warning* maybe don't choose tubewidth exactly equal to 1.0 in this case.
+               - if tubeBlurred=True, then the tube has a clipped gaussian perpendicular
+                 xsection. The stddev of this gaussian is tubeblursig. The tails of the
+                 gaussian are clipped at tubeblurclip. 
+    max_samples: max number of points along the limbs that are evaluated at once.
+                 
+    In all cases the paf amplitude is in [0,1] ie the tube maximum is at y=1.
+
+    The limbs are rasterized by sampling the same points along them as
+    create_affinity_labels_loop, but for all the limbs at once, so the output
+    is the same. Where limbs of different animals overlap, the last animal wins
+    as in the loop.
+
+    returns (nbatch x imsz[0] x imsz[1] x nlimb*2) paf hmaps.
+        4th dim ordering: limb1x, limb1y, limb2x, limb2y, ...
+    """
+
+    if tubeblur:
+        # tubewidth ignored, tubeblursig must be set
+        assert tubeblursig is not None, "tubeblursig must be set"
+        # tube radius (squared) corresponding to clip limit tubeblurblip
+        tuberadsq = -2.0 * tubeblursig**2 * np.log(tubeblurclip)
+        tuberad = np.sqrt(tuberadsq)
+        tubewidth = 2.0 * tuberad
+        # only pixels within tuberad of the limb segment will fall inside clipping range
+    else:
+        tuberad = tubewidth / 2.0
+
+    locs = np.asarray(locs, dtype='float')
+    if locs.ndim == 3:
+        locs = locs[:,np.newaxis,...]
+
+    nlimb = len(graph)
+    nbatch = locs.shape[0]
+    out = np.zeros([nbatch, imsz[0], imsz[1], nlimb * 2])
+    if nlimb == 0:
+        return out
+    n_steps = 2 * max(imsz)
+
+    # limbs in the order batch, animal, limb, which is the order in which they
+    # overwrite each other.
+    graph = np.array(graph)
+    start = locs[:, :, graph[:, 0], :]
+    end = locs[:, :, graph[:, 1], :]
+    assert np.all(np.isfinite(start)) and np.all(np.isfinite(end))
+    limb_ndx = np.broadcast_to(np.arange(nlimb), start.shape[:3])
+    batch_ndx = np.broadcast_to(np.arange(nbatch)[:, np.newaxis, np.newaxis], start.shape[:3])
+    # same arithmetic as in the loop so that the sampled points are rounded the same way
+    ll2 = (start[..., 0] - end[..., 0]) ** 2 + (start[..., 1] - end[..., 1]) ** 2
+    ll = np.sqrt(ll2)
+    # multi labeled animals that are not labeled and limbs with identical start/end labels are skipped.
+    valid = (start[..., 0] >= -1000) & (start[..., 1] >= -1000) & (ll > 0)
+    start = start[valid]
+    end = end[valid]
+    ll2 = ll2[valid]
+    ll = ll[valid]
+    limb_ndx = limb_ndx[valid]
+    batch_ndx = batch_ndx[valid]
+    costh = (end[:, 0] - start[:, 0]) / ll
+    sinth = (end[:, 1] - start[:, 1]) / ll
+
+    TUBESTEP = 0.25
+    ntubestep = int(np.ceil(tubewidth / TUBESTEP + 1))
+    # perpendicular displacements of the sampled lines from the limb
+    deltas = np.linspace(-tuberad, tuberad, ntubestep)
+    n_chunk = max(1, max_samples // (ntubestep * n_steps))
+
+    out_flat = out.reshape(-1)
+    for st in range(0, len(ll), n_chunk):
+        c = slice(st, st + n_chunk)
+        # sampled points, limbs x deltas x steps
+        xx = np.round(np.linspace(start[c, 0, np.newaxis] + deltas * sinth[c, np.newaxis],
+                                  end[c, 0, np.newaxis] + deltas * sinth[c, np.newaxis], n_steps, axis=-1))
+        yy = np.round(np.linspace(start[c, 1, np.newaxis] - deltas * costh[c, np.newaxis],
+                                  end[c, 1, np.newaxis] - deltas * costh[c, np.newaxis], n_steps, axis=-1))
+        sel = np.broadcast_to(np.arange(st, st + xx.shape[0])[:, np.newaxis, np.newaxis], xx.shape).reshape(-1)
+        xx = xx.reshape(-1)
+        yy = yy.reshape(-1)
+        inside = (xx >= 0) & (xx < imsz[1]) & (yy >= 0) & (yy < imsz[0])
+        sel = sel[inside]
+        xx = xx[inside]
+        yy = yy[inside]
+        pndx = ((batch_ndx[sel] * imsz[0] + yy.astype('int')) * imsz[1] + xx.astype('int')) * nlimb * 2 + limb_ndx[sel] * 2
+
+        # keep the last write to each pixel. All the points of a limb that fall in a pixel give the same value.
+        _, last = np.unique(pndx[::-1], return_index=True)
+        last = len(pndx) - 1 - last
+        pndx = pndx[last]
+        sel = sel[last]
+        if tubeblur:
+            # distance of the pixel center to the limb, as in the loop
+            num = (end[sel, 1] - start[sel, 1]) * xx[last] - (end[sel, 0] - start[sel, 0]) * yy[last] + \
+                  end[sel, 0] * start[sel, 1] - end[sel, 1] * start[sel, 0]
+            w = np.exp(-(np.square(num) / ll2[sel]) / 2.0 / tubeblursig**2)
+            out_flat[pndx] = w * costh[sel]
+            out_flat[pndx + 1] = w * sinth[sel]
+        else:
+            out_flat[pndx] = costh[sel]
+            out_flat[pndx + 1] = sinth[sel]
+
+    return out
+
+def create_affinity_labels_loop(locs, imsz, graph,
+                                tubewidth=1.0,
+                                tubeblur=False,
+                                tubeblursig=None,
+                                tubeblurclip=0.05):
+    """
+    Reference implementation of create_affinity_labels that samples points
+    along each limb and writes the pixels they fall in one at a time.
+
+    locs: (nbatch x npts x 2) (x,y) locs, 0-based. (0,0) is the center of the
+        upper-left pixel.
+    imsz: [2] (nr, nc) size of affinity maps to create/return
+
     graph: (nlimb) array of 2-element tuples; connectivity/skeleton
     tubewidth: width of "limb". 
                - if tubeBlurred=False, the tube has "hard" edges with width==tubewidth.
@@ -580,7 +699,8 @@ def data_generator(tfrfilename, conf, distort, shuffle, ims_locs_proc_fn,
         ims_locs_proc_fn = globals()[ims_locs_proc_fn]
 
     batch_size = conf.batch_size
-    N = PoseTools.count_records(filename)
+    reader = PoseTools.TFRecordIndexedReader(filename)
+    N = len(reader)
 
     if instrumented and (instrumentedname is None):
         instrumentedname = "Unnamed-{}".format(os.path.basename(filename))
@@ -594,30 +714,20 @@ def data_generator(tfrfilename, conf, distort, shuffle, ims_locs_proc_fn,
         pass
 
     ns = Namespace()
-    ns.iterator = None
-
-    def iterator_reset():
-        if ns.iterator:
-            ns.iterator.close()
-        ns.iterator = tf.python_io.tf_record_iterator(filename)
+    ns.epoch = 0
+    ns.order = reader.epoch_order(ns.epoch, shuffle, seed=np.random.randint(2**31))
+    ns.pos = 0
 
     def iterator_read_next():
-        if not ns.iterator:
-            ns.iterator = tf.python_io.tf_record_iterator(filename)
-        try:
-            if ISPY3:
-                record = next(ns.iterator)
-            else:
-                record = ns.iterator.next()
-        except StopIteration:
-            if infinite:
-                iterator_reset()
-                if ISPY3:
-                    record = next(ns.iterator)
-                else:
-                    record = ns.iterator.next()
-            else:
-                raise
+        # records are read in a new random permutation each epoch if shuffle is True
+        if ns.pos >= len(ns.order):
+            if not infinite or N == 0:
+                raise StopIteration
+            ns.epoch += 1
+            ns.order = reader.epoch_order(ns.epoch, shuffle, seed=np.random.randint(2**31))
+            ns.pos = 0
+        record = reader[ns.order[ns.pos]]
+        ns.pos += 1
         return record
 
     while True:
@@ -626,11 +736,8 @@ def data_generator(tfrfilename, conf, distort, shuffle, ims_locs_proc_fn,
         all_info = []
         all_mask = []
         for b_ndx in range(batch_size):
-            # TODO: strange shuffle
-            n_skip = np.random.randint(30) if shuffle else 0
             try:
-                for _ in range(n_skip + 1):
-                    record = iterator_read_next()
+                record = iterator_read_next()
             except StopIteration:
                 # did not make it to next record for this batch;
                 # will only occur if infinite == False